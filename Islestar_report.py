@@ -1,8 +1,15 @@
 import os
 import time
-from typing import Dict, List
+from functools import partial
+from typing import BinaryIO, Dict, List, Optional
+import numpy as np
 import pandas as pd
 
+from cost_cube import build_cost_cube
+from money import USAGE_UNITS, format_pounds, parse_money, round_to_pence
+from pipeline import Pipeline
+from vodafone_exports import USAGE_EXPORT, read_export
+
 timestamp = int(time.time())
 
 
@@ -35,6 +42,15 @@ CATEGORY_MAPPING: Dict[str, str] = {
     "SMS": "Other"
 }
 
+# Distinct mapped categories, in a stable order
+USAGE_CATEGORIES: List[str] = list(dict.fromkeys(CATEGORY_MAPPING.values()))
+
+# Daily Rate Roaming day counts, keyed by charge band (£2 EU / £5 RoW)
+ROAMING_COUNT_COLUMNS: List[str] = ["EU Daily Roaming Charges", "RoW Daily Roaming Charges"]
+
+# Rows per chunk when streaming large usage exports
+USAGE_CHUNK_SIZE: int = 250_000
+
 # Initialize billing columns
 BILLING_COLUMNS: List[str] = [
     "EU Daily Roaming Charges",
@@ -64,61 +80,97 @@ def load_service_breakdown(file_path: str) -> pd.DataFrame:
     new_df["Department"] = df["Cost Centre"]
     new_df["User"] = df["Name"]
     new_df["Number"] = df["Service"].astype(str).str.strip()
-    df["Fixed Charges"] = pd.to_numeric(df["Fixed Charges"], errors="coerce").fillna(0)
-    new_df["Fixed Charges"] = df["Fixed Charges"]
+    # In pence. Amounts of £1,000 or more have a thousands separator (" 1,300.00");
+    # blank or unparseable amounts count as 0
+    new_df["Fixed Charges"] = parse_money(df["Fixed Charges"]).fillna(0)
     return new_df
 
 
-def process_billing_data(service_breakdown_path: str, usage_csv_path: str, client_name: str) -> str:
+def summarise_usage(usage_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Process the billing data for Islestar
+    Aggregate raw usage rows into per-Service category totals and roaming counts.
+
+    Args:
+        usage_df (pd.DataFrame): Usage rows with "Service", "Usage Category" and "Cost" columns
+
+    Returns:
+        pd.DataFrame: One row per Service, one column per mapped category (costs in
+            USAGE_UNITS, see money.py) plus the EU and RoW Daily Rate Roaming counts
+    """
+    service = usage_df["Service"].astype(str).str.strip()
+    # Map as plain strings: mapping a categorical can give a categorical, which
+    # has no "Other" category to fill with
+    category = usage_df["Usage Category"].astype(object).map(CATEGORY_MAPPING).fillna("Other")
+    cost = parse_money(usage_df["Cost"], USAGE_UNITS).fillna(0)
+
+    summary, _ = build_cost_cube(service, category, cost, categories=USAGE_CATEGORIES)
+
+    # Count occurrences based on Cost values (Pivot Table Logic)
+    daily_roaming = category == "Daily Rate Roaming"
+    roaming_band = pd.Series(np.select(
+        [daily_roaming & (cost == 2 * USAGE_UNITS), daily_roaming & (cost == 5 * USAGE_UNITS)],
+        ROAMING_COUNT_COLUMNS,
+        default=""
+    ), index=usage_df.index)
+    _, roaming_counts = build_cost_cube(service, roaming_band, cost, categories=ROAMING_COUNT_COLUMNS)
+    summary[ROAMING_COUNT_COLUMNS] = roaming_counts.reindex(summary.index, fill_value=0)
+    return summary
+
+
+def summarise_usage_file(usage_csv_path: str, chunksize: Optional[int] = None) -> pd.DataFrame:
+    """
+    Summarise a usage CSV file, optionally streaming it in bounded chunks.
+
+    Each chunk is folded into the running per-Service totals, so peak memory
+    depends on the number of services rather than the number of usage rows.
 
     Args:
-        service_breakdown_path (str): Path to the service breakdown CSV file
         usage_csv_path (str): Path to the usage CSV file
-        client_name (str): Name of the client for the output file
+        chunksize (Optional[int]): Rows per chunk, or None to load the file in one go
 
     Returns:
-        str: Path to the generated report
+        pd.DataFrame: Per-Service summary as produced by summarise_usage
     """
-    new_df = load_service_breakdown(service_breakdown_path)
+    columns = ["Service", "Usage Category", "Cost"]
+    if chunksize is None:
+        return summarise_usage(read_export(usage_csv_path, USAGE_EXPORT, usecols=columns, dtype={"Service": str}))
 
-    for col in BILLING_COLUMNS:
-        new_df[col] = 0  # Default all charge columns to 0
+    summary = None
+    for chunk in read_export(usage_csv_path, USAGE_EXPORT, usecols=columns, dtype={"Service": str}, chunksize=chunksize):
+        chunk_summary = summarise_usage(chunk)
+        summary = chunk_summary if summary is None else summary.add(chunk_summary, fill_value=0).astype(np.int64)
+    return summary if summary is not None else summarise_usage(pd.DataFrame(columns=columns))
 
-    # Load the usage CSV file
-    if os.path.exists(usage_csv_path):
-        usage_df = pd.read_csv(usage_csv_path, dtype={"Service": str})
-        usage_df["Service"] = usage_df["Service"].astype(str).str.strip()
-        usage_df["Usage Category"] = usage_df["Usage Category"].map(CATEGORY_MAPPING).fillna("Other")
-        usage_df["Cost"] = pd.to_numeric(usage_df["Cost"], errors="coerce").fillna(0)
 
-        # Correctly update "No Usage" column
-        new_df["No Usage"] = ~new_df["Number"].isin(usage_df["Service"])
-        new_df["No Usage"] = new_df["No Usage"].replace({True: "X", False: ""})
+def build_billing_report(new_df: pd.DataFrame, usage_summary: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Fill the billing report from the usage summary and format the charges
 
-        # Process category costs and map to correct columns
-        for category in set(CATEGORY_MAPPING.values()):
-            category_costs = usage_df[usage_df["Usage Category"] == category].groupby("Service")["Cost"].sum()
+    Args:
+        new_df (pd.DataFrame): Billing report rows from load_service_breakdown
+        usage_summary (Optional[pd.DataFrame]): Per-service usage summary, or None when there is no usage file
 
-            # Map the costs to the correct column in billing report
-            if category == "Other":
-                new_df["Other Charges"] = new_df["Number"].map(category_costs).fillna(0)
-            else:
-                new_df[category] = new_df["Number"].map(category_costs).fillna(0)
+    Returns:
+        pd.DataFrame: The formatted billing report
+    """
+    new_df = new_df.copy()
 
-        # Count occurrences based on Cost values (Pivot Table Logic)
-        daily_roaming_df = usage_df[usage_df["Usage Category"] == "Daily Rate Roaming"]
+    for col in BILLING_COLUMNS:
+        new_df[col] = 0  # Default all charge columns to 0
 
-        # Count occurrences where Cost == 2 (EU Roaming)
-        eu_roaming_count = daily_roaming_df[daily_roaming_df["Cost"] == 2].groupby("Service").size()
+    if usage_summary is not None:
+        # Correctly update "No Usage" column
+        new_df["No Usage"] = ~new_df["Number"].isin(usage_summary.index)
+        new_df["No Usage"] = new_df["No Usage"].replace({True: "X", False: ""})
 
-        # Count occurrences where Cost == 5 (RoW Roaming)
-        row_roaming_count = daily_roaming_df[daily_roaming_df["Cost"] == 5].groupby("Service").size()
+        # Map the category costs, in pence, to the correct column in billing report
+        for category in USAGE_CATEGORIES:
+            column = "Other Charges" if category == "Other" else category
+            new_df[column] = round_to_pence(new_df["Number"].map(usage_summary[category]).fillna(0).astype(np.int64))
 
         # Map to Billing Report by aligning "Service" in Usage CSV with "Number" in Billing Report
-        new_df["EU Daily Roaming Charges"] = new_df["Number"].map(eu_roaming_count).fillna(0).astype(int)
-        new_df["RoW Daily Roaming Charges"] = new_df["Number"].map(row_roaming_count).fillna(0).astype(int)
+        for col in ROAMING_COUNT_COLUMNS:
+            new_df[col] = new_df["Number"].map(usage_summary[col]).fillna(0).astype(int)
 
     # Calculate Total Charges (EXCLUDES Roaming Counts)
     new_df["Total"] = (
@@ -137,19 +189,53 @@ def process_billing_data(service_breakdown_path: str, usage_csv_path: str, clien
     ]
 
     for col in monetary_columns:
-        new_df[col] = new_df[col].apply(lambda x: f"£{x:,.2f}")
+        new_df[col] = format_pounds(new_df[col], symbol="£", thousands=True)
 
     # Ensure EU & RoW Roaming Charges remain as integers (not currency)
     new_df["EU Daily Roaming Charges"] = new_df["EU Daily Roaming Charges"].astype(int)
     new_df["RoW Daily Roaming Charges"] = new_df["RoW Daily Roaming Charges"].astype(int)
 
+    return new_df
+
+
+def process_billing_data(service_breakdown_path: str, usage_csv_path: str, client_name: str,
+                         chunksize: Optional[int] = None, stage_dir: Optional[str] = None,
+                         output_dir: Optional[str] = None, output: Optional[BinaryIO] = None) -> str:
+    """
+    Process the billing data for Islestar
+
+    Args:
+        service_breakdown_path (str): Path to the service breakdown CSV file
+        usage_csv_path (str): Path to the usage CSV file
+        client_name (str): Name of the client for the output file
+        chunksize (Optional[int]): Stream the usage file in chunks of this many rows
+        stage_dir (Optional[str]): Keep each stage's result here so reruns and
+            interrupted runs skip stages whose inputs haven't changed; None keeps nothing
+        output_dir (Optional[str]): Directory to write the report to; defaults to ~/Downloads
+        output (Optional[BinaryIO]): Write the report to this file object instead of a file;
+            only the report's file name is returned then
+
+    Returns:
+        str: Path to the generated report
+    """
+    pipeline = Pipeline("islestar", stage_dir)
+    new_df = pipeline.stage("load_services", load_service_breakdown, pipeline.source(service_breakdown_path))
+
+    # Load the usage CSV file
+    usage_summary = None
+    if os.path.exists(usage_csv_path):
+        usage_summary = pipeline.stage("usage_summary", partial(summarise_usage_file, chunksize=chunksize),
+                                       pipeline.source(usage_csv_path))
+
+    new_df = pipeline.stage("report", build_billing_report, new_df, usage_summary).value
+
     # Save to Excel in Downloads folder with month_year_Bill_Run format
-    downloads_path = os.path.expanduser("~/Downloads")
+    downloads_path = output_dir or os.path.expanduser("~/Downloads")
     prev_month = (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime('%B')
     current_year = pd.Timestamp.now().year
     output_path = os.path.join(downloads_path, f"{prev_month}_{current_year}_Bill_Run_{client_name}.xlsx")
 
-    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output if output is not None else output_path, engine="openpyxl") as writer:
         new_df.to_excel(writer, index=False, sheet_name="Billing Report")
 
-    return output_path
+    return output_path if output is None else os.path.basename(output_path)
@@ -0,0 +1,10 @@
+"""
+Benchmarks for the report generators.
+
+    python -m benchmarks.run --size 10k --save benchmarks/baseline.json
+    python -m benchmarks.run --size 10k --compare benchmarks/baseline.json
+
+synthetic.py writes realistic Vodafone exports (services breakdown, usage, data
+usage summary, List of Services) of a given size, and run.py runs every
+generator on them, recording wall time, per-stage time and peak memory.
+"""
@@ -0,0 +1,260 @@
+"""
+Run every report generator on the synthetic exports and record how it performs.
+
+    python -m benchmarks.run --size 10k --size 1m --save benchmarks/baseline.json
+    python -m benchmarks.run --size 10k --compare benchmarks/baseline.json
+
+Each generator runs in a fresh worker process (see report_pool), so its peak
+resident memory is its own and nothing is left over from the previous run.
+Stages are not cached (no stage_dir) and ConvaTec's Lists of Services go to a
+reference store in a scratch directory, so every run does the full work and the
+project's own database is untouched. For each generator the wall time, the time
+of each pipeline stage ("other" is the rest, mostly the workbook write) and the
+peak RSS are printed, and can be saved as a JSON baseline or compared with one.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+
+import reference_store
+from pipeline import record_stage_times
+from report_pool import create_report_pool
+from Islestar_report import process_billing_data, USAGE_CHUNK_SIZE
+from tysers_reports import create_tysers_report
+from kf_reports import process_kf_report
+from icr_report import process_icr_report
+import convatecuk_report
+import convatec_ipad_report
+from benchmarks.synthetic import SIZES, generate_exports
+
+# A run this much slower (or bigger) than the baseline counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Tax amounts passed to the Tysers generator (a 20% VAT ratio)
+TYSERS_PRE_TAX_AMOUNT = 1000.0
+TYSERS_TOTAL_TAX_AMOUNT = 200.0
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def timed(stages: List[Dict[str, Any]], name: str, func: Callable, *args: Any, **kwargs: Any) -> Any:
+    """
+    Call 'func', recording its time as a stage (for generators that don't use a Pipeline).
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    stages.append({"pipeline": name, "stage": name, "seconds": time.perf_counter() - start, "reused": False})
+    return result
+
+
+def run_islestar(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    return process_billing_data(files["service_file"], files["usage_file"], "Islestar", chunksize=USAGE_CHUNK_SIZE,
+                                stage_dir=None, output_dir=output_dir)
+
+
+def run_tysers(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    return create_tysers_report(files["service_file"], files["data_usage_file"], files["usage_file"], "Tysers",
+                                pre_tax_amount=TYSERS_PRE_TAX_AMOUNT, total_tax_amount=TYSERS_TOTAL_TAX_AMOUNT,
+                                stage_dir=None, output_dir=output_dir)
+
+
+def run_kf(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    return process_kf_report(files["usage_file"], files["calls_file"], "Knight Frank", stage_dir=None,
+                             output_dir=output_dir)
+
+
+def run_icr(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    return process_icr_report(files["service_file"], files["usage_file"], "Institute of Cancer Research",
+                              streaming=True, stage_dir=None, output_dir=output_dir)
+
+
+def run_convatec_uk(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    combined = timed(stages, "combine", convatecuk_report.process_and_combine_csv,
+                     files["convatec_limited_file"], files["convatec_plc_file"])
+    return timed(stages, "report", convatecuk_report.generate_billing_report, combined,
+                 files["list_of_services_file"], output_dir=output_dir)
+
+
+def run_convatec_ipad(files: Dict[str, str], output_dir: str, stages: List[Dict[str, Any]]) -> str:
+    combined = timed(stages, "combine", convatec_ipad_report.process_and_combine_csv,
+                     files["ipad_project_file"], files["ipad_europe_file"])
+    return timed(stages, "report", convatec_ipad_report.generate_billing_report, combined,
+                 files["ipad_europe_services_file"], files["ipad_uk_services_file"], output_dir=output_dir)
+
+
+# Benchmarked generators, by the name used in results
+GENERATORS = {
+    "islestar": run_islestar,
+    "tysers": run_tysers,
+    "kf": run_kf,
+    "icr": run_icr,
+    "convatec_uk": run_convatec_uk,
+    "convatec_ipad": run_convatec_ipad,
+}
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident memory of this process so far, in MB (None where it can't be read).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_generator(name: str, files: Dict[str, str], work_dir: str) -> Dict[str, Any]:
+    """
+    Worker task: run one generator and return its wall time, stage times and peak RSS.
+    """
+    reference_store.REFERENCE_DB_PATH = os.path.join(work_dir, "reference.sqlite3")
+    output_dir = os.path.join(work_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    with record_stage_times() as stages:
+        output_path = GENERATORS[name](files, output_dir, stages)
+    wall = time.perf_counter() - start
+
+    stage_seconds: Dict[str, float] = {}
+    for stage in stages:
+        stage_seconds[stage["stage"]] = stage_seconds.get(stage["stage"], 0.0) + stage["seconds"]
+    stage_seconds["other"] = max(wall - sum(stage_seconds.values()), 0.0)
+    return {
+        "wall_seconds": round(wall, 3),
+        "stages": {stage: round(seconds, 3) for stage, seconds in stage_seconds.items()},
+        "peak_rss_mb": None if (peak := peak_rss_mb()) is None else round(peak, 1),
+        "report_bytes": os.path.getsize(output_path),
+    }
+
+
+def run_benchmarks(sizes: List[str], generators: List[str], repeat: int = 1,
+                   data_dir: Optional[str] = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Run 'generators' on the synthetic exports of each size, keeping the fastest of
+    'repeat' runs (and the largest peak RSS).
+
+    Returns:
+        Dict[str, Dict[str, Dict[str, Any]]]: Results keyed by size, then generator
+    """
+    results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for size in sizes:
+        files = generate_exports(size, os.path.join(data_dir, size) if data_dir else None)
+        results[size] = {}
+        work_dir = tempfile.mkdtemp(prefix="benchmark-")
+        try:
+            for name in generators:
+                runs = []
+                for _ in range(repeat):
+                    # A new worker per run, so peak RSS is this run's alone
+                    with create_report_pool(1, max_jobs_per_worker=1) as pool:
+                        runs.append(pool.submit(benchmark_generator, name, files, work_dir).result())
+                best = min(runs, key=lambda run: run["wall_seconds"])
+                peaks = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+                best["peak_rss_mb"] = max(peaks) if peaks else None
+                results[size][name] = best
+                print(f"{name} ({size}): {best['wall_seconds']:.2f}s, peak RSS {best['peak_rss_mb']} MB")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_results(path: str, results: Dict[str, Dict[str, Dict[str, Any]]]) -> None:
+    """
+    Write 'results' to the JSON baseline at 'path', replacing the entries they cover
+    and keeping the others (so a baseline can be built one size at a time).
+    """
+    baseline = {"results": {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    baseline.update(environment())
+    for size, generators in results.items():
+        baseline["results"].setdefault(size, {}).update(generators)
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print(f"Saved results to {path}")
+
+
+def compare_results(path: str, results: Dict[str, Dict[str, Dict[str, Any]]],
+                    tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Print each result against the baseline at 'path'.
+
+    Returns:
+        List[str]: The regressions: wall time or peak RSS more than 'tolerance' above the baseline
+    """
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    print(f"\n{'Size':<5} {'Generator':<14} {'Metric':<12} {'Baseline':>10} {'Now':>10} {'Change':>8}")
+    for size, generators in results.items():
+        for name, result in generators.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                print(f"{size:<5} {name:<14} (not in baseline)")
+                continue
+            for metric in ("wall_seconds", "peak_rss_mb"):
+                old, new = before.get(metric), result.get(metric)
+                if not old or new is None:
+                    continue
+                change = new / old - 1
+                flag = " !" if change > tolerance else ""
+                print(f"{size:<5} {name:<14} {metric:<12} {old:>10.2f} {new:>10.2f} {change:>+7.0%}{flag}")
+                if flag:
+                    regressions.append(f"{name} ({size}) {metric}: {old} -> {new}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the report generators on synthetic Vodafone exports")
+    parser.add_argument("--size", action="append", dest="sizes", choices=list(SIZES),
+                        help="Usage rows to generate (may be repeated; default: 10k)")
+    parser.add_argument("--generator", action="append", dest="generators", choices=list(GENERATORS),
+                        help="Only run this generator (may be repeated)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per generator; the fastest is kept")
+    parser.add_argument("--data-dir", help="Where to write the synthetic exports (default: data/benchmarks)")
+    parser.add_argument("--save", metavar="PATH", help="Save the results to this JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results with this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown or memory growth before a result is a regression (default: 0.25)")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    results = run_benchmarks(args.sizes or ["10k"], args.generators or list(GENERATORS), args.repeat, args.data_dir)
+    if args.save:
+        save_results(args.save, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.tolerance)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
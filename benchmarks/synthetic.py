@@ -0,0 +1,333 @@
+"""
+Synthetic Vodafone exports for the benchmarks.
+
+generate_exports writes one set of input files for every client, at a given
+number of usage rows: a services breakdown (and the Knight Frank calls file,
+which is the same export with "Custom 1"), the usage export, the data usage
+summary, and Lists of Services for ConvaTec UK and the ConvaTec iPads. The
+columns, quoting and value formats follow the real exports, usage is skewed
+towards a minority of heavy users, and the mix of usage types and categories
+covers every category the generators map. The files are deterministic for a
+given size and seed and are only written once.
+"""
+import csv
+import json
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from money import format_pounds
+
+# Benchmark sizes, as usage rows
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# Usage rows per service line, and the fewest service lines generated
+ROWS_PER_SERVICE = 200
+MIN_SERVICES = 100
+
+# Usage rows generated and written at a time
+CHUNK_ROWS = 500_000
+
+SEED = 20250101
+BENCHMARK_DATA_DIR = os.path.join("data", "benchmarks")
+MANIFEST_FILE = "manifest.json"
+
+CUSTOMER_CODE = 1004856
+CUSTOMER_NAME = "Synthetic Benchmark Ltd"
+
+# (Usage Type, Usage Category, Bundle Type, share of usage rows, cost)
+# Costs are "free" (in bundle), "metered" (up to £2.50, priced to 1/10p) or
+# "roaming" (a £2 or £5 Daily Rate Roaming charge)
+USAGE_MIX = [
+    ("Data", "Data UK", "Data", 0.40, "free"),
+    ("Data", "Domestic Data", "Data", 0.05, "free"),
+    ("Data", "Data Abroad", "Data", 0.04, "metered"),
+    ("Data", "Voda Red Data Overage", "Data", 0.005, "metered"),
+    ("Event", "Text Msg UK", "Event", 0.11, "free"),
+    ("Event", "MMS", "Event", 0.01, "metered"),
+    ("Event", "UK to Abroad SMS", "Unbundled", 0.01, "metered"),
+    ("Event", "Roam Text MO", "Unbundled", 0.005, "metered"),
+    ("Event", "Roam Text MT", "Unbundled", 0.005, "free"),
+    ("Event", "Premium Text", "Unbundled", 0.002, "metered"),
+    ("Event", "Daily Rate Roaming", "Unbundled", 0.01, "roaming"),
+    ("Voice", "Cross-Net", "Voice", 0.11, "free"),
+    ("Voice", "On-Net", "Voice", 0.07, "free"),
+    ("Voice", "Landline", "Voice", 0.04, "free"),
+    ("Voice", "Freephone", "Unbundled", 0.05, "free"),
+    ("Voice", "Voicemail", "Voice", 0.01, "free"),
+    ("Voice", "UK to Abroad", "Unbundled", 0.02, "metered"),
+    ("Voice", "Roam Call MO", "Unbundled", 0.02, "metered"),
+    ("Voice", "Roam Call MT", "Unbundled", 0.01, "metered"),
+    ("Voice", "Non Geo", "Unbundled", 0.01, "metered"),
+    ("Voice", "Special Numbers", "Unbundled", 0.003, "metered"),
+    ("Voice", "Channel Islands & Isle of Man", "Unbundled", 0.002, "metered"),
+]
+
+# Categories used abroad (other country code, zero-rated VAT)
+ABROAD_CATEGORIES = {
+    "Data Abroad", "Voda Red Data Overage", "Roam Text MO", "Roam Text MT", "Daily Rate Roaming",
+    "Roam Call MO", "Roam Call MT",
+}
+
+FIRST_NAMES = ["Paul", "Andrew", "Holly", "Jon", "Jennifer", "Phil", "Alan", "Zoran", "Sarah", "Priya",
+               "Tom", "Aisha", "Mark", "Claire", "Owen", "Fatima", "Gareth", "Lucy", "Daniel", "Mei"]
+LAST_NAMES = ["Workman", "Tutt", "Merritt", "Wilkinson", "Hodgson", "Baker", "Cumber", "Rankovic", "Patel",
+              "Smith", "Jones", "Khan", "Evans", "Walsh", "Okafor", "Chen", "Murphy", "Hughes", "Reid", "Ali"]
+APNS = ["mobile.o2.co.uk", "wap.o2.co.uk", "idata.o2.co.uk", "RG6701.everywhere", "WAP"]
+COUNTRIES = ["FRA", "ITA", "ESP", "DEU", "USA", "CAN", "CHE", "SGP", "JAM", "BRB"]
+FIXED_CHARGES_PENCE = [418, 1254, 2425, 3504, 9700]
+TARIFFS = ["Tariff for Shared Bundle", "5GB Sharer MBB", "Business Advance", "Red Unlimited"]
+
+SERVICES_BREAKDOWN_COLUMNS = [
+    "Status", "Service", "Name", "Cost Centre", "Service Start Date", "Fixed Charges", "Usage Charges",
+    "Voice Usage", "Data Usage", "Event Usage", "Total", "% of Invoice", "Downloads",
+]
+LIST_OF_SERVICES_COLUMNS = [
+    "CUSTOMER", "CUSTOMER_NAME", "CONTRACT", "CONTRACT_NAME", "SERVICE", "SERVICE_NO", "SERVICE_NAME",
+    "SERVICE_FROM", "SERVICE_TO", "TEMPLATE", "TEMPLATE_NAME", "STATUS_CODE", "NETWORK", "CONTRACT_START_DATE",
+    "UPGRADE_DUE_DATE", "PRODUCT_TYPE", "ADDITIONAL_FIELD_1", "ADDITIONAL_FIELD_2", "ADDITIONAL_FIELD_3",
+    "SUPPLIER_NETWORK",
+]
+
+
+def billing_month() -> pd.Timestamp:
+    """
+    First day of the month being billed (the previous month, as in the reports).
+    """
+    return (pd.Timestamp.now() - pd.DateOffset(months=1)).normalize().replace(day=1)
+
+
+def clock_times(seconds: int) -> np.ndarray:
+    """
+    "HH:MM:SS" for every whole second below 'seconds', indexed by second.
+    """
+    values = np.arange(seconds)
+    return np.array([f"{h:02d}:{m:02d}:{s:02d}" for h, m, s in zip(values // 3600, values // 60 % 60, values % 60)],
+                    dtype=object)
+
+
+def pence_text(pence: np.ndarray) -> pd.Series:
+    """
+    Amounts as the services breakdown writes them, e.g. " 35.04".
+    """
+    return " " + format_pounds(pd.Series(pence, dtype="int64"))
+
+
+def service_lines(count: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    The service lines of the account: number, user, cost centre and charges in pence.
+    """
+    numbers = 7_000_000_000 + rng.choice(999_999_999, size=count, replace=False)
+    names = (np.array(FIRST_NAMES, dtype=object)[rng.integers(len(FIRST_NAMES), size=count)] + " "
+             + np.array(LAST_NAMES, dtype=object)[rng.integers(len(LAST_NAMES), size=count)])
+    cost_centres = np.array([f"D{code:05d}" for code in range(max(count // 20, 5))], dtype=object)
+    # Most lines have a little usage, some a lot
+    usage_pence = np.round(rng.gamma(0.6, 1500, size=count)).astype(np.int64)
+    return pd.DataFrame({
+        "Service": ["0" + str(number) for number in numbers],
+        "Name": names,
+        "Cost Centre": cost_centres[rng.integers(len(cost_centres), size=count)],
+        "Fixed Charges": np.array(FIXED_CHARGES_PENCE)[rng.integers(len(FIXED_CHARGES_PENCE), size=count)],
+        "Usage Charges": usage_pence,
+    })
+
+
+def write_services_breakdown(path: str, lines: pd.DataFrame, rng: np.random.Generator,
+                             cost_centre: Optional[str] = None, custom: bool = False) -> str:
+    """
+    Write a services breakdown for 'lines'. 'cost_centre' replaces every line's cost
+    centre (the ConvaTec exports name the company there); 'custom' adds the
+    "Custom 1" column of the Knight Frank calls export.
+    """
+    lines = lines.reset_index(drop=True)
+    count = len(lines)
+    total = lines["Fixed Charges"] + lines["Usage Charges"]
+    data_mb = rng.gamma(1.0, 2000, size=count)
+    start_days = billing_month() - pd.to_timedelta(rng.integers(30, 2500, size=count), unit="D")
+    df = pd.DataFrame({
+        "Status": "Active",
+        "Service": lines["Service"],
+        "Name": lines["Name"],
+        "Cost Centre": cost_centre or lines["Cost Centre"],
+        "Service Start Date": start_days.strftime("%d-%m-%Y"),
+        "Fixed Charges": pence_text(lines["Fixed Charges"].to_numpy()),
+        "Usage Charges": pence_text(lines["Usage Charges"].to_numpy()),
+        "Voice Usage": [f"{s // 3600}:{s // 60 % 60:02d}:{s % 60:02d}" for s in rng.integers(36_000, size=count)],
+        "Data Usage": np.where(data_mb >= 1024, [f"{mb / 1024:.1f}GB" for mb in data_mb],
+                               [f"{mb:.1f}MB" for mb in data_mb]),
+        "Event Usage": rng.poisson(40, size=count),
+        "Total": pence_text(total.to_numpy()),
+        "% of Invoice": [f"{share:.2f} " for share in 100 * total / max(total.sum(), 1)],
+        "Downloads": "Calls",
+    }, columns=SERVICES_BREAKDOWN_COLUMNS)
+    if custom:
+        df["Custom 1"] = np.arange(1000, 1000 + count)
+    df.to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+    return path
+
+
+def write_usage(path: str, lines: pd.DataFrame, rows: int, rng: np.random.Generator) -> str:
+    """
+    Write a usage export of 'rows' rows for 'lines', CHUNK_ROWS at a time.
+    """
+    types, categories, bundles, shares, costs = (np.array(values, dtype=object) for values in zip(*USAGE_MIX))
+    shares = shares.astype(float) / shares.astype(float).sum()
+    abroad = np.array([category in ABROAD_CATEGORIES for category in categories])
+    # Heavy users: each line's share of the usage rows is log-normal
+    weights = rng.lognormal(0, 1.2, size=len(lines))
+    weights /= weights.sum()
+
+    month = billing_month()
+    days = pd.date_range(month, month + pd.offsets.MonthEnd(0)).strftime("%d-%m-%Y").to_numpy(dtype=object)
+    times = clock_times(86_400)
+    data_kb = np.array([f"{kb:,}" for kb in range(65_536)], dtype=object)
+    # Cost strings by tenth of a penny, as the export writes them (".642", "5", "0")
+    cost_text = np.array([f"{tenths / 1000:.3f}".rstrip("0").rstrip(".").lstrip("0") or "0"
+                          for tenths in range(5001)], dtype=object)
+    numbers = np.array(["07" + str(number) for number in rng.integers(100_000_000, 999_999_999, size=5000)],
+                       dtype=object)
+
+    services = lines["Service"].to_numpy(dtype=object)
+    names = lines["Name"].to_numpy(dtype=object)
+    contracts = lines["Cost Centre"].to_numpy(dtype=object)
+
+    with open(path, "w", newline="") as f:
+        for start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - start)
+            line = rng.choice(len(lines), size=n, p=weights)
+            mix = rng.choice(len(USAGE_MIX), size=n, p=shares)
+            usage_type, cost_kind, is_abroad = types[mix], costs[mix], abroad[mix]
+            is_voice, is_data = usage_type == "Voice", usage_type == "Data"
+
+            tenths = np.where(cost_kind == "metered", rng.integers(5, 2500, size=n), 0)
+            tenths = np.where(cost_kind == "roaming", rng.choice([2000, 5000], size=n), tenths)
+
+            chunk = pd.DataFrame({
+                "CallDate": days[rng.integers(len(days), size=n)],
+                "CallTime": times[rng.integers(len(times), size=n)],
+                "CustomerCode": CUSTOMER_CODE,
+                "CustomerName": CUSTOMER_NAME,
+                "ContractName": contracts[line],
+                "Service": services[line],
+                "UserName": names[line],
+                "DialledNumber": np.where(is_data, np.array(APNS, dtype=object)[rng.integers(len(APNS), size=n)],
+                                          numbers[rng.integers(len(numbers), size=n)]),
+                "Duration": np.where(is_voice, times[rng.integers(1, 3600, size=n)], ""),
+                "Data (KB)": np.where(is_data, data_kb[rng.integers(len(data_kb), size=n)], "0"),
+                "Usage Type": usage_type,
+                "Usage Category": categories[mix],
+                "Bundle Type": bundles[mix],
+                "Cost": cost_text[tenths],
+                "Country Code": np.where(is_abroad, np.array(COUNTRIES, dtype=object)[rng.integers(len(COUNTRIES),
+                                                                                                   size=n)], "GBR"),
+                "Vat Code": np.where(is_abroad, "E", "S"),
+            })
+            chunk.to_csv(f, index=False, header=start == 0, quoting=csv.QUOTE_ALL)
+    return path
+
+
+def write_data_usage_summary(path: str, lines: pd.DataFrame, rng: np.random.Generator) -> str:
+    """
+    Write the data usage summary: GB used per line this month, blank for lines with none.
+    """
+    gb = rng.gamma(0.8, 3, size=len(lines))
+    df = pd.DataFrame({
+        "Username": lines["Name"],
+        "Service": lines["Service"],
+        f"{billing_month():%b %Y} (GB)": np.where(rng.random(len(lines)) < 0.2, "", [f"{value:.2f}" for value in gb]),
+    })
+    df.to_csv(path, index=False)
+    return path
+
+
+def write_list_of_services(path: str, lines: pd.DataFrame, rng: np.random.Generator, customer_name: str,
+                           coverage: float = 0.9) -> str:
+    """
+    Write a List of Services covering a 'coverage' share of 'lines' (the rest show
+    up as unmapped numbers in the reports).
+    """
+    listed = lines[rng.random(len(lines)) < coverage]
+    count = len(listed)
+    service_from = billing_month() - pd.to_timedelta(rng.integers(30, 2500, size=count), unit="D")
+    df = pd.DataFrame({
+        "CUSTOMER": "1001908",
+        "CUSTOMER_NAME": customer_name,
+        "CONTRACT": "100003268",
+        "CONTRACT_NAME": customer_name,
+        "SERVICE": np.arange(1_000_000, 1_000_000 + count).astype(str),
+        "SERVICE_NO": listed["Service"].to_numpy(),
+        "SERVICE_NAME": listed["Name"].to_numpy(),
+        "SERVICE_FROM": service_from.strftime("%Y-%m-%d  00:00:00"),
+        "SERVICE_TO": "",
+        "TEMPLATE": "1007160",
+        "TEMPLATE_NAME": np.array(TARIFFS, dtype=object)[rng.integers(len(TARIFFS), size=count)],
+        "STATUS_CODE": "C",
+        "NETWORK": "Giacom Mobile",
+        "CONTRACT_START_DATE": service_from.strftime("%d/%m/%Y"),
+        "UPGRADE_DUE_DATE": (service_from + pd.DateOffset(years=2)).strftime("%d/%m/%Y"),
+        "PRODUCT_TYPE": "M - Mobile",
+        "ADDITIONAL_FIELD_1": listed["Cost Centre"].to_numpy(),
+        "ADDITIONAL_FIELD_2": "",
+        "ADDITIONAL_FIELD_3": "",
+        "SUPPLIER_NETWORK": "Vodafone",
+    }, columns=LIST_OF_SERVICES_COLUMNS)
+    df.to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+    return path
+
+
+def generate_exports(size: str, directory: Optional[str] = None, seed: int = SEED) -> Dict[str, str]:
+    """
+    Write (or reuse) the synthetic exports for a benchmark size.
+
+    Args:
+        size (str): A key of SIZES
+        directory (Optional[str]): Where to write; defaults to BENCHMARK_DATA_DIR/<size>
+        seed (int): Random seed
+
+    Returns:
+        Dict[str, str]: File paths keyed by upload field name (see report_tasks), plus
+            'calls_file' for the Knight Frank calls export
+    """
+    rows = SIZES[size]
+    directory = directory or os.path.join(BENCHMARK_DATA_DIR, size)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest["rows"], manifest["seed"]) == (rows, seed) and all(map(os.path.exists, manifest["files"].values())):
+            return manifest["files"]
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lines = service_lines(max(MIN_SERVICES, rows // ROWS_PER_SERVICE), rng)
+    half = len(lines) // 2
+    first_half, second_half = lines.iloc[:half], lines.iloc[half:]
+
+    def path(name: str) -> str:
+        return os.path.join(directory, name)
+
+    print(f"Writing {size} synthetic exports ({rows} usage rows, {len(lines)} service lines) to {directory}")
+    files = {
+        "service_file": write_services_breakdown(path("ServicesBreakdown.csv"), lines, rng),
+        "calls_file": write_services_breakdown(path("Calls.csv"), lines, rng, custom=True),
+        "usage_file": write_usage(path("Usage.csv"), lines, rows, rng),
+        "data_usage_file": write_data_usage_summary(path("DataUsageSummary.csv"), lines, rng),
+        "convatec_limited_file": write_services_breakdown(path("ServicesBreakdown_Limited.csv"), first_half, rng,
+                                                          cost_centre="ConvaTec Limited"),
+        "convatec_plc_file": write_services_breakdown(path("ServicesBreakdown_PLC.csv"), second_half, rng,
+                                                      cost_centre="ConvaTec PLC"),
+        "list_of_services_file": write_list_of_services(path("ListOfServices.csv"), lines, rng, "ConvaTec Limited"),
+        "ipad_project_file": write_services_breakdown(path("ServicesBreakdown_iPad_Project.csv"), first_half, rng,
+                                                      cost_centre="ConvaTec iPad Project"),
+        "ipad_europe_file": write_services_breakdown(path("ServicesBreakdown_iPad_Europe.csv"), second_half, rng,
+                                                     cost_centre="ConvaTec iPads Europe"),
+        "ipad_uk_services_file": write_list_of_services(path("ipad_uk_services.csv"), first_half, rng,
+                                                        "ConvaTec iPad Project"),
+        "ipad_europe_services_file": write_list_of_services(path("ipad_europe_services.csv"), second_half, rng,
+                                                            "ConvaTec iPads Europe"),
+    }
+    with open(manifest_path, "w") as f:
+        json.dump({"rows": rows, "seed": seed, "files": files}, f, indent=2)
+    return files
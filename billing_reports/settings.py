@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -127,7 +128,25 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # Temporary file storage
 TEMP_DIR = BASE_DIR / 'temp'
 
+# Uploads are written once, straight into TEMP_DIR, and hashed as they arrive
+FILE_UPLOAD_HANDLERS = ['reports.uploads.HashingUploadHandler']
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Bill-run jobs (see reports/jobs.py and report_pool.py)
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', os.cpu_count() or 2))  # generator processes
+REPORT_WORKER_MAX_JOBS = 20  # jobs a generator process runs before it is replaced
+REPORT_JOB_RETENTION = 24 * 60 * 60  # seconds a finished job stays available for download
+REPORT_WORKSPACE_DIR = TEMP_DIR / 'runs'  # each job's inputs, in a directory of its own
+REPORT_SPOOL_MAX_BYTES = 32 * 1024 * 1024  # reports above this are spilled from memory to the job's workspace
+REPORT_STAGE_DIR = None  # set (e.g. to BASE_DIR / 'data' / 'cache' / 'stages') to keep generator stage results, see pipeline.py
+
+# Sessions only remember each user's last report job, so they are kept in the cache rather than the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+
+# Cache of generated reports keyed by their inputs (see report_cache.py); set the directory to None to disable
+REPORT_CACHE_DIR = BASE_DIR / 'cache' / 'reports'
+REPORT_CACHE_MAX_BYTES = 2 * 1024 ** 3  # least recently used reports are evicted above this
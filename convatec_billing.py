@@ -0,0 +1,161 @@
+"""
+Column-wise helpers shared by the ConvaTec UK and ConvaTec iPad reports.
+
+Both reports are built from the same services breakdown export and List of
+Services layout; they differ only in which List of Services fields they show
+and in their column layout. build_service_lines works out every column either
+report needs, and each report picks and orders its own.
+"""
+import re
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from money import parse_money, to_pounds
+
+# Divisors to convert each data usage unit to GB
+DATA_UNIT_DIVISORS = {"GB": 1, "MB": 1024, "KB": 1024 * 1024}
+
+
+def standardise_phone_numbers(numbers: pd.Series) -> pd.Series:
+    """
+    Keep only the digits of each number.
+    """
+    return numbers.astype(str).str.strip().str.replace(r"[^0-9]", "", regex=True)
+
+
+def clean_user_names(names: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Strip "spare", "was" and dashes from each user name, and flag the spare lines.
+
+    Args:
+        names: Username column
+
+    Returns:
+        Tuple of cleaned names and a boolean Series that is True for spare lines
+    """
+    names = names.astype(str).str.strip()
+    is_spare = names.str.contains(r"\bspare(?:\swas)?\b", case=False, regex=True)
+    clean_names = names.str.replace(r"\b(spare|was|-)+\b", "", case=False, regex=True).str.strip()
+    return clean_names, is_spare
+
+
+def clean_numeric(values: pd.Series) -> pd.Series:
+    """
+    Clean and convert a column of amounts to whole pence, handling commas and spaces.
+    Values that don't parse become 0; missing values stay missing.
+
+    Args:
+        values: Column of amount strings
+
+    Returns:
+        "Int64" Series of pence (see money.py)
+    """
+    return parse_money(values).fillna(0).where(values.notna())
+
+
+def round_2dp(values: pd.Series) -> pd.Series:
+    """
+    Round to 2 decimal places exactly as round(value, 2) does. np.round scales by
+    100 first, which can tip values sitting on a half (e.g. 0.015) the other way,
+    so those few are rounded individually.
+    """
+    rounded = np.round(values, 2)
+    near_half = (np.abs(np.abs(values * 100) % 1 - 0.5) < 1e-6) & values.notna()
+    if near_half.any():
+        rounded[near_half] = values[near_half].map(lambda v: round(v, 2))
+    return rounded
+
+
+def convert_data_usage_column(values: pd.Series) -> pd.Series:
+    """
+    Convert data usage strings to GB.
+
+    Args:
+        values: Data usage strings with unit (e.g., "500 MB", "1.5 GB", "800 KB")
+
+    Returns:
+        Float Series of data usage in GB rounded to 2 decimal places, NaN where conversion fails
+    """
+    parts = values.astype(str).str.extract(r"^(\d+(?:\.\d+)?)\s*(GB|MB|KB)", flags=re.IGNORECASE)
+    divisor = parts[1].str.upper().map(DATA_UNIT_DIVISORS)
+    return round_2dp(parts[0].astype(float) / divisor)
+
+
+def read_service_mappings(services_file: str, fields: Dict[str, Tuple[str, str]]) -> pd.DataFrame:
+    """
+    Parse a List of Services into a lookup table.
+
+    Args:
+        services_file: Path to the List of Services CSV
+        fields: Report field -> (List of Services column, value used when that column is absent)
+
+    Returns:
+        DataFrame indexed by SERVICE_NO with one column per field; where a SERVICE_NO
+        repeats, the last row wins
+    """
+    services_df = pd.read_csv(services_file, dtype=str)
+    services_df.columns = services_df.columns.str.strip()
+
+    if "SERVICE_NO" not in services_df.columns:
+        return pd.DataFrame(columns=list(fields), index=pd.Index([], name="SERVICE_NO"))
+
+    services_df = services_df[services_df["SERVICE_NO"].fillna("") != ""]
+    service_mappings = pd.DataFrame({
+        field: services_df[column] if column in services_df.columns else default
+        for field, (column, default) in fields.items()
+    })
+    service_mappings.index = pd.Index(services_df["SERVICE_NO"], name="SERVICE_NO")
+    return service_mappings[~service_mappings.index.duplicated(keep="last")]
+
+
+def build_service_lines(service_breakdown: pd.DataFrame, service_mappings: pd.DataFrame,
+                        unmapped_service: Dict[str, str]) -> pd.DataFrame:
+    """
+    Work out the report columns for each service line of the combined service breakdown.
+
+    Args:
+        service_breakdown: Combined DataFrame with billing data
+        service_mappings: Lookup table indexed by SERVICE_NO (see read_service_mappings)
+        unmapped_service: Field values for numbers missing from service_mappings
+
+    Returns:
+        DataFrame with Number, User, Spare?, Company, one column per service_mappings
+        field, Line Rental, Out of Bundle spend, Total Spend and Data Used (GB)
+    """
+    service_breakdown = service_breakdown.reset_index(drop=True)
+    number = standardise_phone_numbers(service_breakdown["Service"])
+    user_name, is_spare = clean_user_names(service_breakdown["Name"])
+
+    # Get service details from mapping; unmapped numbers get the defaults
+    service_details = pd.DataFrame({"Number": number}).merge(
+        service_mappings, how="left", left_on="Number", right_index=True, indicator=True
+    )
+    unmapped = (service_details["_merge"] == "left_only").to_numpy()
+    for field, default in unmapped_service.items():
+        service_details.loc[unmapped, field] = default
+
+    # Get line rental and out of bundle spend
+    zeros = pd.Series(0, index=service_breakdown.index, dtype="Int64")
+    line_rental = clean_numeric(service_breakdown["Fixed Charges"]) if "Fixed Charges" in service_breakdown else zeros
+    out_of_bundle = clean_numeric(service_breakdown["Usage Charges"]) if "Usage Charges" in service_breakdown else zeros
+
+    # Convert data usage to GB, keeping the raw value where it doesn't convert
+    raw_usage = service_breakdown["Data Usage"] if "Data Usage" in service_breakdown else pd.Series(0, index=service_breakdown.index)
+    data_usage_gb = convert_data_usage_column(raw_usage)
+    data_used = data_usage_gb.astype(object).where(data_usage_gb.notna(), raw_usage).infer_objects()
+
+    company = service_breakdown["Cost Centre"] if "Cost Centre" in service_breakdown else pd.Series("", index=service_breakdown.index)
+
+    return pd.DataFrame({
+        "Number": number,
+        "User": user_name,
+        "Spare?": np.where(is_spare, "TRUE", ""),
+        "Company": company.str.strip(),
+        **{field: service_details[field].to_numpy() for field in service_mappings.columns},
+        "Line Rental": to_pounds(line_rental),
+        "Out of Bundle spend": to_pounds(out_of_bundle),
+        "Total Spend": to_pounds(line_rental + out_of_bundle),
+        "Data Used (GB)": data_used,
+    })
@@ -0,0 +1,89 @@
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+
+# Integer costs are split into parts below this for an exact float64 bincount
+_SPLIT = 2 ** 26
+
+
+def _bincount_int64(flat: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    """
+    np.bincount of int64 weights, exact in int64.
+    """
+    if len(weights) == 0 or np.abs(weights.astype(np.float64)).sum() < 2 ** 52:
+        # Every partial sum is below 2**53, where float64 holds integers exactly
+        return np.bincount(flat, weights=weights, minlength=size).astype(np.int64)
+    # low parts are in [0, 2**26), so their sums are exact below 2**27 rows;
+    # high parts are at most 2**37 and sum exactly for any realistic total
+    high, low = np.divmod(weights, _SPLIT)
+    high_sums = np.bincount(flat, weights=high, minlength=size).astype(np.int64)
+    low_sums = np.bincount(flat, weights=low, minlength=size).astype(np.int64)
+    return high_sums * _SPLIT + low_sums
+
+
+def build_cost_cube(service: pd.Series, category: pd.Series, cost: pd.Series,
+                    categories: Optional[List[str]] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Build the dense Service x Category cost and count matrices in a single pass.
+
+    Service and category are factorized into integer codes and every usage row
+    is scattered into a flat (service, category) bucket with np.bincount, so the
+    usage rows are scanned once however many categories there are. Rows whose
+    category is missing (or not in `categories`) or whose service is missing are
+    ignored, matching a pandas groupby on the same keys.
+
+    An integer cost (e.g. fixed-point money, see money.py) is summed exactly:
+    bincount adds in float64, which is exact for integers while every partial
+    sum stays below 2**53, so when the costs could exceed that they are split
+    into high and low 2**26 parts that are summed separately and recombined in
+    int64. A float cost is summed in plain float64, not with the compensated
+    summation a groupby uses, so sums can differ from groupby's in the last bits
+    and, once rounded, by a penny; pass money in integer units where the totals
+    must match exactly.
+
+    Args:
+        service (pd.Series): Service number of each usage row
+        category (pd.Series): Mapped category of each usage row
+        cost (pd.Series): Numeric cost of each usage row
+        categories (Optional[List[str]]): Fixed column order; defaults to the
+            sorted categories that occur in the data
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Summed cost and row count, indexed by
+            Service with one column per category
+    """
+    if categories is None:
+        category_codes, category_index = pd.factorize(category, sort=True)
+    else:
+        category_index = pd.Index(categories)
+        category_codes = category_index.get_indexer(category)
+
+    valid = category_codes >= 0
+    service_codes, service_index = pd.factorize(np.asarray(service)[valid], sort=True)
+    category_codes = category_codes[valid]
+    integer_cost = pd.api.types.is_integer_dtype(cost)
+    if integer_cost:
+        weights = pd.Series(cost).to_numpy(dtype=np.int64, na_value=0)[valid]
+    else:
+        weights = np.asarray(cost, dtype=np.float64)[valid]
+
+    known = service_codes >= 0
+    service_codes, category_codes, weights = service_codes[known], category_codes[known], weights[known]
+
+    n_services, n_categories = len(service_index), len(category_index)
+    flat = service_codes * n_categories + category_codes
+    size = n_services * n_categories
+    if integer_cost:
+        cost_matrix = _bincount_int64(flat, weights, size)
+    else:
+        cost_matrix = np.bincount(flat, weights=weights, minlength=size)
+    cost_matrix = cost_matrix.reshape(n_services, n_categories)
+    count_matrix = np.bincount(flat, minlength=size).reshape(n_services, n_categories)
+
+    index = pd.Index(service_index, name="Service")
+    columns = pd.Index(category_index, name="Category")
+    return (
+        pd.DataFrame(cost_matrix, index=index, columns=columns),
+        pd.DataFrame(count_matrix, index=index, columns=columns),
+    )
@@ -1,8 +1,24 @@
 import os
-import time
+import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from typing import BinaryIO, Optional
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment, NamedStyle
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.hyperlink import Hyperlink
+
+from money import USAGE_UNITS, parse_money, round_to_pence, to_pounds
+from pipeline import Pipeline
+from vodafone_exports import USAGE_EXPORT, read_export
+from workbook_assembler import WorkbookAssembler
+
+# Named style shared by every header row in a streaming workbook
+HEADER_STYLE_NAME = "ICR Header"
+
+# Sheets written by the drill-down layout
+CONTENTS_SHEET_NAME = "Contents"
+DETAIL_SHEET_NAME = "Usage Detail"
 
 def sanitize_sheet_name(name):
     # Remove invalid characters and truncate to a maximum of 31 characters
@@ -11,6 +27,25 @@ def sanitize_sheet_name(name):
         name = name.replace(ch, '')
     return name[:31]
 
+def partition_usage(usage_df, keys):
+    """
+    Sort the usage rows once by 'keys' and locate each group as a row range.
+
+    Groups are numbered in order of first appearance and a stable sort keeps the
+    original row order inside each group, so every group is the contiguous slice
+    sorted_df.iloc[start:stop]. Blank keys form their own group.
+
+    Returns the sorted DataFrame and a list of (key tuple, start, stop) in group order.
+    """
+    grouper = usage_df.groupby(keys, sort=False, dropna=False, observed=True)
+    codes = grouper.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=grouper.ngroups))])
+    sorted_df = usage_df.iloc[order]
+    group_keys = sorted_df[keys].iloc[bounds[:-1]].itertuples(index=False, name=None)
+    groups = [(key, bounds[i], bounds[i + 1]) for i, key in enumerate(group_keys)]
+    return sorted_df, groups
+
 def write_dataframe_to_sheet(ws, df, header):
     """
     Writes the DataFrame 'df' into worksheet 'ws' starting at row 2,
@@ -49,30 +84,169 @@ def auto_adjust_column_widths(ws):
                 max_length = max(max_length, len(str(cell.value)))
         ws.column_dimensions[column].width = max_length + 2
 
-def process_icr_report(services_file: str, usage_file: str, client_name: str) -> str:
+def register_header_style(wb):
     """
-    Process ICR report from usage and services CSV files.
-    
-    Args:
-        services_file (str): Path to the services breakdown CSV file
-        usage_file (str): Path to the usage CSV file
-        client_name (str): Name of the client for the output file
-        
-    Returns:
-        str: Path to the generated report
+    Register the header style (same look as apply_header_formatting) once on the
+    workbook, so every sheet refers to the one shared style. Returns its name.
+    """
+    if HEADER_STYLE_NAME not in wb.named_styles:
+        header_style = NamedStyle(name=HEADER_STYLE_NAME)
+        header_style.fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
+        header_style.font = Font(color="FFFFFF", bold=True)
+        thin = Side(style='thin')
+        header_style.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        header_style.alignment = Alignment(horizontal="center", vertical="center")
+        wb.add_named_style(header_style)
+    return HEADER_STYLE_NAME
+
+def compute_column_widths(df, header):
+    """
+    Column widths matching auto_adjust_column_widths, computed from vectorised
+    string lengths of the DataFrame instead of walking the written cells.
+    Empty values (None, "", 0) do not count towards the width.
+    """
+    widths = []
+    for col_num, col_name in enumerate(header):
+        column = df.iloc[:, col_num]
+        lengths = column.astype(str).str.len().where(~column.isin([0, ""]), 0)
+        max_length = max(len(str(col_name)) if col_name else 0, int(lengths.max()) if len(lengths) else 0)
+        widths.append(max_length + 2)
+    return widths
+
+def write_streaming_sheet(wb, sheet_name, df, header, autofilter=False):
+    """
+    Add a sheet to a write-only workbook: column widths are set up front, then the
+    styled header and the DataFrame rows are appended in one pass. With df=None
+    only a plain header row is written. With autofilter=True the header row is
+    frozen and given filter buttons over the written rows.
+    """
+    ws = wb.create_sheet(sheet_name)
+    if df is None:
+        ws.append(header)
+        return ws
+
+    if autofilter:
+        ws.auto_filter.ref = f"A1:{get_column_letter(len(header))}{len(df) + 1}"
+        ws.freeze_panes = "A2"
+    for col_num, width in enumerate(compute_column_widths(df, header), start=1):
+        ws.column_dimensions[get_column_letter(col_num)].width = width
+
+    style_name = register_header_style(wb)
+    header_cells = []
+    for col_name in header:
+        cell = WriteOnlyCell(ws, value=col_name)
+        cell.style = style_name
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    for row in df.itertuples(index=False):
+        ws.append(row)
+    return ws
+
+def write_formatted_sheet(wb, sheet_name, df, header):
+    """
+    Add a sheet to a regular workbook cell by cell, then format its header and
+    column widths. With df=None only a plain header row is written.
+    """
+    ws = wb.create_sheet(sheet_name)
+    for col_num, col_name in enumerate(header, start=1):
+        ws.cell(row=1, column=col_num, value=col_name)
+    if df is None:
+        return ws
+
+    write_dataframe_to_sheet(ws, df, header)
+    apply_header_formatting(ws, len(header))
+    auto_adjust_column_widths(ws)
+    return ws
+
+def write_assembled_sheet(wb, sheet_name, df, header):
+    """
+    Queue a sheet on a WorkbookAssembler, to be rendered in a worker process
+    when the workbook is saved. With df=None only a plain header row is written.
+    """
+    if df is None:
+        return wb.add_sheet(sheet_name, None, header, header_styled=False)
+    return wb.add_sheet(sheet_name, df, header, widths=compute_column_widths(df, header))
+
+def write_drilldown_sheets(wb, sorted_usage, sheet_groups, header):
+    """
+    Write the qualifying usage once, in report order, to a filterable "Usage Detail"
+    sheet, and index it from a "Contents" sheet with one row per Service/User giving
+    its row count, Cost subtotal and a hyperlink to its row range.
+
+    'sheet_groups' is a list of (service, user, start, stop) ranges of 'sorted_usage'.
+    Both sheets are added to the write-only workbook 'wb'.
+    """
+    starts = np.array([start for _, _, start, _ in sheet_groups], dtype=int)
+    stops = np.array([stop for _, _, _, stop in sheet_groups], dtype=int)
+    lengths = stops - starts
+    positions = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)]) \
+        if sheet_groups else np.array([], dtype=int)
+    detail = sorted_usage.iloc[positions]
+
+    # Sheet rows of each group in the detail sheet (row 1 is the header)
+    first_rows = 2 + np.concatenate([[0], np.cumsum(lengths)[:-1]]) if sheet_groups else starts
+    last_rows = first_rows + lengths - 1
+
+    if 'Cost' in detail.columns and sheet_groups:
+        costs = parse_money(detail['Cost'], USAGE_UNITS).fillna(0).to_numpy(dtype=np.int64)
+        subtotals = to_pounds(pd.Series(round_to_pence(np.add.reduceat(costs, first_rows - 2))))
+    else:
+        subtotals = np.full(len(sheet_groups), np.nan)
+
+    last_col = get_column_letter(len(header))
+    contents = pd.DataFrame({
+        "Service": [service for service, _, _, _ in sheet_groups],
+        "UserName": [user for _, user, _, _ in sheet_groups],
+        "Rows": lengths,
+        "Subtotal": subtotals,
+        "Detail": [f"Rows {first}-{last}" for first, last in zip(first_rows, last_rows)],
+    })
+    contents_header = list(contents.columns)
+
+    style_name = register_header_style(wb)
+    toc = wb.create_sheet(CONTENTS_SHEET_NAME)
+    for col_num, width in enumerate(compute_column_widths(contents, contents_header), start=1):
+        toc.column_dimensions[get_column_letter(col_num)].width = width
+    header_cells = []
+    for col_name in contents_header:
+        cell = WriteOnlyCell(toc, value=col_name)
+        cell.style = style_name
+        header_cells.append(cell)
+    toc.append(header_cells)
+    for row_num, row in enumerate(contents.itertuples(index=False), start=2):
+        *values, label = row
+        link = WriteOnlyCell(toc, value=label)
+        link.hyperlink = Hyperlink(
+            ref=f"{get_column_letter(len(contents_header))}{row_num}",
+            location=f"'{DETAIL_SHEET_NAME}'!A{first_rows[row_num - 2]}:{last_col}{last_rows[row_num - 2]}",
+            display=label
+        )
+        link.style = "Hyperlink"
+        toc.append(values + [link])
+    print(f"Created sheet '{CONTENTS_SHEET_NAME}' with {len(contents)} Service/User entries.")
+
+    write_streaming_sheet(wb, DETAIL_SHEET_NAME, detail, header, autofilter=True)
+    print(f"Created sheet '{DETAIL_SHEET_NAME}' with {len(detail)} rows.")
+
+def load_usage(usage_file: str) -> pd.DataFrame:
+    """
+    Load the usage CSV file, with repeated text held as categoricals (see vodafone_exports).
     """
-    # Create a new workbook
-    from openpyxl import Workbook
-    wb = Workbook()
-    
-    # Load CSV files into DataFrames
     try:
-        usage_df = pd.read_csv(usage_file)
+        usage_df = read_export(usage_file, USAGE_EXPORT)
         print(f"Loaded usage data: {usage_file} (rows: {len(usage_df)})")
     except Exception as e:
         print(f"Error loading usage file: {e}")
         raise Exception(f"Failed to load usage file: {e}")
-    
+    return usage_df
+
+
+def load_qualifying_services(services_file: str) -> pd.DataFrame:
+    """
+    Load the services breakdown and keep the rows whose Usage Charges are above £5.00.
+    The charges column is returned as float under the name 'usage charges'.
+    """
     try:
         services_df = pd.read_csv(services_file)
         print(f"Loaded services breakdown: {services_file} (rows: {len(services_df)})")
@@ -93,76 +267,129 @@ def process_icr_report(services_file: str, usage_file: str, client_name: str) ->
     # Filter for rows where Usage Charges are above £5.00
     filtered_services = services_df[services_df['usage charges'] > 5.00]
     print(f"Found {len(filtered_services)} rows in services breakdown with Usage Charges above £5.00.")
+    return filtered_services
+
+
+def process_icr_report(services_file: str, usage_file: str, client_name: str, streaming: bool = False,
+                       processes: Optional[int] = None, drilldown: bool = False,
+                       stage_dir: Optional[str] = None, output_dir: Optional[str] = None,
+                       output: Optional[BinaryIO] = None) -> str:
+    """
+    Process ICR report from usage and services CSV files.
+    
+    Args:
+        services_file (str): Path to the services breakdown CSV file
+        usage_file (str): Path to the usage CSV file
+        client_name (str): Name of the client for the output file
+        streaming (bool): Build the workbook with write-only sheets that rows are
+            appended to in bulk, keeping memory flat as the sheet count grows
+        processes (Optional[int]): Render the sheets in parallel on this many worker
+            processes and assemble them into one workbook (takes precedence over streaming)
+        drilldown (bool): Instead of one sheet per Service/User, write the qualifying usage
+            to a single sorted detail sheet with a hyperlinked contents sheet
+        stage_dir (Optional[str]): Keep the loaded inputs here so a rerun or an interrupted
+            write skips parsing them again; None keeps nothing
+        output_dir (Optional[str]): Directory to write the report to; defaults to ~/Downloads
+        output (Optional[BinaryIO]): Write the report to this file object instead of a file;
+            only the report's file name is returned then
+        
+    Returns:
+        str: Path to the generated report
+    """
+    # Create a new workbook
+    if drilldown:
+        wb = Workbook(write_only=True)
+        write_sheet = write_streaming_sheet
+    elif processes:
+        wb = WorkbookAssembler(processes)
+        write_sheet = write_assembled_sheet
+    else:
+        wb = Workbook(write_only=streaming)
+        write_sheet = write_streaming_sheet if streaming else write_formatted_sheet
+    
+    # Load CSV files into DataFrames
+    pipeline = Pipeline("icr", stage_dir)
+    usage_df = pipeline.stage("load_usage", load_usage, pipeline.source(usage_file)).value
+    filtered_services = pipeline.stage("qualifying_services", load_qualifying_services,
+                                       pipeline.source(services_file)).value
 
     # Create the main sheet "ICR Bill Summary"
     if "Sheet" in wb.sheetnames:
         wb.remove(wb["Sheet"])  # Remove default sheet
-    main_sheet = wb.create_sheet("ICR Bill Summary")
     print("Using sheet 'ICR Bill Summary' for usage data.")
 
     # Use columns from the usage file as header
     header = list(usage_df.columns)
-    for col_num, col_name in enumerate(header, start=1):
-        main_sheet.cell(row=1, column=col_num, value=col_name)
 
     # Write the entire usage data to the "ICR Bill Summary" sheet (starting at row 2)
-    write_dataframe_to_sheet(main_sheet, usage_df, header)
-    # Apply header formatting and auto-adjust column widths on the main sheet
-    apply_header_formatting(main_sheet, len(header))
-    auto_adjust_column_widths(main_sheet)
+    # with header formatting and auto-adjusted column widths
+    write_sheet(wb, "ICR Bill Summary", usage_df, header)
     print("Wrote usage data into 'ICR Bill Summary' sheet with formatting.")
 
     # Create new sheets for each qualifying service from the services breakdown.
     if 'Service' in filtered_services.columns:
+        # Sort the usage once by Service (and UserName, if present) so every
+        # sheet below is a contiguous slice instead of a fresh scan of all rows.
+        by_user = 'UserName' in usage_df.columns
+        sorted_usage, groups = partition_usage(usage_df, ['Service', 'UserName'] if by_user else ['Service'])
+        service_groups = {}
+        for key, start, stop in groups:
+            service, user = key if by_user else (key[0], None)
+            service_groups.setdefault(service, []).append((user, start, stop))
+
         unique_services = filtered_services['Service'].unique()
-        for service in unique_services:
-            # Filter usage data for the current service
-            service_usage = usage_df[usage_df['Service'] == service]
-            if service_usage.empty:
-                print(f"No usage records found for Service: {service}")
-                continue
-            
-            # If the usage data has a UserName column, create separate sheets per user
-            if 'UserName' in usage_df.columns:
-                unique_users = service_usage['UserName'].unique()
-                for user in unique_users:
-                    sheet_name = sanitize_sheet_name(f"{service} - {user}")
-                    new_sheet = wb.create_sheet(sheet_name)
-                    # Write header row in the new sheet
-                    for col_num, col_name in enumerate(header, start=1):
-                        new_sheet.cell(row=1, column=col_num, value=col_name)
-                    # Filter usage data for both the service and the user
-                    filtered_usage = service_usage[service_usage['UserName'] == user]
-                    if filtered_usage.empty:
+        if drilldown:
+            # All qualifying usage goes once into one detail sheet, indexed by a contents sheet
+            sheet_groups = []
+            for service in unique_services:
+                if service not in service_groups:
+                    print(f"No usage records found for Service: {service}")
+                    continue
+                for user, start, stop in service_groups[service]:
+                    # As in the per-user sheets, rows with a blank UserName are left out
+                    if by_user and pd.isna(user):
                         print(f"No usage records for Service: {service} and User: {user}")
                         continue
-                    write_dataframe_to_sheet(new_sheet, filtered_usage, header)
-                    apply_header_formatting(new_sheet, len(header))
-                    auto_adjust_column_widths(new_sheet)
-                    print(f"Created sheet '{sheet_name}' with {len(filtered_usage)} rows and formatted header.")
-            else:
-                # If no UserName column exists, create one sheet per service.
-                sheet_name = sanitize_sheet_name(service)
-                new_sheet = wb.create_sheet(sheet_name)
-                for col_num, col_name in enumerate(header, start=1):
-                    new_sheet.cell(row=1, column=col_num, value=col_name)
-                write_dataframe_to_sheet(new_sheet, service_usage, header)
-                apply_header_formatting(new_sheet, len(header))
-                auto_adjust_column_widths(new_sheet)
-                print(f"Created sheet '{sheet_name}' with {len(service_usage)} rows and formatted header.")
+                    sheet_groups.append((service, user, start, stop))
+            write_drilldown_sheets(wb, sorted_usage, sheet_groups, header)
+        else:
+            for service in unique_services:
+                if service not in service_groups:
+                    print(f"No usage records found for Service: {service}")
+                    continue
+            
+                # If the usage data has a UserName column, create separate sheets per user
+                if by_user:
+                    for user, start, stop in service_groups[service]:
+                        sheet_name = sanitize_sheet_name(f"{service} - {user}")
+                        # Rows with a blank UserName never match a user, so their sheet keeps just the header
+                        if pd.isna(user):
+                            write_sheet(wb, sheet_name, None, header)
+                            print(f"No usage records for Service: {service} and User: {user}")
+                            continue
+                        filtered_usage = sorted_usage.iloc[start:stop]
+                        write_sheet(wb, sheet_name, filtered_usage, header)
+                        print(f"Created sheet '{sheet_name}' with {len(filtered_usage)} rows and formatted header.")
+                else:
+                    # If no UserName column exists, create one sheet per service.
+                    _, start, stop = service_groups[service][0]
+                    service_usage = sorted_usage.iloc[start:stop]
+                    sheet_name = sanitize_sheet_name(service)
+                    write_sheet(wb, sheet_name, service_usage, header)
+                    print(f"Created sheet '{sheet_name}' with {len(service_usage)} rows and formatted header.")
     else:
         print("Skipping additional sheets; 'Service' column not found in the services breakdown file.")
 
     # Save to Excel in Downloads folder with month_year_Bill_Run format
-    downloads_path = os.path.expanduser("~/Downloads")
+    downloads_path = output_dir or os.path.expanduser("~/Downloads")
     prev_month = (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime('%B')
     current_year = pd.Timestamp.now().year
     output_path = os.path.join(downloads_path, f"{prev_month}_{current_year}_Bill_Run_{client_name}.xlsx")
     try:
-        wb.save(output_path)
-        print(f"ICR report saved to: {output_path}")
+        wb.save(output if output is not None else output_path)
+        print(f"ICR report saved to: {output_path if output is None else 'output buffer'}")
     except Exception as e:
         print(f"Error saving ICR report: {e}")
         raise e
 
-    return output_path
+    return output_path if output is None else os.path.basename(output_path)
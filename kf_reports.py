@@ -1,32 +1,127 @@
 import os
-import time
 import pandas as pd
+from typing import BinaryIO, Optional, Union
 
-def process_kf_report(usage_file: str, calls_file: str, client_name: str) -> str:
+from pipeline import Pipeline
+from vodafone_exports import USAGE_EXPORT, concat_chunks, read_export
+from workbook_assembler import WorkbookAssembler
+
+# Define the desired column headers for the final output
+DESIRED_COLUMNS = [
+    "CallDate", "CallTime", "CustomerCode", "CustomerName", "ContractName",
+    "Custom 1", "Service", "UserName", "DialledNumber", "Duration",
+    "Data (KB)", "Usage Type", "Usage Category", "Bundle Type", "Cost",
+    "Country Code", "Vat Code"
+]
+
+# Excel's maximum number of rows per sheet, including the header row
+EXCEL_MAX_ROWS = 1_048_576
+
+# Supported output formats for the call detail
+OUTPUT_FORMATS = ("xlsx", "csv.gz")
+
+# Rows per chunk when streaming the usage CSV
+USAGE_CHUNK_SIZE = 250_000
+
+def read_voice_usage(usage_file: str, lookup_dict: dict, chunksize: int = USAGE_CHUNK_SIZE) -> pd.DataFrame:
     """
-    Process Knight Frank report from usage and calls CSV files.
-    
+    Stream the usage CSV and return only its Voice rows, in the desired column order.
+
+    Only the desired columns are parsed, with the compact dtypes of USAGE_EXPORT, and each
+    chunk is filtered to "Usage Type" == "Voice" before the "Custom 1" lookup and
+    "DialledNumber" conversion are applied, so memory is bounded by the Voice subset rather
+    than by the whole file.
+
     Args:
         usage_file (str): Path to the usage CSV file
-        calls_file (str): Path to the calls CSV file
-        client_name (str): Name of the client for the output file
-        
+        lookup_dict (dict): Mapping of "Service" to its "Custom 1" value
+        chunksize (int): Number of usage rows to parse at a time
+
     Returns:
-        str: Path to the generated report
+        pd.DataFrame: Voice usage rows with the columns in DESIRED_COLUMNS
     """
-    # Define the desired column headers for the final output
-    desired_columns = [
-        "CallDate", "CallTime", "CustomerCode", "CustomerName", "ContractName",
-        "Custom 1", "Service", "UserName", "DialledNumber", "Duration",
-        "Data (KB)", "Usage Type", "Usage Category", "Bundle Type", "Cost",
-        "Country Code", "Vat Code"
-    ]
-
-    # Load the usage CSV data into a DataFrame
-    print("Reading usage CSV file...")
-    df = pd.read_csv(usage_file)
-    print("Usage CSV loaded. Rows:", len(df))
+    # "Custom 1" is always replaced by the lookup, so it is never read from the usage file
+    read_columns = set(DESIRED_COLUMNS) - {"Custom 1"}
+
+    voice_chunks = []
+    total_rows = 0
+    for chunk in read_export(usage_file, USAGE_EXPORT, usecols=lambda col: col in read_columns, chunksize=chunksize):
+        total_rows += len(chunk)
+
+        # Reorder (or select) the columns to match the desired order.
+        # Any desired column missing from the file is added empty.
+        chunk = chunk.reindex(columns=DESIRED_COLUMNS)
+
+        # Filter to only include rows where "Usage Type" is "Voice"
+        chunk = chunk[chunk["Usage Type"] == "Voice"].copy()
+
+        # Update the "Custom 1" column using the lookup dictionary.
+        # This mimics an Excel XLOOKUP based on the "Service" column.
+        # Any non-convertible value will be set as NaN.
+        chunk["Custom 1"] = pd.to_numeric(chunk["Service"].map(lookup_dict), errors="coerce")
+
+        # Ensure the "DialledNumber" column is numeric with no decimals
+        # Using Int64 to handle larger numbers
+        chunk["DialledNumber"] = pd.to_numeric(chunk["DialledNumber"], errors="coerce").fillna(0).astype('Int64')
+
+        voice_chunks.append(chunk)
+
+    print(f"Usage CSV streamed. Rows: {total_rows}, 'Voice' rows kept: {sum(len(c) for c in voice_chunks)}")
+    if not voice_chunks:
+        return pd.DataFrame(columns=DESIRED_COLUMNS)
+    return concat_chunks(voice_chunks)
+
+def write_kf_workbook(df: pd.DataFrame, output_path: Union[str, BinaryIO], sheet_name: str = "KF Report",
+                      max_rows: int = EXCEL_MAX_ROWS, processes: Optional[int] = None) -> None:
+    """
+    Write the call detail to an Excel workbook, starting a new sheet each time one fills.
+
+    Sheets are named "KF Report", "KF Report (2)", "KF Report (3)" and so on. The
+    "DialledNumber" number format is set once per sheet on the whole column rather
+    than on every cell.
+
+    Args:
+        df (pd.DataFrame): Call detail in DESIRED_COLUMNS order
+        output_path (Union[str, BinaryIO]): Path of the workbook to create, or a binary file object
+        sheet_name (str): Name of the first sheet
+        max_rows (int): Row limit of a sheet, including its header row
+        processes (Optional[int]): Render the sheets in parallel on this many worker processes
+    """
+    rows_per_sheet = max_rows - 1
+    if processes:
+        # Each full sheet is rendered by its own worker and stitched into one workbook
+        assembler = WorkbookAssembler(processes)
+        for shard, start in enumerate(range(0, max(len(df), 1), rows_per_sheet), start=1):
+            shard_name = sheet_name if shard == 1 else f"{sheet_name} ({shard})"
+            assembler.add_sheet(shard_name, df.iloc[start:start + rows_per_sheet], DESIRED_COLUMNS,
+                                header_styled=False, number_formats={DESIRED_COLUMNS.index("DialledNumber"): "0"})
+        assembler.save(output_path)
+        return
+
+    dialled_number_col_idx = DESIRED_COLUMNS.index("DialledNumber")  # xlsxwriter columns are 0-indexed
 
+    with pd.ExcelWriter(output_path, engine="xlsxwriter") as writer:
+        # '0' is the format code for Number with no decimal places
+        number_format = writer.book.add_format({"num_format": "0"})
+
+        for shard, start in enumerate(range(0, max(len(df), 1), rows_per_sheet), start=1):
+            shard_name = sheet_name if shard == 1 else f"{sheet_name} ({shard})"
+            shard_df = df.iloc[start:start + rows_per_sheet]
+            shard_df.to_excel(writer, index=False, sheet_name=shard_name)
+            writer.sheets[shard_name].set_column(dialled_number_col_idx, dialled_number_col_idx, None, number_format)
+            print(f"Wrote {len(shard_df)} rows to sheet '{shard_name}'")
+
+def load_voice_report(usage_file: str, calls_file: str) -> pd.DataFrame:
+    """
+    Build the report rows: the Voice rows of the usage file with "Custom 1" looked up from the calls file.
+
+    Args:
+        usage_file (str): Path to the usage CSV file
+        calls_file (str): Path to the calls CSV file
+
+    Returns:
+        pd.DataFrame: Report rows in DESIRED_COLUMNS order
+    """
     # Load the calls CSV data (for lookup)
     print("Reading calls CSV file for lookup...")
     calls_df = pd.read_csv(calls_file)
@@ -36,52 +131,49 @@ def process_kf_report(usage_file: str, calls_file: str, client_name: str) -> str
     # Map the "Service" column to its corresponding "Custom 1" value
     lookup_dict = calls_df.set_index("Service")["Custom 1"].to_dict()
 
-    # Update the "Custom 1" column in the usage DataFrame using the lookup dictionary.
-    # This mimics an Excel XLOOKUP based on the "Service" column.
-    print("Performing lookup for 'Custom 1' values...")
-    df["Custom 1"] = df["Service"].map(lookup_dict)
-
-    # Convert the looked-up "Custom 1" values to numeric format.
-    # Any non-convertible value will be set as NaN.
-    df["Custom 1"] = pd.to_numeric(df["Custom 1"], errors="coerce")
-    print("'Custom 1' column updated and converted to numeric.")
-
-    # Ensure the "DialledNumber" column is numeric with no decimals
-    print("Converting 'DialledNumber' column to numeric (no decimals)...")
-    # Convert to numeric, coercing errors to NaN, then fill NaN with 0
-    df["DialledNumber"] = pd.to_numeric(df["DialledNumber"], errors="coerce").fillna(0)
-    # Convert to integer to remove decimal places
-    df["DialledNumber"] = df["DialledNumber"].astype('Int64')  # Using Int64 to handle larger numbers
-
-    # Reorder (or select) the DataFrame columns to match the desired order.
-    # Any extra columns not in desired_columns will be dropped.
-    print("Reordering columns to match desired order...")
-    df = df.reindex(columns=desired_columns)
-
-    # Filter to only include rows where "Usage Type" is "Voice"
-    print(f"Filtering data to only include 'Voice' usage type. Before filtering: {len(df)} rows")
-    df = df[df["Usage Type"] == "Voice"]
-    print(f"After filtering: {len(df)} rows")
-
-    # Write the DataFrame to an Excel file in Downloads folder with month_year_Bill_Run format
-    downloads_path = os.path.expanduser("~/Downloads")
+    # Stream the usage CSV, keeping only the Voice rows
+    print("Reading usage CSV file (Voice rows only)...")
+    return read_voice_usage(usage_file, lookup_dict)
+
+def process_kf_report(usage_file: str, calls_file: str, client_name: str, output_format: str = "xlsx",
+                      processes: Optional[int] = None, stage_dir: Optional[str] = None,
+                      output_dir: Optional[str] = None, output: Optional[BinaryIO] = None) -> str:
+    """
+    Process Knight Frank report from usage and calls CSV files.
+    
+    Args:
+        usage_file (str): Path to the usage CSV file
+        calls_file (str): Path to the calls CSV file
+        client_name (str): Name of the client for the output file
+        output_format (str): "xlsx" for a workbook, or "csv.gz" for a gzip-compressed CSV
+        processes (Optional[int]): Render workbook sheets in parallel on this many worker processes
+        stage_dir (Optional[str]): Keep the report rows here so a rerun or an interrupted
+            write skips reading the inputs again; None keeps nothing
+        output_dir (Optional[str]): Directory to write the report to; defaults to ~/Downloads
+        output (Optional[BinaryIO]): Write the report to this file object instead of a file;
+            only the report's file name is returned then
+        
+    Returns:
+        str: Path to the generated report
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+    pipeline = Pipeline("kf", stage_dir)
+    df = pipeline.stage("voice_report", load_voice_report,
+                        pipeline.source(usage_file), pipeline.source(calls_file)).value
+
+    # Write the report to the Downloads folder with month_year_Bill_Run format
+    downloads_path = output_dir or os.path.expanduser("~/Downloads")
     prev_month = (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime('%B')
     current_year = pd.Timestamp.now().year
-    output_path = os.path.join(downloads_path, f"{prev_month}_{current_year}_Bill_Run_{client_name}.xlsx")
+    output_path = os.path.join(downloads_path, f"{prev_month}_{current_year}_Bill_Run_{client_name}.{output_format}")
 
-    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="KF Report")
-        
-        # Get the workbook and the worksheet
-        workbook = writer.book
-        worksheet = writer.sheets["KF Report"]
-        
-        # Find the column index for "DialledNumber"
-        dialled_number_col_idx = desired_columns.index("DialledNumber") + 1  # +1 because Excel is 1-indexed
-        
-        # Set the number format for the "DialledNumber" column to Number with no decimal places
-        for row in range(2, len(df) + 2):  # +2 because Excel is 1-indexed and we have a header row
-            cell = worksheet.cell(row=row, column=dialled_number_col_idx)
-            cell.number_format = '0'  # '0' is the format code for Number with no decimal places
+    target = output if output is not None else output_path
+    if output_format == "csv.gz":
+        # No row limit, for recipients who do not need a workbook
+        df.to_csv(target, index=False, compression="gzip")
+    else:
+        write_kf_workbook(df, target, processes=processes)
 
-    return output_path
+    return output_path if output is None else os.path.basename(output_path)
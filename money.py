@@ -0,0 +1,103 @@
+"""
+Fixed-point money.
+
+Amounts are held as int64 counts of a fixed fraction of a pound rather than as
+floats, so sums, VAT and totals are exact integer arithmetic and a report's
+total always equals the sum of the amounts shown on it. Each column is parsed
+once (parse_money) and only turned back into text or pounds by the writer
+(format_pounds, to_pounds).
+
+Bill amounts (Fixed Charges, Usage Charges, tax amounts) are whole pence.
+Vodafone usage lines are priced to fractions of a penny (e.g. 0.045), so usage
+costs are parsed in USAGE_UNITS and summed there; round_to_pence turns a sum into
+pence only where the report shows it. Rounding is half away from zero throughout.
+
+Columns that may have missing values are pandas "Int64" (int64 values with a mask).
+"""
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+# Units per pound
+PENCE = 100
+USAGE_UNITS = 10_000  # hundredths of a penny
+
+
+def parse_money(values: pd.Series, scale: int = PENCE) -> pd.Series:
+    """
+    Parse a column of amounts (numbers, or strings such as "£1,942.00" or " 12.71")
+    into int64 counts of 1/'scale' of a pound.
+
+    Amounts with no more decimals than 'scale' holds are converted exactly; finer
+    amounts are rounded half away from zero. Blank or unparseable values are missing.
+
+    Returns:
+        pd.Series: "Int64" Series on the same index
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        pounds = values.astype("float64")
+    else:
+        cleaned = values.astype("string").str.replace("£", "", regex=False).str.replace(",", "", regex=False)
+        pounds = pd.to_numeric(cleaned.str.strip(), errors="coerce").astype("float64")
+    scaled = pounds.to_numpy() * scale
+    # Scaling can leave an exact amount a few ulps off a whole unit (12.71 * 100 =
+    # 1270.9999999999998), so snap those before rounding ties away from zero
+    snapped = np.round(scaled, 6)
+    units = np.sign(snapped) * np.floor(np.abs(snapped) + 0.5)
+    return pd.Series(pd.array(units, dtype="Int64"), index=values.index, name=values.name)
+
+
+def money(amount: Union[int, float, str], scale: int = PENCE) -> int:
+    """
+    A single amount in 1/'scale' of a pound; unparseable amounts are 0.
+    """
+    units = parse_money(pd.Series([amount], dtype=object), scale).iloc[0]
+    return 0 if pd.isna(units) else int(units)
+
+
+def divide_round(numerator, denominator: int):
+    """
+    Integer division rounding half away from zero, for int64 arrays and Series.
+    """
+    quotient = (np.abs(numerator) * 2 + denominator) // (denominator * 2)
+    return np.sign(numerator) * quotient
+
+
+def round_to_pence(units, scale: int = USAGE_UNITS):
+    """
+    Round amounts in 1/'scale' of a pound to whole pence.
+    """
+    return divide_round(units, scale // PENCE)
+
+
+def apply_ratio(pence, numerator: int, denominator: int):
+    """
+    pence * numerator / denominator, rounded to whole pence (e.g. VAT on a net
+    amount, as the tax paid over the amount it was paid on).
+    """
+    return divide_round(pence * numerator, denominator)
+
+
+def to_pounds(pence: pd.Series) -> pd.Series:
+    """
+    Pounds as float64 for numeric cells. Each value is the nearest double to the
+    exact amount, as if the amount had been typed in.
+    """
+    return pence.astype("float64") / PENCE
+
+
+def format_pounds(pence: pd.Series, symbol: str = "", thousands: bool = False, missing: str = "") -> pd.Series:
+    """
+    Format whole pence for display, e.g. "£1,942.05" with symbol="£" and thousands=True.
+    The sign follows the symbol, as in f"£{x:,.2f}". Missing values are shown as 'missing'.
+    """
+    present = pence.notna()
+    values = pence.fillna(0).astype("int64")
+    magnitude = values.abs()
+    pounds = (magnitude // PENCE).astype(str)
+    if thousands:
+        pounds = pounds.str.replace(r"(\d)(?=(\d{3})+$)", r"\1,", regex=True)
+    sign = pd.Series(np.where(values < 0, "-", ""), index=pence.index)
+    text = symbol + sign + pounds + "." + (magnitude % PENCE).astype(str).str.zfill(2)
+    return text.where(present, missing).astype(object)
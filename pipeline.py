@@ -0,0 +1,197 @@
+"""
+Memoized report stages.
+
+A generator runs as a chain of named stages (load -> normalize -> aggregate ->
+format -> write). Each stage's result is pickled under a key made from the
+stage name, the generator version and the keys of its inputs: a file input is
+keyed by its content hash and an earlier stage by its own key. When a run is
+repeated with some inputs changed, only the stages downstream of the change
+are recomputed; when a run dies part way (e.g. a worker killed during the
+Excel write), the next run picks up after the last stage that completed.
+
+Stage results are only kept when a cache directory is given (the generators'
+stage_dir, off by default). The directory is pruned when a pipeline starts:
+results unused for STAGE_MAX_AGE are deleted, then the least recently used
+until the rest fit in STAGE_MAX_BYTES.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+from reference_store import file_sha256
+from report_cache import GENERATOR_VERSION
+
+# Suggested directory for stage results (relative to the project root, like data/output)
+STAGE_CACHE_DIR = os.path.join("data", "cache", "stages")
+
+# Stage results unused for this long are deleted when a pipeline starts
+STAGE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Least recently used stage results are deleted when a pipeline starts until the rest fit in this
+STAGE_MAX_BYTES = 2 * 1024 ** 3
+
+# Stage timings collected inside record_stage_times(), or None when not recording
+_stage_times: Optional[List[Dict[str, Any]]] = None
+
+
+@contextmanager
+def record_stage_times() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Collect the time taken by every stage run inside the block, as dicts with
+    "pipeline", "stage", "seconds" and "reused" keys in the order the stages ran.
+    Used by the benchmarks.
+    """
+    global _stage_times
+    previous, _stage_times = _stage_times, []
+    try:
+        yield _stage_times
+    finally:
+        _stage_times = previous
+
+
+def _record_stage(pipeline: str, stage: str, start: float, reused: bool) -> None:
+    if _stage_times is not None:
+        _stage_times.append({"pipeline": pipeline, "stage": stage,
+                             "seconds": time.perf_counter() - start, "reused": reused})
+
+
+class SourceFile:
+    """
+    An input file of a pipeline, keyed by its content. The file is only hashed
+    when the key is first needed, so a pipeline without a cache never reads it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._key: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        if self._key is None:
+            self._key = file_sha256(self.path)
+        return self._key
+
+    @property
+    def value(self) -> str:
+        return self.path
+
+
+class StageResult:
+    """
+    The result of a stage: its key (None when the pipeline has no cache) and its value.
+    """
+
+    def __init__(self, key: Optional[str], value: Any):
+        self.key = key
+        self.value = value
+
+
+def argument_key(argument: Any) -> str:
+    if isinstance(argument, (SourceFile, StageResult)):
+        return argument.key
+    return json.dumps(argument, sort_keys=True, default=repr)
+
+
+def argument_value(argument: Any) -> Any:
+    if isinstance(argument, (SourceFile, StageResult)):
+        return argument.value
+    return argument
+
+
+class Pipeline:
+    """
+    Runs the stages of one generator, reusing stored results where the inputs match.
+
+    Args:
+        name (str): Generator name, part of every stage key
+        cache_dir (Optional[str]): Directory for stage results (e.g. STAGE_CACHE_DIR); None keeps
+            results in memory only
+    """
+
+    def __init__(self, name: str, cache_dir: Optional[str] = None):
+        self.name = name
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._prune()
+
+    def source(self, path: str) -> SourceFile:
+        return SourceFile(path)
+
+    def stage(self, name: str, func: Callable, *args: Any, **kwargs: Any) -> StageResult:
+        """
+        Run 'func' on the values of 'args'/'kwargs', or reuse its stored result.
+
+        Args may be SourceFile (passed as the path), StageResult (passed as its
+        value) or plain JSON-serializable values. Without a cache no key is
+        worked out, so input files are not hashed.
+        """
+        key = path = None
+        if self.cache_dir:
+            payload = json.dumps({
+                "pipeline": self.name,
+                "version": GENERATOR_VERSION,
+                "stage": name,
+                "args": [argument_key(arg) for arg in args],
+                "kwargs": {kw: argument_key(arg) for kw, arg in sorted(kwargs.items())},
+            })
+            key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            path = os.path.join(self.cache_dir, f"{self.name}-{name}-{key}.pkl")
+
+        start = time.perf_counter()
+        if path:
+            # Load in the same step as the existence check: another run may prune the file at any time
+            try:
+                value = pd.read_pickle(path)
+            except FileNotFoundError:
+                pass
+            else:
+                print(f"{self.name}: reusing stage '{name}'")
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+                _record_stage(self.name, name, start, reused=True)
+                return StageResult(key, value)
+
+        value = func(*[argument_value(arg) for arg in args],
+                     **{kw: argument_value(arg) for kw, arg in kwargs.items()})
+        if path:
+            fd, partial_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".partial-")
+            os.close(fd)
+            pd.to_pickle(value, partial_path)
+            os.replace(partial_path, path)
+        _record_stage(self.name, name, start, reused=False)
+        return StageResult(key, value)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - STAGE_MAX_AGE
+        kept = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if stat.st_mtime < cutoff:
+                        os.remove(entry.path)
+                    else:
+                        kept.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+
+        total = sum(size for _, size, _ in kept)
+        for _, size, path in sorted(kept):
+            if total <= STAGE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
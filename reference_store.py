@@ -0,0 +1,182 @@
+"""
+Persistent store for List-of-Services reference data.
+
+A List-of-Services export is parsed once and kept in a SQLite database of its
+own (REFERENCE_DB_PATH) as an indexed table keyed on SERVICE_NO, together with the SHA-256 of
+the file it came from. Later runs only hash an uploaded file to see whether it
+differs from the stored version, and look up the numbers on a bill in one
+keyed query instead of reparsing the CSV.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional
+import numpy as np
+import pandas as pd
+
+# The project root, so the store is the same file whatever the working directory
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The reference database; set REFERENCE_DB_PATH in the environment to use another file.
+# It is kept apart from Django's db.sqlite3, whose tables are managed by migrations
+REFERENCE_DB_PATH = os.environ.get("REFERENCE_DB_PATH", os.path.join(PROJECT_DIR, "data", "reference.sqlite3"))
+
+# Where earlier versions kept the reference tables; they are moved out on first use
+LEGACY_DB_PATH = os.path.join(PROJECT_DIR, "db.sqlite3")
+
+# Report field -> column in the service_mappings table
+MAPPING_COLUMNS = {
+    "Tariff": "tariff",
+    "Start/End Date": "start_end_date",
+    "Cost Centre": "cost_centre",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reference_versions (
+    name TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    loaded_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS service_mappings (
+    name TEXT NOT NULL,
+    service_no TEXT NOT NULL,
+    tariff TEXT,
+    start_end_date TEXT,
+    cost_centre TEXT,
+    PRIMARY KEY (name, service_no)
+) WITHOUT ROWID;
+"""
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Hex SHA-256 of a file's contents, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ReferenceStore:
+    """
+    Named List-of-Services tables (e.g. "convatec_uk") in a SQLite database.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, legacy_db_path: Optional[str] = LEGACY_DB_PATH):
+        self.db_path = str(db_path or REFERENCE_DB_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        created = not os.path.exists(self.db_path)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        if created and legacy_db_path and os.path.exists(legacy_db_path):
+            self._move_legacy_tables(str(legacy_db_path))
+
+    def _move_legacy_tables(self, legacy_db_path: str) -> None:
+        """
+        Copy the reference tables out of the database they used to live in, then drop them there.
+        """
+        with self._connect() as conn:
+            conn.execute("ATTACH DATABASE ? AS legacy", (legacy_db_path,))
+            tables = {row[0] for row in conn.execute("SELECT name FROM legacy.sqlite_master WHERE type = 'table'")}
+            if not {"reference_versions", "service_mappings"} <= tables:
+                return
+            conn.execute("INSERT OR REPLACE INTO reference_versions SELECT * FROM legacy.reference_versions")
+            conn.execute("INSERT OR REPLACE INTO service_mappings SELECT * FROM legacy.service_mappings")
+        with sqlite3.connect(legacy_db_path, timeout=30) as legacy:
+            legacy.execute("DROP TABLE IF EXISTS service_mappings")
+            legacy.execute("DROP TABLE IF EXISTS reference_versions")
+        legacy.close()
+        print(f"Moved stored reference data from {legacy_db_path} to {self.db_path}")
+
+    @contextmanager
+    def _connect(self):
+        """
+        Connection that commits on success and is always closed.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def current_hash(self, name: str) -> Optional[str]:
+        """
+        Content hash of the stored version of 'name', or None if nothing is stored.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT content_hash FROM reference_versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def has(self, name: str) -> bool:
+        return self.current_hash(name) is not None
+
+    def ingest(self, name: str, path: str, parse: Callable[[str], pd.DataFrame]) -> bool:
+        """
+        Store the List of Services in 'path' as 'name', unless that exact file is already stored.
+
+        Args:
+            name (str): Reference table name
+            path (str): List-of-Services CSV
+            parse (Callable[[str], pd.DataFrame]): Reads the CSV into a table indexed by
+                SERVICE_NO with report field columns (see MAPPING_COLUMNS)
+
+        Returns:
+            bool: True if the file was parsed and stored, False if the stored version was current
+        """
+        content_hash = file_sha256(path)
+        if content_hash == self.current_hash(name):
+            return False
+
+        mappings = parse(path)
+        columns = [field for field in MAPPING_COLUMNS if field in mappings.columns]
+        values = mappings[columns].astype(object).where(mappings[columns].notna(), None)
+        rows = [(name, service_no, *row) for service_no, row in zip(mappings.index, values.itertuples(index=False))]
+        sql_columns = ", ".join(MAPPING_COLUMNS[field] for field in columns)
+        placeholders = ", ".join("?" * (len(columns) + 2))
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM service_mappings WHERE name = ?", (name,))
+            conn.executemany(
+                f"INSERT OR REPLACE INTO service_mappings (name, service_no, {sql_columns}) VALUES ({placeholders})",
+                rows,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO reference_versions (name, content_hash, row_count, loaded_at) VALUES (?, ?, ?, ?)",
+                (name, content_hash, len(rows), time.time()),
+            )
+        print(f"Stored {len(rows)} services as reference '{name}'")
+        return True
+
+    def lookup(self, name: str, service_nos: Iterable[str], fields: List[str]) -> pd.DataFrame:
+        """
+        Fetch the stored details for the given service numbers in one keyed query.
+
+        Args:
+            name (str): Reference table name
+            service_nos (Iterable[str]): Numbers to look up; unknown numbers are left out
+            fields (List[str]): Report fields to return (keys of MAPPING_COLUMNS)
+
+        Returns:
+            pd.DataFrame: Details indexed by SERVICE_NO with one column per field
+        """
+        sql_columns = ", ".join(f"m.{MAPPING_COLUMNS[field]}" for field in fields)
+        keys = [(service_no,) for service_no in set(service_nos) if isinstance(service_no, str)]
+
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE lookup_keys (service_no TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO lookup_keys VALUES (?)", keys)
+            rows = conn.execute(
+                f"SELECT m.service_no, {sql_columns} FROM lookup_keys k "
+                "JOIN service_mappings m ON m.name = ? AND m.service_no = k.service_no",
+                (name,),
+            ).fetchall()
+
+        mappings = pd.DataFrame(rows, columns=["SERVICE_NO", *fields], dtype=object).set_index("SERVICE_NO")
+        # NULLs come back as None; report blanks are NaN as when read from the CSV
+        return mappings.where(mappings.notna(), np.nan)
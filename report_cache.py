@@ -0,0 +1,117 @@
+"""
+Content-addressed cache of generated reports.
+
+A report is keyed by the SHA-256 of everything that determines it: the hash of
+every input file, the client, the report parameters, the generator version and,
+for reports that show the period they were run for, that period.
+Re-submitting the same exports therefore returns the stored report without
+running the generator. The cache directory is bounded in size; the least
+recently used reports are evicted first (file mtimes record last use).
+"""
+import json
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from report_output import ReportOutput
+
+# Bump when a change to any generator alters its output, so stale reports aren't served
+GENERATOR_VERSION = "2026.10.2"
+
+# Extensions of report files that are kept as-is in the cache
+REPORT_EXTENSIONS = (".csv.gz", ".xlsx")
+
+
+def cache_key(client: str, input_hashes: Dict[str, str], params: Dict[str, Any],
+              version: str = GENERATOR_VERSION, period: Optional[str] = None) -> str:
+    """
+    Hex SHA-256 identifying a report run.
+
+    Args:
+        client (str): Client name
+        input_hashes (Dict[str, str]): Content hash of each input, keyed by input name
+        params (Dict[str, Any]): Report parameters (must be JSON serializable)
+        version (str): Generator version tag
+        period (Optional[str]): Billing period shown in the report, for reports that
+            take it from the run date (see report_tasks.report_period)
+
+    Returns:
+        str: The cache key
+    """
+    payload = json.dumps(
+        {"version": version, "client": client, "inputs": input_hashes, "params": params, "period": period},
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def report_extension(path: str) -> str:
+    for extension in REPORT_EXTENSIONS:
+        if path.endswith(extension):
+            return extension
+    return os.path.splitext(path)[1]
+
+
+class ReportCache:
+    """
+    Reports stored as <key><extension> in one directory, bounded to 'max_bytes'.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.is_file() and not entry.name.startswith(".")]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Path of the cached report for 'key', or None. A hit counts as a use for eviction.
+        """
+        for extension in REPORT_EXTENSIONS:
+            path = os.path.join(self.directory, key + extension)
+            if os.path.exists(path):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    continue  # evicted in the meantime
+                return path
+        return None
+
+    def put(self, key: str, report: ReportOutput) -> Optional[str]:
+        """
+        Copy a generated report into the cache and evict old reports to stay within max_bytes.
+
+        Returns:
+            Optional[str]: The cached path, or None if the report alone exceeds max_bytes
+        """
+        if report.size > self.max_bytes:
+            return None
+
+        path = os.path.join(self.directory, key + report_extension(report.name))
+        fd, partial_path = tempfile.mkstemp(dir=self.directory, prefix=".partial-")
+        os.close(fd)
+        report.save(partial_path)
+        os.replace(partial_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: str) -> None:
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+            total = sum(entry.stat().st_size for entry in entries)
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                if entry.path == keep:
+                    continue
+                total -= entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,163 @@
+"""
+Spooled report output.
+
+A generator given an 'output' file object writes its workbook there instead of
+to a file. ReportSpool is that file object for web runs: it keeps the report in
+memory while it is small and moves it to a private temporary file once it grows
+past a threshold, so a run never writes to the server user's home directory and
+small reports never touch the disk at all. Finishing a spool gives a
+ReportOutput, which can be sent back from a worker process and streamed to the
+browser.
+"""
+import io
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Optional
+
+# Reports larger than this are spilled from memory to a temporary file
+REPORT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+
+class ReportOutput:
+    """
+    A finished report, held either as bytes in memory or in a file.
+
+    Args:
+        name (str): File name of the report (used for its extension)
+        data (Optional[bytes]): Report content, when held in memory
+        path (Optional[str]): Report file, when held on disk
+        temporary (bool): The file belongs to this report and is deleted by discard()
+    """
+
+    def __init__(self, name: str, data: Optional[bytes] = None, path: Optional[str] = None,
+                 temporary: bool = False):
+        self.name = name
+        self.data = data
+        self.path = path
+        self.temporary = temporary
+
+    @classmethod
+    def from_file(cls, path: str, name: Optional[str] = None) -> "ReportOutput":
+        return cls(name or os.path.basename(path), path=path)
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def exists(self) -> bool:
+        return self.data is not None or (self.path is not None and os.path.exists(self.path))
+
+    def open(self) -> BinaryIO:
+        """
+        A new binary file object positioned at the start of the report.
+        """
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def save(self, path: str) -> str:
+        """
+        Write the report to 'path' and return it.
+        """
+        if self.data is not None:
+            with open(path, "wb") as f:
+                f.write(self.data)
+        else:
+            shutil.copyfile(self.path, path)
+        return path
+
+    def discard(self) -> None:
+        """
+        Delete the report's temporary file, if it has one.
+        """
+        if self.temporary and self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ReportSpool(io.BufferedIOBase):
+    """
+    A seekable binary file that stays in memory up to 'max_bytes', then moves to
+    a temporary file in 'spill_dir' (the system temp directory by default).
+
+    Args:
+        max_bytes (int): Largest size kept in memory
+        spill_dir (Optional[str]): Directory for the temporary file
+    """
+
+    def __init__(self, max_bytes: int = REPORT_SPOOL_MAX_BYTES, spill_dir: Optional[str] = None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_path: Optional[str] = None
+        self._file = io.BytesIO()
+
+    @property
+    def spilled(self) -> bool:
+        return self.spill_path is not None
+
+    def _spill(self) -> None:
+        fd, self.spill_path = tempfile.mkstemp(dir=self.spill_dir, prefix="report_", suffix=".part")
+        spilled = os.fdopen(fd, "w+b")
+        position = self._file.tell()
+        spilled.write(self._file.getbuffer())
+        spilled.seek(position)
+        self._file = spilled
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if not self.spilled and self._file.tell() + len(data) > self.max_bytes:
+            self._spill()
+        return self._file.write(data)
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        return self._file.read(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        return self._file.truncate(size)
+
+    def flush(self) -> None:
+        if not self.closed:
+            self._file.flush()
+
+    def close(self) -> None:
+        # Leaves a spilled file in place; finish() and discard() decide what happens to it
+        if not self.closed:
+            super().close()
+            self._file.close()
+
+    def finish(self, name: str) -> ReportOutput:
+        """
+        Close the spool and return its content as a ReportOutput named 'name'.
+        """
+        if self.spilled:
+            self.close()
+            return ReportOutput(name, path=self.spill_path, temporary=True)
+        data = self._file.getvalue()
+        self.close()
+        return ReportOutput(name, data=data)
+
+    def discard(self) -> None:
+        """
+        Close the spool and delete its temporary file, if any.
+        """
+        self.close()
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
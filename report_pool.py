@@ -0,0 +1,73 @@
+"""
+Pre-warmed process pool for running report generators.
+
+The generators are pure pandas/openpyxl work that holds the GIL, so threads in
+the web server would run them one at a time. This pool runs them in separate
+processes instead. On platforms that have it, workers are forked from a
+forkserver that has already imported the heavy modules, so a new or recycled
+worker starts with pandas, numpy and the report modules loaded. Each worker is
+replaced after a fixed number of jobs to stop memory growing across runs
+(Python 3.11 and later; older versions keep their workers for good).
+"""
+import importlib
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+# Imported once in the forkserver (or in each worker where there is none)
+PRELOAD_MODULES = [
+    "numpy",
+    "pandas",
+    "openpyxl",
+    "xlsxwriter",
+    "report_tasks",
+]
+
+# Jobs a worker runs before it is replaced
+DEFAULT_MAX_JOBS_PER_WORKER = 20
+
+
+def preload_modules() -> None:
+    """
+    Worker initializer: import the report stack up front rather than in the first job.
+    A no-op for modules the forkserver already imported.
+    """
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+
+def pool_context():
+    """
+    The forkserver context with the report stack preloaded, or spawn where
+    forkserver isn't available (Windows).
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def create_report_pool(workers: Optional[int] = None,
+                       max_jobs_per_worker: Optional[int] = DEFAULT_MAX_JOBS_PER_WORKER) -> ProcessPoolExecutor:
+    """
+    Create a process pool for report generators.
+
+    Args:
+        workers (Optional[int]): Number of worker processes; defaults to the CPU count
+        max_jobs_per_worker (Optional[int]): Replace a worker after this many jobs; None keeps workers
+            for good. Ignored before Python 3.11, where ProcessPoolExecutor can't recycle workers
+
+    Returns:
+        ProcessPoolExecutor: The pool; submit report_tasks.run_report to it
+    """
+    options = {}
+    if max_jobs_per_worker is not None and sys.version_info >= (3, 11):
+        options["max_tasks_per_child"] = max_jobs_per_worker
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=pool_context(),
+        initializer=preload_modules,
+        **options,
+    )
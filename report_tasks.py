@@ -0,0 +1,170 @@
+"""
+One entry point for running any client's report generator.
+
+A report run is described by plain data (the client, a dict of input file
+paths keyed by upload field name and a dict of parameters), so it can be
+queued, handed to another process or replayed from the command line.
+"""
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from reference_store import ReferenceStore, file_sha256
+from report_output import REPORT_SPOOL_MAX_BYTES, ReportOutput, ReportSpool
+from Islestar_report import process_billing_data, USAGE_CHUNK_SIZE
+from tysers_reports import create_tysers_report
+from kf_reports import process_kf_report
+from icr_report import process_icr_report
+from convatecuk_report import process_and_combine_csv as process_and_combine_csv_uk
+from convatecuk_report import generate_billing_report as generate_billing_report_uk
+from convatecuk_report import ensure_directories_exist as ensure_directories_exist_uk
+from convatecuk_report import SERVICES_REFERENCE as CONVATEC_UK_SERVICES_REFERENCE
+from convatecuk_report import get_date_ranges as get_date_ranges_uk
+from convatec_ipad_report import process_and_combine_csv as process_and_combine_csv_ipad
+from convatec_ipad_report import generate_billing_report as generate_billing_report_ipad
+from convatec_ipad_report import ensure_directories_exist as ensure_directories_exist_ipad
+from convatec_ipad_report import EUROPE_SERVICES_REFERENCE as IPAD_EUROPE_SERVICES_REFERENCE
+from convatec_ipad_report import UK_SERVICES_REFERENCE as IPAD_UK_SERVICES_REFERENCE
+from convatec_ipad_report import get_date_ranges as get_date_ranges_ipad
+
+# Upload field names each client needs; any other client uses DEFAULT_INPUTS
+REQUIRED_INPUTS = {
+    'Tysers': ['usage_file', 'service_file', 'data_usage_file'],
+    'ConvaTec UK': ['convatec_limited_file', 'convatec_plc_file'],
+    'ConvaTec iPad': ['ipad_project_file', 'ipad_europe_file'],
+}
+DEFAULT_INPUTS = ['usage_file', 'service_file']
+
+# Reference inputs that may be left out when a stored version exists, mapped to
+# their name in the reference store
+OPTIONAL_INPUTS = {
+    'ConvaTec UK': {'list_of_services_file': CONVATEC_UK_SERVICES_REFERENCE},
+    'ConvaTec iPad': {
+        'ipad_europe_services_file': IPAD_EUROPE_SERVICES_REFERENCE,
+        'ipad_uk_services_file': IPAD_UK_SERVICES_REFERENCE,
+    },
+}
+
+# Clients whose report shows a billing period worked out from the run date, so the
+# same inputs give a different report each month
+DATED_REPORTS = {
+    'ConvaTec UK': get_date_ranges_uk,
+    'ConvaTec iPad': get_date_ranges_ipad,
+}
+
+
+def required_inputs(client: str) -> List[str]:
+    return REQUIRED_INPUTS.get(client, DEFAULT_INPUTS)
+
+
+def optional_inputs(client: str) -> Dict[str, str]:
+    return OPTIONAL_INPUTS.get(client, {})
+
+
+def report_period(client: str) -> Optional[str]:
+    """
+    The billing period a run started now would show in the client's report, or
+    None if the report doesn't depend on the run date.
+    """
+    date_ranges = DATED_REPORTS.get(client)
+    return date_ranges()[0] if date_ranges else None
+
+
+def input_hashes(client: str, inputs: Dict[str, str], known: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Content hash of every input of a run, keyed by upload field name. Inputs whose
+    hash is in 'known' aren't read again. A reference input that was left out is
+    represented by the hash of its stored version.
+    """
+    known = known or {}
+    hashes = {field: known[field] if field in known else file_sha256(path) for field, path in inputs.items()}
+    missing = {field: reference for field, reference in optional_inputs(client).items() if field not in inputs}
+    if missing:
+        reference_store = ReferenceStore()
+        for field, reference in missing.items():
+            hashes[field] = f"stored:{reference_store.current_hash(reference)}"
+    return hashes
+
+
+def run_report(client: str, inputs: Dict[str, str], params: Dict[str, Any], output_dir: Optional[str] = None,
+               output: Optional[BinaryIO] = None, stage_dir: Optional[str] = None) -> str:
+    """
+    Run the report generator for a client.
+
+    Args:
+        client (str): Client name as listed in the UI
+        inputs (Dict[str, str]): Input file paths keyed by upload field name
+        params (Dict[str, Any]): Client options ('pre_tax_amount' and 'total_tax_amount'
+            for Tysers, 'output_format' for Knight Frank, 'drilldown' for ICR)
+        output_dir (Optional[str]): Directory to write the report to; defaults to ~/Downloads
+        output (Optional[BinaryIO]): Write the report to this file object instead of a file
+        stage_dir (Optional[str]): Keep the generator's stage results here so a rerun skips
+            unchanged stages (see pipeline.py); None keeps nothing
+
+    Returns:
+        str: Path to the generated report, or only its file name when 'output' is given
+    """
+    if client == 'Tysers':
+        return create_tysers_report(
+            inputs['service_file'],
+            inputs['data_usage_file'],
+            inputs['usage_file'],
+            client,
+            pre_tax_amount=params.get('pre_tax_amount', 0),
+            total_tax_amount=params.get('total_tax_amount', 0),
+            stage_dir=stage_dir,
+            output_dir=output_dir,
+            output=output
+        )
+
+    if client == 'Knight Frank':
+        return process_kf_report(inputs['usage_file'], inputs['service_file'], client,
+                                 output_format=params.get('output_format', 'xlsx'), stage_dir=stage_dir,
+                                 output_dir=output_dir, output=output)
+
+    if client == 'Institute of Cancer Research':
+        return process_icr_report(inputs['service_file'], inputs['usage_file'], client,
+                                  streaming=True, drilldown=params.get('drilldown', False), stage_dir=stage_dir,
+                                  output_dir=output_dir, output=output)
+
+    if client == 'ConvaTec UK':
+        ensure_directories_exist_uk()
+        combined_df = process_and_combine_csv_uk(inputs['convatec_limited_file'], inputs['convatec_plc_file'])
+        # A new List of Services is stored on the way; without one the stored version is used
+        return generate_billing_report_uk(combined_df, inputs.get('list_of_services_file'), output_dir=output_dir,
+                                          output=output)
+
+    if client == 'ConvaTec iPad':
+        ensure_directories_exist_ipad()
+        combined_df = process_and_combine_csv_ipad(inputs['ipad_project_file'], inputs['ipad_europe_file'])
+        return generate_billing_report_ipad(combined_df, inputs.get('ipad_europe_services_file'),
+                                            inputs.get('ipad_uk_services_file'), output_dir=output_dir,
+                                            output=output)
+
+    # Other clients (Isle Star, etc.)
+    return process_billing_data(inputs['service_file'], inputs['usage_file'], client, chunksize=USAGE_CHUNK_SIZE,
+                                stage_dir=stage_dir, output_dir=output_dir, output=output)
+
+
+def run_report_spooled(client: str, inputs: Dict[str, str], params: Dict[str, Any], spill_dir: Optional[str] = None,
+                       max_bytes: int = REPORT_SPOOL_MAX_BYTES, stage_dir: Optional[str] = None) -> ReportOutput:
+    """
+    Run the report generator for a client, writing the report to a ReportSpool
+    rather than a file.
+
+    Args:
+        client (str): Client name as listed in the UI
+        inputs (Dict[str, str]): Input file paths keyed by upload field name
+        params (Dict[str, Any]): Client options (see run_report)
+        spill_dir (Optional[str]): Directory for the temporary file of a report larger than max_bytes
+        max_bytes (int): Largest report kept in memory
+        stage_dir (Optional[str]): Directory for the generator's stage results (see run_report)
+
+    Returns:
+        ReportOutput: The report, in memory or in a temporary file in spill_dir
+    """
+    spool = ReportSpool(max_bytes, spill_dir)
+    try:
+        name = run_report(client, inputs, params, output=spool, stage_dir=stage_dir)
+    except BaseException:
+        spool.discard()
+        raise
+    return spool.finish(name)
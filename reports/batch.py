@@ -0,0 +1,75 @@
+"""
+Streaming zip of a monthly bill run.
+
+A batch submits every client's report to the job pool at once, so they are
+generated concurrently. The zip is streamed back as reports finish: each one is
+added as soon as it is ready, and the response is sent while the slower clients
+are still running. Reports are already compressed (.xlsx, .csv.gz), so they are
+stored in the zip rather than deflated again.
+"""
+import zipfile
+from concurrent.futures import as_completed
+from typing import Callable, Iterable, Iterator, List
+
+from report_output import ReportOutput
+from .jobs import Job
+
+# Bytes read from a report at a time while adding it to the zip
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+class ZipStream:
+    """
+    Write-only target for ZipFile that hands over what has been written so far.
+    It has no tell(), so ZipFile writes entries with data descriptors and never seeks.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_report_zip(jobs: Iterable[Job], report_filename: Callable[[str, ReportOutput], str]) -> Iterator[bytes]:
+    """
+    Yield a zip of the reports of 'jobs', adding each one as it finishes.
+
+    Clients whose report failed are listed with their error in errors.txt at the
+    end of the zip.
+
+    Args:
+        jobs (Iterable[Job]): Submitted jobs
+        report_filename (Callable[[str, ReportOutput], str]): Name of a client's report in the zip
+    """
+    jobs_by_future = {job.future: job for job in jobs}
+    errors = []
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for future in as_completed(jobs_by_future):
+            job = jobs_by_future[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                errors.append(f"{job.client}: {e}")
+                continue
+
+            with report.open() as source, archive.open(report_filename(job.client, report), 'w',
+                                                       force_zip64=True) as entry:
+                for chunk in iter(lambda: source.read(ZIP_CHUNK_SIZE), b''):
+                    entry.write(chunk)
+                    yield stream.take()
+            print(f"Added {job.client} report to the bill run zip")
+
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+    yield stream.take()
@@ -0,0 +1,242 @@
+"""
+Background bill-run jobs.
+
+Submitting a job returns straight away with an id; the report is generated in
+the pre-warmed process pool (see report_pool) and the browser polls the job's
+status until it can download the result. Jobs are kept in memory, so the status
+and download endpoints must be served by the same server process that accepted
+the job.
+
+Each job runs in its own workspace directory (see workspace.RunWorkspace), which
+holds its inputs, so any number of runs can be in flight at once without
+overwriting each other's files. Reports are written to a spool rather than a
+file (see report_output): they come back from the worker in memory, or in a
+temporary file in the workspace when they are large. The workspace and any
+such file are deleted when the job is forgotten.
+"""
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Optional
+
+from django.conf import settings
+
+from report_cache import ReportCache, cache_key, report_extension
+from report_output import REPORT_SPOOL_MAX_BYTES, ReportOutput
+from report_pool import create_report_pool
+from report_tasks import input_hashes, report_period, run_report_spooled
+from workspace import RunWorkspace, remove_stale_workspaces
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """
+    One report run and its outcome.
+    """
+
+    def __init__(self, client: str, inputs: Dict[str, str], params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.inputs = inputs
+        self.params = params
+        self.future: Optional[Future] = None
+        self.workspace: Optional[RunWorkspace] = None
+        self.cache_key: Optional[str] = None
+        self.cached = False
+        self.report: Optional[ReportOutput] = None
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def status(self) -> str:
+        if self.finished_at is not None:
+            return FAILED if self.error is not None else DONE
+        if self.future is not None and self.future.running():
+            return RUNNING
+        return QUEUED
+
+    def report_file(self) -> Optional[str]:
+        """
+        Path of the report on disk, for opening it locally. A report held in memory
+        is written to the job's workspace (or a private temporary file) first.
+        """
+        if self.report is None or not self.report.exists():
+            return None
+        if self.report.path is None:
+            if self.workspace is not None:
+                path = os.path.join(self.workspace.output_dir, self.report.name)
+            else:
+                fd, path = tempfile.mkstemp(prefix="report_", suffix=report_extension(self.report.name))
+                os.close(fd)
+            self.report = ReportOutput(self.report.name, path=self.report.save(path), temporary=True)
+        return self.report.path
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.id,
+            'client': self.client,
+            'status': self.status,
+            'cached': self.cached,
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs report jobs in a process pool and keeps their status for polling.
+    Finished jobs are forgotten after 'retention' seconds. With a cache, a run
+    whose inputs and parameters were seen before is answered from the cache.
+    With a workspace_dir, every run gets its own workspace in it; without one,
+    inputs are used where they are. Reports up to 'spool_max_bytes' are kept in
+    memory; larger ones are spilled to a temporary file. With a stage_dir, the
+    generators keep their stage results there (see pipeline.py).
+    """
+
+    def __init__(self, workers: Optional[int], retention: float, max_jobs_per_worker: Optional[int] = None,
+                 cache: Optional[ReportCache] = None, workspace_dir: Optional[str] = None,
+                 spool_max_bytes: int = REPORT_SPOOL_MAX_BYTES, stage_dir: Optional[str] = None):
+        self.retention = retention
+        self.stage_dir = stage_dir
+        self.spool_max_bytes = spool_max_bytes
+        self.workspace_dir = workspace_dir
+        self.cache = cache
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        if workspace_dir:
+            # Workspaces left behind by a server that was stopped with jobs still held
+            remove_stale_workspaces(str(workspace_dir), retention)
+        self._pool = create_report_pool(workers, max_jobs_per_worker)
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, client: str, inputs: Dict[str, str], params: Dict[str, Any], use_cache: bool = True,
+               hashes: Optional[Dict[str, str]] = None) -> Job:
+        """
+        Queue a report run. The input files are deleted once the job has finished.
+        With use_cache=False the report is regenerated even if a cached copy exists
+        (the new report still replaces the cached one). 'hashes' holds input hashes
+        that are already known (e.g. computed during upload), so they aren't read again.
+        """
+        job = Job(client, inputs, params)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+
+        if self.cache is not None:
+            job.cache_key = cache_key(client, input_hashes(client, inputs, hashes), params,
+                                      period=report_period(client))
+            cached_path = self.cache.get(job.cache_key) if use_cache else None
+            if cached_path:
+                print(f"Report job {job.id} for {client} served from cache")
+                job.cached = True
+                job.future = Future()
+                job.future.set_result(ReportOutput.from_file(cached_path))
+                self._finish(job, job.future)
+                return job
+
+        spill_dir = None
+        if self.workspace_dir:
+            try:
+                job.workspace = RunWorkspace(str(self.workspace_dir))
+                job.inputs = job.workspace.add_inputs(inputs)
+            except OSError:
+                with self._lock:
+                    del self._jobs[job.id]
+                remove_files(inputs.values())
+                if job.workspace is not None:
+                    job.workspace.remove()
+                raise
+            spill_dir = job.workspace.output_dir
+
+        args = (client, job.inputs, params, spill_dir, self.spool_max_bytes, self.stage_dir)
+        try:
+            job.future = self._pool.submit(run_report_spooled, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            self._pool = create_report_pool(self.workers, self.max_jobs_per_worker)
+            job.future = self._pool.submit(run_report_spooled, *args)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def run(self, client: str, inputs: Dict[str, str], params: Dict[str, Any], use_cache: bool = True,
+            hashes: Optional[Dict[str, str]] = None) -> ReportOutput:
+        """
+        Run a report in the pool and wait for it. Returns the report; errors are re-raised.
+        """
+        return self.submit(client, inputs, params, use_cache, hashes).future.result()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _finish(self, job: Job, future: Future) -> None:
+        try:
+            job.report = future.result()
+        except Exception as e:
+            print(f"Report job {job.id} for {job.client} failed: {e}")
+            job.error = str(e) or type(e).__name__
+        finally:
+            remove_files(job.inputs.values())
+
+        if job.report and self.cache is not None and not job.cached:
+            try:
+                self.cache.put(job.cache_key, job.report)
+            except OSError as e:
+                print(f"Could not cache report for {job.client}: {e}")
+        job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if job.report is not None:
+                job.report.discard()
+            if job.workspace is not None:
+                job.workspace.remove()
+
+
+def remove_files(paths: Iterable[Optional[str]]) -> None:
+    """
+    Delete temporary files, skipping any that are missing.
+    """
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+_manager: Optional[JobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """
+    The process-wide job manager, created on first use from the REPORT_JOB_* settings,
+    settings.REPORT_WORKER_MAX_JOBS, the REPORT_CACHE_* settings,
+    settings.REPORT_WORKSPACE_DIR, settings.REPORT_SPOOL_MAX_BYTES and settings.REPORT_STAGE_DIR.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(
+                workers=getattr(settings, 'REPORT_JOB_WORKERS', None),
+                retention=getattr(settings, 'REPORT_JOB_RETENTION', 24 * 60 * 60),
+                max_jobs_per_worker=getattr(settings, 'REPORT_WORKER_MAX_JOBS', None),
+                cache=ReportCache(settings.REPORT_CACHE_DIR, settings.REPORT_CACHE_MAX_BYTES)
+                if getattr(settings, 'REPORT_CACHE_DIR', None) else None,
+                workspace_dir=getattr(settings, 'REPORT_WORKSPACE_DIR', None),
+                spool_max_bytes=getattr(settings, 'REPORT_SPOOL_MAX_BYTES', REPORT_SPOOL_MAX_BYTES),
+                stage_dir=getattr(settings, 'REPORT_STAGE_DIR', None),
+            )
+        return _manager
@@ -0,0 +1,216 @@
+"""
+Run the monthly bill run from the command line.
+
+    python manage.py billrun data/input --output data/output --jobs 4
+
+Every subdirectory of the input directory that names a client (e.g. "Tysers",
+"knight-frank", "convatec_ipad") is run. The client's inputs are found by file
+name (see DISCOVERY_PATTERNS); options such as the Tysers tax amounts are read
+from an optional params.json in the same directory. The reports are generated
+in parallel worker processes and written to the output directory, and a table
+of per-client timings is printed at the end.
+"""
+import fnmatch
+import json
+import os
+import re
+import time
+from concurrent.futures import as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from report_pool import create_report_pool
+from report_tasks import optional_inputs, required_inputs, run_report
+from reports.views import CLIENTS
+
+# Other directory names accepted for a client (compared as in normalise_name)
+CLIENT_ALIASES = {
+    'islestar': 'Islestarr',
+    'convatec': 'ConvaTec UK',
+    'kf': 'Knight Frank',
+    'icr': 'Institute of Cancer Research',
+}
+
+# File name patterns for each input, compared against normalise_name(file name).
+# Fields are matched in order and a file is only used once, so more specific
+# fields come first. For each field the first pattern with any match is used.
+DEFAULT_PATTERNS = {
+    'usage_file': ['usage*'],
+    'service_file': ['servicesbreakdown*', 'service*'],
+}
+DISCOVERY_PATTERNS = {
+    'Tysers': {
+        'data_usage_file': ['datausage*'],
+        **DEFAULT_PATTERNS,
+    },
+    'Knight Frank': {
+        'usage_file': ['usage*'],
+        'service_file': ['calls*', 'servicesbreakdown*', 'service*'],
+    },
+    'ConvaTec UK': {
+        'list_of_services_file': ['*listofservices*'],
+        'convatec_limited_file': ['*limited*'],
+        'convatec_plc_file': ['*plc*'],
+    },
+    'ConvaTec iPad': {
+        'ipad_europe_services_file': ['*europe*services*'],
+        'ipad_uk_services_file': ['*uk*services*'],
+        'ipad_project_file': ['*project*'],
+        'ipad_europe_file': ['*europe*'],
+    },
+}
+
+# Client options read from this file in the client's directory
+PARAMS_FILE = 'params.json'
+
+
+def normalise_name(name: str) -> str:
+    """
+    Lower-case a file or directory name and drop everything but letters, digits,
+    dots and the wildcard characters, so "Services Breakdown_ICR.csv" and
+    "servicesbreakdown-icr.csv" compare equal.
+    """
+    return re.sub(r'[^a-z0-9.*?]', '', name.lower())
+
+
+def directory_client(name: str) -> Optional[str]:
+    """
+    The client a directory name refers to, or None.
+    """
+    normalised = normalise_name(name)
+    for client in CLIENTS:
+        if normalise_name(client) == normalised:
+            return client
+    return CLIENT_ALIASES.get(normalised)
+
+
+def discover_inputs(client: str, directory: str) -> Dict[str, str]:
+    """
+    Find a client's input files in its directory.
+
+    Returns:
+        Dict[str, str]: Input paths keyed by upload field name
+
+    Raises:
+        CommandError: If a required input is missing or a pattern matches more than one file
+    """
+    files = sorted(name for name in os.listdir(directory)
+                   if name.lower().endswith('.csv') and os.path.isfile(os.path.join(directory, name)))
+    fields = [*required_inputs(client), *optional_inputs(client)]
+    patterns = DISCOVERY_PATTERNS.get(client, DEFAULT_PATTERNS)
+
+    inputs = {}
+    for field in sorted(fields, key=lambda field: list(patterns).index(field) if field in patterns else len(patterns)):
+        for pattern in patterns.get(field, [normalise_name(field[:-len('_file')]) + '*']):
+            matches = [name for name in files if fnmatch.fnmatchcase(normalise_name(name), pattern)]
+            if len(matches) > 1:
+                raise CommandError(f"more than one file in {directory} matches {field}: {', '.join(matches)}")
+            if matches:
+                inputs[field] = os.path.join(directory, matches[0])
+                files.remove(matches[0])
+                break
+
+    missing = [field for field in required_inputs(client) if field not in inputs]
+    if missing:
+        raise CommandError(f"no file in {directory} for {', '.join(missing)}")
+    return inputs
+
+
+def load_params(directory: str) -> Dict[str, Any]:
+    path = os.path.join(directory, PARAMS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def run_client(client: str, inputs: Dict[str, str], params: Dict[str, Any], output_dir: str,
+               stage_dir: Optional[str] = None) -> Tuple[str, float]:
+    """
+    Worker task: run one client's report, returning its path and the seconds it took.
+    """
+    start = time.perf_counter()
+    output_path = run_report(client, inputs, params, output_dir=output_dir, stage_dir=stage_dir)
+    return output_path, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Run the bill run for every client directory under INPUT_DIR, in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_dir', nargs='?', default=os.path.join('data', 'input'),
+                            help="Directory with one subdirectory per client (default: data/input)")
+        parser.add_argument('-o', '--output', default=os.path.join('data', 'output'),
+                            help="Directory to write the reports to (default: data/output)")
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help="Number of clients to run at once (default: CPU count)")
+        parser.add_argument('-c', '--client', action='append', dest='clients', metavar='CLIENT',
+                            help="Only run this client (may be repeated)")
+        parser.add_argument('--stage-dir', metavar='DIR',
+                            help="Keep each generator's stage results here (e.g. data/cache/stages), so a rerun "
+                                 "skips the stages whose inputs haven't changed (default: keep nothing)")
+
+    def handle(self, *args, **options):
+        input_dir = options['input_dir']
+        output_dir = options['output']
+        if not os.path.isdir(input_dir):
+            raise CommandError(f"Input directory not found: {input_dir}")
+        if options['jobs'] < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        wanted = None
+        if options['clients']:
+            wanted = set()
+            for name in options['clients']:
+                client = directory_client(name)
+                if client is None:
+                    raise CommandError(f"Unknown client: {name}")
+                wanted.add(client)
+
+        # Discover every client's inputs before running any of them; a client
+        # whose inputs can't be found is reported as failed and the rest still run
+        runs: List[Tuple[str, Dict[str, str], Dict[str, Any]]] = []
+        results: Dict[str, Tuple[str, float, str]] = {}
+        for name in sorted(os.listdir(input_dir)):
+            directory = os.path.join(input_dir, name)
+            client = directory_client(name) if os.path.isdir(directory) else None
+            if client is None or (wanted is not None and client not in wanted):
+                continue
+            try:
+                runs.append((client, discover_inputs(client, directory), load_params(directory)))
+            except (CommandError, ValueError) as e:
+                results[client] = ('failed', 0.0, str(e))
+        if not runs and not results:
+            raise CommandError(f"No client directories found in {input_dir}")
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.stdout.write(f"Running {len(runs)} client(s) with {options['jobs']} worker(s)")
+
+        start = time.perf_counter()
+        with create_report_pool(min(options['jobs'], max(len(runs), 1)), max_jobs_per_worker=None) as pool:
+            futures = {pool.submit(run_client, client, inputs, params, output_dir, options['stage_dir']): client
+                       for client, inputs, params in runs}
+            for future in as_completed(futures):
+                client = futures[future]
+                try:
+                    output_path, seconds = future.result()
+                    results[client] = ('ok', seconds, output_path)
+                except Exception as e:
+                    results[client] = ('failed', 0.0, str(e) or type(e).__name__)
+                self.stdout.write(f"{client}: {results[client][0]}")
+        total = time.perf_counter() - start
+
+        self.print_table(results, total)
+        failed = [client for client, (status, _, _) in results.items() if status != 'ok']
+        if failed:
+            raise CommandError(f"{len(failed)} of {len(results)} client(s) failed: {', '.join(failed)}")
+
+    def print_table(self, results: Dict[str, Tuple[str, float, str]], total: float) -> None:
+        width = max(len('Total (wall clock)'), *(len(client) for client in results))
+        self.stdout.write("")
+        self.stdout.write(f"{'Client':<{width}}  {'Status':<6}  {'Seconds':>8}  Report")
+        self.stdout.write(f"{'-' * width}  {'-' * 6}  {'-' * 8}  {'-' * 6}")
+        for client, (status, seconds, detail) in sorted(results.items()):
+            self.stdout.write(f"{client:<{width}}  {status:<6}  {seconds:>8.2f}  {detail}")
+        self.stdout.write(f"{'Total (wall clock)':<{width}}  {'':<6}  {total:>8.2f}")
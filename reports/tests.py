@@ -1,3 +1,894 @@
-from django.test import TestCase
+import os
+import hashlib
+import io
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+from functools import partial
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import openpyxl
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, override_settings
+
+from Islestar_report import build_billing_report, load_service_breakdown, summarise_usage_file
+import convatec_ipad_report
+import convatecuk_report
+from convatec_billing import read_service_mappings
+from cost_cube import build_cost_cube
+from icr_report import partition_usage, process_icr_report
+from kf_reports import DESIRED_COLUMNS, write_kf_workbook
+import reference_store
+from money import USAGE_UNITS, apply_ratio, format_pounds, money, parse_money, round_to_pence
+import pipeline
+from pipeline import Pipeline
+import report_tasks
+from report_cache import cache_key
+from report_output import ReportSpool
+import report_pool
+from reports.management.commands.billrun import discover_inputs
+from reports import views
+from reports.jobs import DONE, FAILED, QUEUED, RUNNING, JobManager
+from reports.uploads import HashingUploadHandler
+from service_breakdown import combine_service_breakdowns
+from workbook_assembler import WorkbookAssembler, _cell_xml
+from workspace import RunWorkspace, remove_stale_workspaces
+
+
+class TempDirMixin:
+    """
+    Gives each test a scratch directory, removed afterwards.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def write(self, name: str, text: str) -> str:
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+
+class CategoricalUsageTests(TempDirMixin, SimpleTestCase):
+    """
+    Usage Category is read as a categorical; a chunk whose categories all map to
+    distinct named columns must still summarise.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.usage = self.write("usage.csv", "Service,Usage Category,Cost\n"
+                                             "07700900001,Daily Rate Roaming,2\n"
+                                             "07700900002,Roam Call MO,0.5\n")
+
+    def test_single_category_per_chunk(self):
+        for chunksize in (None, 1):
+            with self.subTest(chunksize=chunksize):
+                summary = summarise_usage_file(self.usage, chunksize=chunksize)
+                self.assertEqual(summary.loc["07700900001", "Daily Rate Roaming"], 2 * USAGE_UNITS)
+                self.assertEqual(summary.loc["07700900001", "EU Daily Roaming Charges"], 1)
+                self.assertEqual(summary.loc["07700900002", "Roaming Calls"], USAGE_UNITS // 2)
+
+    def test_unmapped_category_is_other(self):
+        usage = self.write("other.csv", "Service,Usage Category,Cost\n07700900003,Something New,1.25\n")
+        summary = summarise_usage_file(usage)
+        self.assertEqual(summary.loc["07700900003", "Other"], 125 * USAGE_UNITS // 100)
+
+
+class IslestarFixedChargesTests(TempDirMixin, SimpleTestCase):
+    """
+    Fixed Charges with a thousands separator are charged in full (before user-024
+    they failed to parse and were billed as £0.00).
+    """
+
+    def test_thousands_separator(self):
+        services = self.write("services.csv", "Service,Name,Cost Centre,Fixed Charges\n"
+                                                "1002060,Shared Data Tariff,Holdings,\" 1,300.00\"\n"
+                                                "07700900001,A User,Holdings,\" 12.54\"\n"
+                                                "07700900002,Spare,Holdings,\n")
+        services_df = load_service_breakdown(services)
+        self.assertEqual(services_df["Fixed Charges"].tolist(), [130000, 1254, 0])
+
+        report = build_billing_report(services_df, None)
+        self.assertEqual(report["Fixed Charges"].tolist(), ["£1,300.00", "£12.54", "£0.00"])
+        self.assertEqual(report["Total"].tolist(), ["£1,300.00", "£12.54", "£0.00"])
+
+
+class PipelineTests(TempDirMixin, SimpleTestCase):
+    """
+    Stage results are only kept when a cache directory is given, and a result
+    deleted from it is recomputed rather than failing the run.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+    def double(self, value):
+        self.calls.append(value)
+        return value * 2
+
+    def test_no_cache_dir_by_default(self):
+        self.assertIsNone(Pipeline("test").cache_dir)
+
+    def test_sources_not_hashed_without_cache(self):
+        run = Pipeline("test")
+        source = run.source(self.write("input.csv", "a,b\n"))
+        with mock.patch.object(pipeline, "file_sha256") as file_sha256:
+            self.assertEqual(run.stage("read", lambda path: path, source).value, source.path)
+        file_sha256.assert_not_called()
+
+    def test_reuses_stored_stage(self):
+        stages = os.path.join(self.tmp, "stages")
+        self.assertEqual(Pipeline("test", stages).stage("double", self.double, 21).value, 42)
+        self.assertEqual(Pipeline("test", stages).stage("double", self.double, 21).value, 42)
+        self.assertEqual(self.calls, [21])
+
+    def test_recomputes_deleted_stage(self):
+        stages = os.path.join(self.tmp, "stages")
+        run = Pipeline("test", stages)
+        run.stage("double", self.double, 21)
+        for name in os.listdir(stages):
+            os.remove(os.path.join(stages, name))
+        self.assertEqual(run.stage("double", self.double, 21).value, 42)
+        self.assertEqual(self.calls, [21, 21])
+
+    def test_prune_keeps_most_recently_used_within_size_limit(self):
+        stages = os.path.join(self.tmp, "stages")
+        run = Pipeline("test", stages)
+        for i in range(3):
+            run.stage("double", self.double, i)
+        paths = sorted((os.path.join(stages, name) for name in os.listdir(stages)), key=os.path.getmtime)
+        for age, path in enumerate(reversed(paths)):
+            os.utime(path, (os.path.getmtime(path) - age, os.path.getmtime(path) - age))
+
+        sizes = [os.path.getsize(path) for path in paths]
+        with mock.patch.object(pipeline, "STAGE_MAX_BYTES", sizes[-1]):
+            Pipeline("test", stages)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True])
+
+
+class ReportPeriodCacheKeyTests(SimpleTestCase):
+    """
+    ConvaTec reports show the billing period of the run date, so a cached report
+    must not be served in a later month.
+    """
+
+    def key(self, client):
+        return cache_key(client, {"usage_file": "abc"}, {}, period=report_tasks.report_period(client))
+
+    def test_dated_reports_are_keyed_by_period(self):
+        for client in ("ConvaTec UK", "ConvaTec iPad"):
+            with self.subTest(client=client):
+                with mock.patch.dict(report_tasks.DATED_REPORTS, {client: lambda: ("Oct-26", "")}):
+                    october = self.key(client)
+                with mock.patch.dict(report_tasks.DATED_REPORTS, {client: lambda: ("Nov-26", "")}):
+                    november = self.key(client)
+                self.assertNotEqual(october, november)
+
+    def test_undated_reports_have_no_period(self):
+        self.assertIsNone(report_tasks.report_period("Tysers"))
+        self.assertEqual(self.key("Tysers"), cache_key("Tysers", {"usage_file": "abc"}, {}))
+
+
+class CellXmlTests(SimpleTestCase):
+    """
+    numpy scalars are written as the cell types of their Python equivalents.
+    """
+
+    def test_numpy_bool_is_boolean_cell(self):
+        for value in (True, np.bool_(True)):
+            with self.subTest(value=type(value)):
+                self.assertEqual(_cell_xml("A1", value, None), '<c r="A1" t="b"><v>1</v></c>')
+
+    def test_numpy_float32_keeps_fraction(self):
+        self.assertEqual(_cell_xml("A1", np.float32(1.5), None), '<c r="A1"><v>1.5</v></c>')
+        self.assertEqual(_cell_xml("A1", np.float32("nan"), None), "")
+
+
+class WorkbookAssemblerTests(TempDirMixin, SimpleTestCase):
+    """
+    The stitched package opens in openpyxl with the sheets, values and styles queued.
+    """
+
+    def test_saved_workbook_loads(self):
+        assembler = WorkbookAssembler(processes=2)
+        df = pd.DataFrame({"Name": ["Ann", " Bob ", None], "Amount": [1.5, np.nan, 3.0],
+                           "Count": np.array([1, 2, 3], dtype=np.int64), "Flag": [np.bool_(True), False, True]})
+        assembler.add_sheet("Data", df, list(df.columns), number_formats={2: "0"})
+        self.assertEqual(assembler.add_sheet("Data", None, ["Only", "Header"], header_styled=False), "Data1")
+
+        path = os.path.join(self.tmp, "assembled.xlsx")
+        assembler.save(path)
+        workbook = openpyxl.load_workbook(path)
+        self.assertEqual(workbook.sheetnames, ["Data", "Data1"])
+
+        data = workbook["Data"]
+        self.assertEqual([list(row) for row in data.iter_rows(values_only=True)], [
+            ["Name", "Amount", "Count", "Flag"],
+            ["Ann", 1.5, 1, True],
+            [" Bob ", None, 2, False],
+            [None, 3, 3, True],
+        ])
+        self.assertTrue(data["A1"].font.b)
+        self.assertEqual(data["C2"].number_format, "0")
+        self.assertIs(data["D2"].value, True)
+
+        header_only = workbook["Data1"]
+        self.assertEqual(list(header_only.iter_rows(values_only=True)), [("Only", "Header")])
+        self.assertFalse(header_only["A1"].font.b)
+
+
+class MoneyTests(SimpleTestCase):
+    """
+    Fixed-point money: amounts are whole units and ties round away from zero.
+    """
+
+    def test_parse_money(self):
+        values = pd.Series(["£1,942.00", " 12.71", "-0.005", "n/a", None])
+        self.assertEqual(parse_money(values).tolist(), [194200, 1271, -1, pd.NA, pd.NA])
+        self.assertEqual(parse_money(pd.Series([0.1 + 0.2, 12.71])).tolist(), [30, 1271])
+        self.assertEqual(parse_money(pd.Series(["0.00015"]), USAGE_UNITS).tolist(), [2])
+
+    def test_money(self):
+        self.assertEqual(money("£3.50"), 350)
+        self.assertEqual(money("unknown"), 0)
+
+    def test_apply_ratio(self):
+        pence = pd.Series([1001, 5, -5, 0])
+        self.assertEqual(apply_ratio(pence, 200, 1000).tolist(), [200, 1, -1, 0])
+        self.assertEqual(apply_ratio(pence, 1, 2).tolist(), [501, 3, -3, 0])
+
+    def test_round_to_pence(self):
+        self.assertEqual(round_to_pence(pd.Series([149, 150, -150])).tolist(), [1, 2, -2])
+
+    def test_format_pounds(self):
+        pence = pd.Series([123456, -5, pd.NA], dtype="Int64")
+        self.assertEqual(format_pounds(pence, symbol="£", thousands=True).tolist(), ["£1,234.56", "£-0.05", ""])
+        self.assertEqual(format_pounds(pence, missing="0.00").tolist(), ["1234.56", "-0.05", "0.00"])
+
+
+class CostCubeTests(SimpleTestCase):
+    """
+    build_cost_cube gives the same sums and counts as a groupby on the same keys.
+    """
+
+    def setUp(self):
+        self.service = pd.Series(["b", "a", "a", None, "a", "b"])
+        self.category = pd.Series(["x", "y", "x", "x", "z", None])
+
+    def groupby(self, cost, agg):
+        df = pd.DataFrame({"Service": self.service, "Category": self.category, "Cost": cost})
+        return df.groupby(["Service", "Category"])["Cost"].agg(agg).unstack(fill_value=0)
+
+    def test_matches_groupby(self):
+        cost = pd.Series([100, 250, 75, 999, 5, 999], dtype="int64")
+        sums, counts = build_cost_cube(self.service, self.category, cost)
+        self.assertEqual(sums.to_dict(), self.groupby(cost, "sum").to_dict())
+        self.assertEqual(counts.to_dict(), self.groupby(cost, "count").to_dict())
+        self.assertEqual(sums.dtypes.unique().tolist(), [np.int64])
+
+    def test_fixed_categories(self):
+        cost = pd.Series([100, 250, 75, 999, 5, 999], dtype="int64")
+        sums, counts = build_cost_cube(self.service, self.category, cost, categories=["y", "x"])
+        self.assertEqual(sums.columns.tolist(), ["y", "x"])
+        self.assertEqual(sums.loc["a"].tolist(), [250, 75])
+        self.assertEqual(counts.loc["b"].tolist(), [0, 1])
+
+    def test_integer_sums_are_exact(self):
+        service, category = pd.Series(["a", "a"]), pd.Series(["x", "x"])
+        sums, _ = build_cost_cube(service, category, pd.Series([2 ** 53, 1], dtype="Int64"))
+        self.assertEqual(sums.loc["a", "x"], 2 ** 53 + 1)
+
+    def test_float_cost(self):
+        cost = pd.Series([1.5, 2.25, 0.75, 9.0, 0.5, 9.0])
+        sums, _ = build_cost_cube(self.service, self.category, cost)
+        self.assertEqual(sums.loc["a"].tolist(), [0.75, 2.25, 0.5])
+        self.assertEqual(sums.dtypes.unique().tolist(), [np.float64])
+
+
+class CacheKeyTests(SimpleTestCase):
+    """
+    A report's cache key changes with anything that changes the report, and nothing else.
+    """
+
+    def setUp(self):
+        self.key = cache_key("Tysers", {"usage_file": "abc", "service_file": "def"}, {"pre_tax_amount": 1000})
+
+    def test_stable(self):
+        self.assertEqual(self.key, cache_key("Tysers", {"service_file": "def", "usage_file": "abc"},
+                                             {"pre_tax_amount": 1000}))
+
+    def test_changes_with_each_part(self):
+        others = [
+            cache_key("Islestarr", {"usage_file": "abc", "service_file": "def"}, {"pre_tax_amount": 1000}),
+            cache_key("Tysers", {"usage_file": "abc", "service_file": "xyz"}, {"pre_tax_amount": 1000}),
+            cache_key("Tysers", {"usage_file": "abc", "service_file": "def"}, {"pre_tax_amount": 2000}),
+            cache_key("Tysers", {"usage_file": "abc", "service_file": "def"}, {"pre_tax_amount": 1000},
+                      version="0"),
+            cache_key("Tysers", {"usage_file": "abc", "service_file": "def"}, {"pre_tax_amount": 1000},
+                      period="Oct-26"),
+        ]
+        self.assertEqual(len({self.key, *others}), len(others) + 1)
+
+
+class DiscoverInputsTests(TempDirMixin, SimpleTestCase):
+    """
+    billrun finds each client's inputs by file name.
+    """
+
+    def touch(self, *names):
+        for name in names:
+            self.write(os.path.join("client", name), "")
+        return os.path.join(self.tmp, "client")
+
+    def test_tysers(self):
+        directory = self.touch("USAGE_March.csv", "Services Breakdown.csv", "DataUsageSummary.csv", "notes.txt")
+        self.assertEqual(discover_inputs("Tysers", directory), {
+            "usage_file": os.path.join(directory, "USAGE_March.csv"),
+            "service_file": os.path.join(directory, "Services Breakdown.csv"),
+            "data_usage_file": os.path.join(directory, "DataUsageSummary.csv"),
+        })
+
+    def test_specific_patterns_first(self):
+        directory = self.touch("Project.csv", "Europe.csv", "Europe Services.csv")
+        self.assertEqual(discover_inputs("ConvaTec iPad", directory), {
+            "ipad_project_file": os.path.join(directory, "Project.csv"),
+            "ipad_europe_file": os.path.join(directory, "Europe.csv"),
+            "ipad_europe_services_file": os.path.join(directory, "Europe Services.csv"),
+        })
+
+    def test_missing_input(self):
+        directory = self.touch("USAGE.csv")
+        with self.assertRaisesMessage(CommandError, "service_file"):
+            discover_inputs("Islestarr", directory)
+
+    def test_ambiguous_input(self):
+        directory = self.touch("USAGE_1.csv", "USAGE_2.csv", "ServicesBreakdown.csv")
+        with self.assertRaisesMessage(CommandError, "more than one file"):
+            discover_inputs("Islestarr", directory)
+
+
+class CombineServiceBreakdownsTests(TempDirMixin, SimpleTestCase):
+    """
+    The merge gives the rows of all files in Service order; rows with the same
+    Service stay in file order, then export order, whatever the chunk size.
+    """
+
+    def test_merge(self):
+        limited = self.write("limited.csv", "Service,Name\n07b,L1\n 07a,L2\n07b,L3\n,L4\n07a,L5\n")
+        plc = self.write("plc.csv", "Service,Name,Extra\n07a,P1,x\n07c,P2,y\n07b,P3,z\n")
+        for chunksize in (1, 2, 100):
+            with self.subTest(chunksize=chunksize):
+                combined = combine_service_breakdowns([limited, plc], chunksize=chunksize)
+                self.assertEqual(combined["Name"].tolist(), ["L4", "L2", "L5", "P1", "L1", "L3", "P3", "P2"])
+                self.assertEqual(combined["Service"].fillna("").tolist(),
+                                 ["", "07a", "07a", "07a", "07b", "07b", "07b", "07c"])
+                self.assertEqual(combined["Extra"].fillna("").tolist(), ["", "", "", "x", "", "", "z", "y"])
+
+    def test_missing_service_column(self):
+        with self.assertRaisesMessage(ValueError, "no 'Service' column"):
+            combine_service_breakdowns([self.write("bad.csv", "Number,Name\n07a,A\n")])
+
+
+class ReportPoolTests(SimpleTestCase):
+    """
+    Workers are only recycled where ProcessPoolExecutor supports it (Python 3.11+).
+    """
+
+    def pool_options(self, version):
+        with mock.patch.object(report_pool.sys, "version_info", version), \
+                mock.patch.object(report_pool, "ProcessPoolExecutor") as executor:
+            report_pool.create_report_pool(2, max_jobs_per_worker=5)
+        return executor.call_args.kwargs
+
+    def test_recycles_workers_on_311(self):
+        self.assertEqual(self.pool_options((3, 11, 0))["max_tasks_per_child"], 5)
+
+    def test_no_recycling_before_311(self):
+        self.assertNotIn("max_tasks_per_child", self.pool_options((3, 10, 12)))
+
+    def test_runs_jobs(self):
+        with report_pool.create_report_pool(1) as pool:
+            self.assertEqual(pool.submit(abs, -3).result(), 3)
+
+
+class ConvaTecReportTests(TempDirMixin, SimpleTestCase):
+    """
+    The column-wise ConvaTec reports give the rows the old per-row loop gave
+    (expected values taken from the reports before user-011).
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.services = self.write("services.csv", "SERVICE_NO,TEMPLATE_NAME,CONTRACT_START_DATE,ADDITIONAL_FIELD_1\n"
+                                                   "07443772403,Red Extra,01/02/2024,CC1\n"
+                                                   "07510448324,Business Unl,,CC2\n")
+        self.breakdown = pd.DataFrame({
+            "Service": ["07443 772-403", "07510448324", "07000000000", "07999000111"],
+            "Name": ["Jason John", "Spare - was Bob", "spare", "Ann"],
+            "Cost Centre": ["ConvaTec Limited", " ConvaTec PLC ", "X", "Y"],
+            "Fixed Charges": [" 24.25", "1,024.50", "", " 0.10"],
+            "Usage Charges": [" 0.00", "12.5", "abc", "-3"],
+            "Data Usage": ["898.4MB", "1.5 GB", "n/a", "2048 KB"],
+        })
+        self.common = {
+            "Number": ["07443772403", "07510448324", "07000000000", "07999000111"],
+            "User": ["Jason John", "-  Bob", "", "Ann"],
+            "Spare?": ["", "TRUE", "TRUE", ""],
+            "Company": ["ConvaTec Limited", "ConvaTec PLC", "X", "Y"],
+            "Start/End Date": ["01/02/2024", "", "", ""],
+            "Line Rental": [24.25, 1024.5, 0.0, 0.1],
+            "Total Spend": [24.25, 1037.0, 0.0, -2.9],
+            "Data Used (GB)": [0.88, 1.5, "n/a", 0.0],
+        }
+
+    def report(self, module):
+        mappings = read_service_mappings(self.services, module.SERVICE_FIELDS)
+        return module.build_billing_report(self.breakdown, mappings).fillna("").to_dict("list")
+
+    def test_uk(self):
+        report = self.report(convatecuk_report)
+        self.assertEqual(list(report), convatecuk_report.REPORT_COLUMNS)
+        self.assertEqual(report, {**self.common,
+                                  "Tariff": ["Red Extra", "Business Unl", "Unknown", "Unknown"],
+                                  "Out of Bundle spend": [0.0, 12.5, 0.0, -3.0]})
+
+    def test_ipad(self):
+        report = self.report(convatec_ipad_report)
+        self.assertEqual(list(report), convatec_ipad_report.REPORT_COLUMNS)
+        self.assertEqual(report, {**self.common,
+                                  "Cost Centre": ["CC1", "CC2", "", ""],
+                                  "Notes": ["", "", "", ""],
+                                  "Tariff": [convatec_ipad_report.IPAD_TARIFF] * 4,
+                                  "Out of Bundle Spend": [0.0, 12.5, 0.0, -3.0]})
+
+
+class ReferenceStoreTests(TempDirMixin, SimpleTestCase):
+    """
+    A List of Services is only re-parsed when its content changes, and the
+    store doesn't depend on the working directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.store = reference_store.ReferenceStore(os.path.join(self.tmp, "db", "reference.sqlite3"),
+                                                    legacy_db_path=None)
+
+    def ingest(self, text):
+        return self.store.ingest("convatec_uk", self.write("services.csv", text),
+                                 partial(read_service_mappings, fields=convatecuk_report.SERVICE_FIELDS))
+
+    def test_versions(self):
+        self.assertFalse(self.store.has("convatec_uk"))
+        self.assertTrue(self.ingest("SERVICE_NO,TEMPLATE_NAME\n07700900001,Red\n"))
+        first = self.store.current_hash("convatec_uk")
+        self.assertFalse(self.ingest("SERVICE_NO,TEMPLATE_NAME\n07700900001,Red\n"))
+
+        self.assertTrue(self.ingest("SERVICE_NO,TEMPLATE_NAME\n07700900002,Blue\n"))
+        self.assertNotEqual(self.store.current_hash("convatec_uk"), first)
+        found = self.store.lookup("convatec_uk", ["07700900001", "07700900002", None], ["Tariff"])
+        self.assertEqual(found["Tariff"].to_dict(), {"07700900002": "Blue"})
+
+    def test_default_path_is_absolute(self):
+        self.assertTrue(os.path.isabs(reference_store.REFERENCE_DB_PATH))
+
+    def test_moves_legacy_tables(self):
+        self.ingest("SERVICE_NO,TEMPLATE_NAME\n07700900001,Red\n")
+        stored_hash = self.store.current_hash("convatec_uk")
+        moved = reference_store.ReferenceStore(os.path.join(self.tmp, "new.sqlite3"),
+                                               legacy_db_path=self.store.db_path)
+        self.assertEqual(moved.current_hash("convatec_uk"), stored_hash)
+        self.assertEqual(moved.lookup("convatec_uk", ["07700900001"], ["Tariff"])["Tariff"].tolist(), ["Red"])
+        with sqlite3.connect(self.store.db_path) as legacy:
+            tables = legacy.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        legacy.close()
+        self.assertEqual(tables, [])
+
+
+class HashingUploadHandlerTests(TempDirMixin, SimpleTestCase):
+    """
+    Uploads are written once, into TEMP_DIR, and hashed as they arrive.
+    """
+
+    def receive(self, chunks):
+        handler = HashingUploadHandler()
+        handler.new_file("usage_file", "USAGE.csv", "text/csv", None)
+        start = 0
+        for chunk in chunks:
+            handler.receive_data_chunk(chunk, start)
+            start += len(chunk)
+        return handler
+
+    def test_hashes_while_writing(self):
+        chunks = [b"Service,Cost\n", b"07700900001,1.25\n"]
+        with override_settings(TEMP_DIR=self.tmp):
+            upload = self.receive(chunks).file_complete(sum(map(len, chunks)))
+        upload.close()
+        self.assertEqual(upload.sha256, hashlib.sha256(b"".join(chunks)).hexdigest())
+        self.assertEqual(os.path.dirname(upload.temporary_file_path()), self.tmp)
+        with open(upload.temporary_file_path(), "rb") as f:
+            self.assertEqual(f.read(), b"".join(chunks))
+
+    def test_interrupted_upload_is_removed(self):
+        with override_settings(TEMP_DIR=self.tmp):
+            handler = self.receive([b"Service,Cost\n"])
+            handler.upload_interrupted()
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+class IcrLayoutTests(TempDirMixin, SimpleTestCase):
+    """
+    The per-user sheets and the drill-down layout cover the same usage, so they
+    total the same; rows with a blank UserName are in neither.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.usage = self.write("usage.csv", "Service,UserName,Usage Category,Cost\n"
+                                             "SA,Ann,Data UK,1.25\n"
+                                             "SA,,Data UK,7.00\n"
+                                             "SB,Bob,Roaming,2.50\n"
+                                             "SA,Ann,Data UK,0.75\n"
+                                             "SC,Cat,Data UK,9.99\n")
+        self.services = self.write("services.csv", "Service,Usage Charges\nSA,10.00\nSB,6.00\nSC,1.00\n")
+
+    def sheets(self, **options):
+        directory = tempfile.mkdtemp(dir=self.tmp)
+        path = process_icr_report(self.services, self.usage, "ICR", output_dir=directory, **options)
+        return pd.read_excel(path, sheet_name=None)
+
+    def test_layouts_total_the_same(self):
+        per_user = self.sheets()
+        self.assertEqual(sorted(per_user), ["ICR Bill Summary", "SA - Ann", "SA - nan", "SB - Bob"])
+        self.assertEqual(len(per_user["SA - nan"]), 0)
+        per_user_total = sum(sheet["Cost"].sum() for name, sheet in per_user.items() if name != "ICR Bill Summary")
+
+        drilldown = self.sheets(drilldown=True)
+        detail, contents = drilldown["Usage Detail"], drilldown["Contents"]
+        self.assertEqual(detail["UserName"].tolist(), ["Ann", "Ann", "Bob"])
+        self.assertAlmostEqual(detail["Cost"].sum(), per_user_total)
+        self.assertAlmostEqual(contents["Subtotal"].sum(), per_user_total)
+        self.assertAlmostEqual(per_user_total, 4.50)
+
+    def assertSameSheets(self, sheets, expected):
+        self.assertEqual(list(sheets), list(expected))
+        for name, sheet in expected.items():
+            pd.testing.assert_frame_equal(sheets[name], sheet, obj=name)
+
+    def test_parallel_matches_default(self):
+        for drilldown in (False, True):
+            with self.subTest(drilldown=drilldown):
+                self.assertSameSheets(self.sheets(drilldown=drilldown, processes=2),
+                                      self.sheets(drilldown=drilldown))
+
+    def test_streaming_matches_default(self):
+        for drilldown in (False, True):
+            with self.subTest(drilldown=drilldown):
+                self.assertSameSheets(self.sheets(drilldown=drilldown, streaming=True),
+                                      self.sheets(drilldown=drilldown))
+
+
+class IslestarRoundingTests(TempDirMixin, SimpleTestCase):
+    """
+    Each amount is summed exactly and rounded half up to the penny once, and the
+    Total is the sum of the rounded amounts shown beside it. Before user-024 the
+    amounts were float sums formatted with :.2f, which showed the first line as
+    "£0.12", "£1.00" and a Total of "£11.13", and the second as "£2.67".
+    """
+
+    def test_half_pennies_round_up(self):
+        services = self.write("services.csv", "Service,Name,Cost Centre,Fixed Charges\n"
+                                                "07700900001,Ann,Ops,10.00\n"
+                                                "07700900002,Bob,Ops,0.10\n")
+        usage = self.write("usage.csv", "Service,Usage Category,Cost\n"
+                                          "07700900001,Data UK,1.005\n"
+                                          "07700900001,Roam Call MO,0.125\n"
+                                          "07700900002,Data UK,0.1\n"
+                                          "07700900002,Data UK,0.2\n"
+                                          "07700900002,Roam Call MO,2.675\n")
+        report = build_billing_report(load_service_breakdown(services), summarise_usage_file(usage))
+        self.assertEqual(report["Roaming Calls"].tolist(), ["£0.13", "£2.68"])
+        self.assertEqual(report["Other Charges"].tolist(), ["£1.01", "£0.30"])
+        self.assertEqual(report["Total"].tolist(), ["£11.14", "£3.08"])
+
+
+class KfShardingTests(TempDirMixin, SimpleTestCase):
+    """
+    Call detail that doesn't fit in one sheet carries on in "KF Report (2)" and so on.
+    """
+
+    def calls(self, rows):
+        return pd.DataFrame({column: [f"{column} {i}" for i in range(rows)] for column in DESIRED_COLUMNS})
+
+    def test_shards_at_row_limit(self):
+        df = self.calls(5)
+        for processes in (None, 2):
+            with self.subTest(processes=processes):
+                path = os.path.join(self.tmp, f"kf-{processes}.xlsx")
+                write_kf_workbook(df, path, max_rows=3, processes=processes)
+                sheets = pd.read_excel(path, sheet_name=None, dtype=str)
+                self.assertEqual(list(sheets), ["KF Report", "KF Report (2)", "KF Report (3)"])
+                self.assertEqual([len(sheet) for sheet in sheets.values()], [2, 2, 1])
+                pd.testing.assert_frame_equal(pd.concat(sheets.values(), ignore_index=True), df)
+
+    def test_exactly_full_sheet(self):
+        path = os.path.join(self.tmp, "kf.xlsx")
+        write_kf_workbook(self.calls(2), path, max_rows=3)
+        self.assertEqual(list(pd.read_excel(path, sheet_name=None)), ["KF Report"])
+
+    def test_no_calls(self):
+        path = os.path.join(self.tmp, "kf.xlsx")
+        write_kf_workbook(self.calls(0), path, max_rows=3)
+        sheets = pd.read_excel(path, sheet_name=None)
+        self.assertEqual(list(sheets), ["KF Report"])
+        self.assertEqual(list(sheets["KF Report"].columns), DESIRED_COLUMNS)
+
+
+class PartitionUsageTests(SimpleTestCase):
+    """
+    partition_usage sorts once and gives each Service/User group as a row range.
+    """
+
+    def test_groups(self):
+        usage = pd.DataFrame({
+            "Service": ["S2", "S1", "S2", "S1", "S2", "S1"],
+            "UserName": ["Bob", "Ann", None, "Ann", "Bob", "Cat"],
+            "Row": range(6),
+        })
+        for dtype in (object, "category"):
+            with self.subTest(dtype=dtype):
+                sorted_usage, groups = partition_usage(usage.astype({"Service": dtype, "UserName": dtype}),
+                                                       ["Service", "UserName"])
+                keys = [key for key, _, _ in groups]
+                self.assertEqual(keys[:2], [("S2", "Bob"), ("S1", "Ann")])
+                self.assertEqual(keys[2][0], "S2")
+                self.assertTrue(pd.isna(keys[2][1]))
+                self.assertEqual(keys[3], ("S1", "Cat"))
+                rows = [sorted_usage["Row"].iloc[start:stop].tolist() for _, start, stop in groups]
+                self.assertEqual(rows, [[0, 4], [1, 3], [2], [5]])
+                self.assertEqual(groups[-1][2], len(usage))
+
+
+class JobManagerMixin(TempDirMixin):
+    """
+    Serves the views from a JobManager of its own, with one worker and the
+    uploads and workspaces in the scratch directory.
+    """
+
+    USAGE = ("Service,UserName,Usage Type,DialledNumber,Cost\n"
+             "07700900001,Ann,Voice,441632960001,0.25\n"
+             "07700900001,Ann,Data,,1.00\n"
+             "07700900002,Bob,Voice,441632960002,0.50\n")
+    CALLS = "Service,Custom 1\n07700900001,101\n07700900002,102\n"
+
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(TEMP_DIR=self.tmp)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.manager = JobManager(workers=1, retention=60, workspace_dir=os.path.join(self.tmp, "runs"))
+        self.addCleanup(self.manager._pool.shutdown)
+        patcher = mock.patch.object(views, "get_job_manager", return_value=self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, name, text):
+        return SimpleUploadedFile(name, text.encode(), content_type="text/csv")
+
+
+class JobViewTests(JobManagerMixin, SimpleTestCase):
+    """
+    A report submitted to /jobs/ runs in the background, is polled until it is
+    done and is then downloaded.
+    """
+
+    def wait(self, status_url):
+        deadline = time.monotonic() + 60
+        while True:
+            status = self.client.get(status_url).json()
+            if status["status"] not in (QUEUED, RUNNING) or time.monotonic() > deadline:
+                return status
+            time.sleep(0.05)
+
+    def test_submit_poll_download(self):
+        response = self.client.post("/jobs/", {
+            "client": "Knight Frank", "output_format": "csv.gz",
+            "usage_file": self.upload("usage.csv", self.USAGE), "service_file": self.upload("calls.csv", self.CALLS),
+        })
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual(job["client"], "Knight Frank")
+
+        self.assertEqual(self.wait(job["status_url"])["status"], DONE)
+        download = self.client.get(job["download_url"])
+        self.assertEqual(download.status_code, 200)
+        self.assertIn(f'{views.bill_run_name()}_Knight Frank.csv.gz', download["Content-Disposition"])
+        with tempfile.TemporaryFile() as report:
+            report.write(b"".join(download.streaming_content))
+            report.seek(0)
+            rows = pd.read_csv(report, compression="gzip")
+        self.assertEqual(rows["Service"].tolist(), [7700900001, 7700900002])
+        self.assertEqual(rows["Custom 1"].tolist(), [101, 102])
+
+        # The uploads were moved into the job's workspace and deleted once it finished
+        self.assertEqual(sorted(os.listdir(self.tmp)), ["runs"])
+
+    def test_failed_job(self):
+        response = self.client.post("/jobs/", {
+            "client": "Knight Frank",
+            "usage_file": self.upload("usage.csv", self.USAGE), "service_file": self.upload("calls.csv", "Service\n"),
+        })
+        job = response.json()
+        status = self.wait(job["status_url"])
+        self.assertEqual(status["status"], FAILED)
+        self.assertIn("Custom 1", status["error"])
+        self.assertEqual(self.client.get(job["download_url"]).status_code, 409)
+
+    def test_missing_upload_and_unknown_job(self):
+        response = self.client.post("/jobs/", {"client": "Knight Frank",
+                                               "usage_file": self.upload("usage.csv", self.USAGE)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Please upload both files")
+        self.assertEqual(os.listdir(self.tmp), [])
+        self.assertEqual(self.client.get("/jobs/0123/").status_code, 404)
+        self.assertEqual(self.client.get("/jobs/0123/download/").status_code, 404)
+
+
+class BatchViewTests(JobManagerMixin, SimpleTestCase):
+    """
+    /batch/ streams back a zip of every client's report, listing the clients
+    whose report failed in errors.txt.
+    """
+
+    def post(self, files):
+        return self.client.post("/batch/", {
+            f"{views.batch_prefix(client)}{field}": upload for (client, field), upload in files.items()
+        })
+
+    def test_zip_of_reports(self):
+        icr = "Institute of Cancer Research"
+        response = self.post({
+            ("Knight Frank", "usage_file"): self.upload("usage.csv", self.USAGE),
+            ("Knight Frank", "service_file"): self.upload("calls.csv", self.CALLS),
+            (icr, "usage_file"): self.upload("usage.csv", self.USAGE),
+            (icr, "service_file"): self.upload("services.csv", "Service,Cost Centre\n07700900001,Ops\n"),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertIn(f'filename="{views.bill_run_name()}.zip"', response["Content-Disposition"])
+
+        content = b"".join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(sorted(archive.namelist()), [f"{views.bill_run_name()}_Knight Frank.xlsx", "errors.txt"])
+            with archive.open(f"{views.bill_run_name()}_Knight Frank.xlsx") as report:
+                rows = pd.read_excel(io.BytesIO(report.read()))
+            errors = archive.read("errors.txt").decode()
+        self.assertEqual(rows["Custom 1"].tolist(), [101, 102])
+        self.assertTrue(errors.startswith(f"{icr}: "))
+        self.assertEqual(len(errors.splitlines()), 1)
+
+    def test_incomplete_client_runs_nothing(self):
+        response = self.post({
+            ("Knight Frank", "usage_file"): self.upload("usage.csv", self.USAGE),
+            ("Knight Frank", "service_file"): self.upload("calls.csv", self.CALLS),
+            ("Tysers", "usage_file"): self.upload("usage.csv", self.USAGE),
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Tysers: Please upload all required files")
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_no_clients(self):
+        response = self.post({})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Please upload the files for at least one client")
+
+
+class RunWorkspaceTests(TempDirMixin, SimpleTestCase):
+    """
+    Every run gets its own directory, so runs with same-named inputs don't collide.
+    """
+
+    def test_runs_are_isolated(self):
+        root = os.path.join(self.tmp, "runs")
+        workspaces = []
+        for text in ("first", "second"):
+            upload = self.write(os.path.join("uploads", "usage.csv"), text)
+            workspace = RunWorkspace(root)
+            inputs = workspace.add_inputs({"usage_file": upload})
+            self.assertEqual(inputs, {"usage_file": os.path.join(workspace.input_dir, "usage.csv")})
+            self.assertFalse(os.path.exists(upload))
+            self.assertTrue(os.path.isdir(workspace.output_dir))
+            workspaces.append((workspace, inputs["usage_file"]))
+
+        for (workspace, path), text in zip(workspaces, ("first", "second")):
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+
+        workspaces[0][0].remove()
+        self.assertEqual(os.listdir(root), [os.path.basename(workspaces[1][0].path)])
+
+    def test_remove_stale_workspaces(self):
+        root = os.path.join(self.tmp, "runs")
+        stale, fresh = RunWorkspace(root), RunWorkspace(root)
+        other = os.path.join(root, "keep")
+        os.makedirs(other)
+        an_hour_ago = time.time() - 3600
+        for path in (stale.path, other):
+            os.utime(path, (an_hour_ago, an_hour_ago))
+
+        remove_stale_workspaces(root, max_age=60)
+        self.assertEqual(sorted(os.listdir(root)), sorted([os.path.basename(fresh.path), "keep"]))
+        remove_stale_workspaces(os.path.join(self.tmp, "missing"), max_age=60)
+
+
+class ReportSpoolTests(TempDirMixin, SimpleTestCase):
+    """
+    Reports stay in memory up to max_bytes and move to a temporary file past it.
+    """
+
+    def test_small_report_stays_in_memory(self):
+        spool = ReportSpool(max_bytes=16, spill_dir=self.tmp)
+        spool.write(b"0123456789")
+        spool.seek(0)
+        spool.write(b"ab")
+        report = spool.finish("report.xlsx")
+        self.assertFalse(spool.spilled)
+        self.assertEqual((report.data, report.path, report.size), (b"ab23456789", None, 10))
+        with report.open() as f:
+            self.assertEqual(f.read(), b"ab23456789")
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_large_report_spills(self):
+        spool = ReportSpool(max_bytes=16, spill_dir=self.tmp)
+        spool.write(b"0123456789")
+        spool.seek(2)
+        spool.write(b"ab")
+        spool.seek(0, os.SEEK_END)
+        spool.write(b"x" * 10)
+        self.assertTrue(spool.spilled)
+        self.assertEqual(os.path.dirname(spool.spill_path), self.tmp)
+        spool.seek(0)
+        self.assertEqual(spool.read(4), b"01ab")
+
+        report = spool.finish("report.xlsx")
+        self.assertIsNone(report.data)
+        with report.open() as f:
+            self.assertEqual(f.read(), b"01ab456789" + b"x" * 10)
+        saved = report.save(os.path.join(self.tmp, "saved.xlsx"))
+        with open(saved, "rb") as f:
+            self.assertEqual(f.read(), b"01ab456789" + b"x" * 10)
+
+        report.discard()
+        self.assertFalse(report.exists())
+        self.assertEqual(os.listdir(self.tmp), ["saved.xlsx"])
+
+    def test_discard_removes_spilled_file(self):
+        spool = ReportSpool(max_bytes=4, spill_dir=self.tmp)
+        spool.write(b"0123456789")
+        spool.discard()
+        self.assertTrue(spool.closed)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_workbook_written_to_spool(self):
+        df = pd.DataFrame([["07700900001", 441632960001]], columns=["Service", "DialledNumber"])
+        df = df.reindex(columns=DESIRED_COLUMNS)
+        for max_bytes in (1024 * 1024, 1024):
+            with self.subTest(max_bytes=max_bytes):
+                spool = ReportSpool(max_bytes=max_bytes, spill_dir=self.tmp)
+                write_kf_workbook(df, spool)
+                report = spool.finish("report.xlsx")
+                self.assertEqual(report.path is not None, max_bytes == 1024)
+                with report.open() as f:
+                    sheet = pd.read_excel(f)
+                self.assertEqual(sheet["DialledNumber"].tolist(), [441632960001])
+                report.discard()
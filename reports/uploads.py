@@ -0,0 +1,80 @@
+"""
+Upload handling for report inputs.
+
+Django's default handlers spool an upload to a temporary file, after which it
+was copied again into settings.TEMP_DIR. HashingUploadHandler instead writes
+each upload straight into TEMP_DIR as it arrives and computes its SHA-256 on
+the same pass, so the file is written once and the report cache doesn't have
+to read it back to key the run.
+
+The uploads are not parsed here. The generators run in the worker pool
+(report_pool.py), not in the web process. Each one streams the usage file in
+bounded chunks and reads only the columns it needs. The handler can't know
+those columns, because the client field may arrive after the files.
+Parsing while receiving would therefore mean holding a fully parsed export in
+the web process and pickling it across to a worker. That uses more memory and
+gains nothing over the worker reading the file itself.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashedUploadedFile(UploadedFile):
+    """
+    An upload already stored at its final path in settings.TEMP_DIR, with its content hash.
+    The file is kept after the request; whoever runs the report deletes it.
+    """
+
+    def __init__(self, file, name, content_type, size, charset, sha256, content_type_extra=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = sha256
+
+    def temporary_file_path(self) -> str:
+        return self.file.name
+
+    def close(self):
+        # Closing the handle leaves the file on disk
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            pass
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Writes every uploaded file to settings.TEMP_DIR, hashing it chunk by chunk.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        os.makedirs(settings.TEMP_DIR, exist_ok=True)
+        prefix = self.field_name[:-len('_file')] if self.field_name.endswith('_file') else self.field_name
+        self.file = tempfile.NamedTemporaryFile(dir=settings.TEMP_DIR, prefix=f"{prefix}_", suffix='.csv',
+                                                delete=False)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.hash.update(raw_data)
+        self.size += len(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.flush()
+        self.file.seek(0)
+        uploaded = HashedUploadedFile(self.file, self.file_name, self.content_type, file_size, self.charset,
+                                      self.hash.hexdigest(), self.content_type_extra)
+        self.file = None
+        return uploaded
+
+    def upload_interrupted(self):
+        # The client went away part way through; don't leave the partial file behind
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)
+            self.file = None
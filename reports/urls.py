@@ -7,4 +7,8 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('generate_report/', views.generate_report, name='generate_report'),
     path('open_report/', views.open_report, name='open_report'),
+    path('batch/', views.batch_report, name='batch_report'),
+    path('jobs/', views.submit_report, name='submit_report'),
+    path('jobs/<str:job_id>/', views.report_status, name='report_status'),
+    path('jobs/<str:job_id>/download/', views.download_report, name='download_report'),
 ]
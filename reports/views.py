@@ -1,27 +1,18 @@
 import os
-import time
 import platform
-import tempfile
 import subprocess
-from pathlib import Path
 import pandas as pd
-from django.shortcuts import render, redirect
-from django.http import HttpResponse, JsonResponse, FileResponse
-from django.conf import settings
+from django.shortcuts import render
+from django.http import JsonResponse, FileResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils.text import slugify
 
 # Import report processing modules
-from Islestar_report import process_billing_data
-from tysers_reports import create_tysers_report
-from kf_reports import process_kf_report
-from icr_report import process_icr_report
-from convatecuk_report import process_and_combine_csv as process_and_combine_csv_uk
-from convatecuk_report import generate_billing_report as generate_billing_report_uk
-from convatecuk_report import ensure_directories_exist as ensure_directories_exist_uk
-from convatec_ipad_report import process_and_combine_csv as process_and_combine_csv_ipad
-from convatec_ipad_report import generate_billing_report as generate_billing_report_ipad
-from convatec_ipad_report import ensure_directories_exist as ensure_directories_exist_ipad
+from reference_store import ReferenceStore
+from report_tasks import REQUIRED_INPUTS, optional_inputs, required_inputs
+from .batch import stream_report_zip
+from .jobs import DONE, get_job_manager, remove_files
 
 # List of supported clients
 CLIENTS = [
@@ -34,8 +25,8 @@ CLIENTS = [
     'Institute of Cancer Research'
 ]
 
-# Store the path of the most recently generated report
-last_report_path = None
+# Session key holding the id of the job whose report "Open Report" opens
+LAST_REPORT_SESSION_KEY = 'last_report_job'
 
 def index(request):
     """
@@ -43,13 +34,119 @@ def index(request):
     """
     return render(request, 'index.html', {'clients': CLIENTS})
 
+def remove_uploads(request, keep=()):
+    """
+    Close every file uploaded with the request and delete those not in 'keep'.
+    The generators open the kept files by path, so the upload handles aren't needed.
+    """
+    keep = set(keep)
+    for _, field_uploads in request.FILES.lists():
+        for upload in field_uploads:
+            upload.close()
+            if upload.temporary_file_path() not in keep:
+                remove_files([upload.temporary_file_path()])
+
+
+def report_inputs(request, client, prefix=''):
+    """
+    Collect the uploads and parameters of one client's report from the request.
+    HashingUploadHandler has already written the uploads to settings.TEMP_DIR and
+    hashed them while they were received. Field names are looked up with 'prefix'
+    in front (see batch_report).
+
+    Returns:
+        Tuple of (input paths keyed by upload field name, report parameters, content
+        hash of each input)
+
+    Raises:
+        ValueError: If a file is missing or a parameter is invalid
+    """
+    references = optional_inputs(client)
+    fields = [*required_inputs(client), *references]
+    uploads = {field: request.FILES[prefix + field] for field in fields if prefix + field in request.FILES}
+
+    if any(field not in uploads for field in required_inputs(client)):
+        raise ValueError('Please upload all required files' if client in REQUIRED_INPUTS else 'Please upload both files')
+
+    # List of services files can be left out when a stored version is already loaded
+    if references:
+        reference_store = ReferenceStore()
+        if any(field not in uploads and not reference_store.has(reference)
+               for field, reference in references.items()):
+            raise ValueError('Please upload the List of Services file' if len(references) == 1
+                             else 'Please upload both list of services files')
+
+    inputs = {field: upload.temporary_file_path() for field, upload in uploads.items()}
+    hashes = {field: upload.sha256 for field, upload in uploads.items()}
+
+    params = {}
+    if client == 'Tysers':
+        # Get pre-tax and total tax amounts
+        params['pre_tax_amount'] = float(request.POST.get(prefix + 'pre_tax_amount', 0))
+        params['total_tax_amount'] = float(request.POST.get(prefix + 'total_tax_amount', 0))
+    elif client == 'Knight Frank':
+        params['output_format'] = request.POST.get(prefix + 'output_format', 'xlsx')
+    elif client == 'Institute of Cancer Research':
+        params['drilldown'] = request.POST.get(prefix + 'icr_layout') == 'drilldown'
+
+    return inputs, params, hashes
+
+
+def save_report_inputs(request, client):
+    """
+    Validate the uploads for a client, keeping only the files its report uses.
+
+    Returns:
+        Tuple of (input paths keyed by upload field name, report parameters, content
+        hash of each input), or a JsonResponse describing what is missing
+    """
+    try:
+        inputs, params, hashes = report_inputs(request, client)
+    except ValueError as e:
+        remove_uploads(request)
+        return JsonResponse({'error': str(e)}, status=400)
+
+    remove_uploads(request, keep=inputs.values())
+    return inputs, params, hashes
+
+
+def bypass_cache(request):
+    """
+    True when the form asks to regenerate the report rather than reuse a cached copy.
+    """
+    return request.POST.get('bypass_cache', '').lower() in ('1', 'true', 'on', 'yes')
+
+
+def bill_run_name():
+    """
+    "<Month>_<Year>_Bill_Run" for the previous month, the prefix of every download.
+    """
+    prev_month = (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime('%B')
+    current_year = pd.Timestamp.now().year
+    return f"{prev_month}_{current_year}_Bill_Run"
+
+
+def report_filename(client, report):
+    """
+    Download name of a client's report (a report_output.ReportOutput).
+    """
+    extension = '.csv.gz' if report.name.endswith('.csv.gz') else '.xlsx'
+    return f"{bill_run_name()}_{client}{extension}"
+
+
+def report_response(client, report):
+    """
+    Stream a generated report (a report_output.ReportOutput) as a download named after the bill run.
+    """
+    return FileResponse(report.open(), as_attachment=True, filename=report_filename(client, report))
+
+
 @csrf_exempt
 def generate_report(request):
     """
     Handle report generation based on uploaded files and selected client.
+    The response waits for the report; see submit_report for the background version.
     """
-    global last_report_path
-    
     if request.method != 'POST':
         return JsonResponse({'error': 'Only POST method is allowed'}, status=405)
     
@@ -58,250 +155,137 @@ def generate_report(request):
         return JsonResponse({'error': 'Client selection is required'}, status=400)
     
     try:
-        # Create temp directory if it doesn't exist
-        temp_dir = settings.TEMP_DIR
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Generate timestamp for unique filenames
-        timestamp = int(time.time())
-        
-        if client == 'Tysers':
-            # Handle Tysers specific case with 3 files
-            if ('usage_file' not in request.FILES or 
-                'service_file' not in request.FILES or 
-                'data_usage_file' not in request.FILES):
-                return JsonResponse({'error': 'Please upload all required files'}, status=400)
-
-            usage_file = request.FILES['usage_file']
-            service_file = request.FILES['service_file']
-            data_usage_file = request.FILES['data_usage_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            usage_path = fs.save(f"usage_{client}.csv", usage_file)
-            service_path = fs.save(f"service_breakdown_{client}.csv", service_file)
-            data_usage_path = fs.save(f"data_usage_{client}.csv", data_usage_file)
-            
-            usage_path = os.path.join(temp_dir, usage_path)
-            service_path = os.path.join(temp_dir, service_path)
-            data_usage_path = os.path.join(temp_dir, data_usage_path)
-
-            # Get pre-tax and total tax amounts
-            pre_tax_amount = float(request.POST.get('pre_tax_amount', 0))
-            total_tax_amount = float(request.POST.get('total_tax_amount', 0))
-
-            try:
-                output_path = create_tysers_report(
-                    service_path, 
-                    data_usage_path,
-                    usage_path, 
-                    client,
-                    pre_tax_amount=pre_tax_amount,
-                    total_tax_amount=total_tax_amount
-                )
-            finally:
-                # Clean up temporary files
-                for path in [usage_path, service_path, data_usage_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-
-        elif client == 'Knight Frank':
-            # Handle Knight Frank case with 2 files
-            if 'usage_file' not in request.FILES or 'service_file' not in request.FILES:
-                return JsonResponse({'error': 'Please upload both files'}, status=400)
-
-            usage_file = request.FILES['usage_file']
-            service_file = request.FILES['service_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            usage_path = fs.save(f"usage_{client}.csv", usage_file)
-            service_path = fs.save(f"service_breakdown_{client}.csv", service_file)
-            
-            usage_path = os.path.join(temp_dir, usage_path)
-            service_path = os.path.join(temp_dir, service_path)
-
-            try:
-                # Note: The original large usage file has been removed
-                # This function will now expect the user to upload the usage file
-                output_path = process_kf_report(usage_path, service_path, client)
-            finally:
-                # Clean up temporary files
-                for path in [usage_path, service_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-
-        elif client == 'Institute of Cancer Research':
-            # Handle ICR case with 2 files
-            if 'usage_file' not in request.FILES or 'service_file' not in request.FILES:
-                return JsonResponse({'error': 'Please upload both files'}, status=400)
-
-            usage_file = request.FILES['usage_file']
-            service_file = request.FILES['service_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            usage_path = fs.save(f"usage_{client}.csv", usage_file)
-            service_path = fs.save(f"service_breakdown_{client}.csv", service_file)
-            
-            usage_path = os.path.join(temp_dir, usage_path)
-            service_path = os.path.join(temp_dir, service_path)
-
-            try:
-                output_path = process_icr_report(service_path, usage_path, client)
-            finally:
-                # Clean up temporary files
-                for path in [usage_path, service_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-                        
-        elif client == 'ConvaTec UK':
-            # Handle ConvaTec UK case with 3 files
-            if ('convatec_limited_file' not in request.FILES or 
-                'convatec_plc_file' not in request.FILES or 
-                'list_of_services_file' not in request.FILES):
-                return JsonResponse({'error': 'Please upload all required files'}, status=400)
-
-            convatec_limited_file = request.FILES['convatec_limited_file']
-            convatec_plc_file = request.FILES['convatec_plc_file']
-            list_of_services_file = request.FILES['list_of_services_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            convatec_limited_path = fs.save(f"convatec_limited_{timestamp}.csv", convatec_limited_file)
-            convatec_plc_path = fs.save(f"convatec_plc_{timestamp}.csv", convatec_plc_file)
-            list_of_services_path = fs.save(f"list_of_services_{timestamp}.csv", list_of_services_file)
-            
-            convatec_limited_path = os.path.join(temp_dir, convatec_limited_path)
-            convatec_plc_path = os.path.join(temp_dir, convatec_plc_path)
-            list_of_services_path = os.path.join(temp_dir, list_of_services_path)
-            
-            try:
-                # Ensure required directories exist
-                ensure_directories_exist_uk()
-                
-                # Create the data/input/convatec directory if it doesn't exist
-                os.makedirs(os.path.join("data", "input", "convatec"), exist_ok=True)
-                
-                # First combine the service breakdown files
-                combined_df = process_and_combine_csv_uk(convatec_limited_path, convatec_plc_path)
-                
-                # Save the list of services file to the expected location
-                list_services_dest = os.path.join("data", "input", "convatec", "reports__listOfServices.csv")
-                os.makedirs(os.path.dirname(list_services_dest), exist_ok=True)
-                with open(list_of_services_path, 'rb') as src_file, open(list_services_dest, 'wb') as dest_file:
-                    dest_file.write(src_file.read())
-                
-                # Generate the billing report
-                output_path = generate_billing_report_uk(combined_df)
-            finally:
-                # Clean up temporary files
-                for path in [convatec_limited_path, convatec_plc_path, list_of_services_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-                        
-        elif client == 'ConvaTec iPad':
-            # Handle ConvaTec iPad case with 4 files
-            if ('ipad_project_file' not in request.FILES or 
-                'ipad_europe_file' not in request.FILES or 
-                'ipad_europe_services_file' not in request.FILES or
-                'ipad_uk_services_file' not in request.FILES):
-                return JsonResponse({'error': 'Please upload all required files'}, status=400)
-
-            ipad_project_file = request.FILES['ipad_project_file']
-            ipad_europe_file = request.FILES['ipad_europe_file']
-            ipad_europe_services_file = request.FILES['ipad_europe_services_file']
-            ipad_uk_services_file = request.FILES['ipad_uk_services_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            ipad_project_path = fs.save(f"ipad_project_{timestamp}.csv", ipad_project_file)
-            ipad_europe_path = fs.save(f"ipad_europe_{timestamp}.csv", ipad_europe_file)
-            ipad_europe_services_path = fs.save(f"ipad_europe_services_{timestamp}.csv", ipad_europe_services_file)
-            ipad_uk_services_path = fs.save(f"ipad_uk_services_{timestamp}.csv", ipad_uk_services_file)
-            
-            ipad_project_path = os.path.join(temp_dir, ipad_project_path)
-            ipad_europe_path = os.path.join(temp_dir, ipad_europe_path)
-            ipad_europe_services_path = os.path.join(temp_dir, ipad_europe_services_path)
-            ipad_uk_services_path = os.path.join(temp_dir, ipad_uk_services_path)
-            
-            try:
-                # Ensure required directories exist
-                ensure_directories_exist_ipad()
-                
-                # Create the data/input/convatec_ipad directory if it doesn't exist
-                os.makedirs(os.path.join("data", "input", "convatec_ipad"), exist_ok=True)
-                
-                # First combine the service breakdown files
-                combined_df = process_and_combine_csv_ipad(ipad_project_path, ipad_europe_path)
-                
-                # Save the list of services files to the expected locations
-                ipad_europe_services_dest = os.path.join("data", "input", "convatec_ipad", "ipad_europe_services.csv")
-                ipad_uk_services_dest = os.path.join("data", "input", "convatec_ipad", "ipad_uk_services.csv")
-                
-                os.makedirs(os.path.dirname(ipad_europe_services_dest), exist_ok=True)
-                
-                with open(ipad_europe_services_path, 'rb') as src_file, open(ipad_europe_services_dest, 'wb') as dest_file:
-                    dest_file.write(src_file.read())
-                    
-                with open(ipad_uk_services_path, 'rb') as src_file, open(ipad_uk_services_dest, 'wb') as dest_file:
-                    dest_file.write(src_file.read())
-                
-                # Generate the billing report
-                output_path = generate_billing_report_ipad(combined_df)
-            finally:
-                # Clean up temporary files
-                for path in [ipad_project_path, ipad_europe_path, ipad_europe_services_path, ipad_uk_services_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-
-        else:
-            # Handle other clients (Isle Star, etc.)
-            if 'usage_file' not in request.FILES or 'service_file' not in request.FILES:
-                return JsonResponse({'error': 'Please upload both files'}, status=400)
-
-            usage_file = request.FILES['usage_file']
-            service_file = request.FILES['service_file']
-
-            # Save files temporarily
-            fs = FileSystemStorage(location=temp_dir)
-            usage_path = fs.save(f"usage_{client}.csv", usage_file)
-            service_path = fs.save(f"service_breakdown_{client}.csv", service_file)
-            
-            usage_path = os.path.join(temp_dir, usage_path)
-            service_path = os.path.join(temp_dir, service_path)
-
-            try:
-                output_path = process_billing_data(service_path, usage_path, client)
-            finally:
-                # Clean up temporary files
-                for path in [usage_path, service_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-
-        # Store the path for the "Open Report" button
-        last_report_path = output_path
-
-        # Get previous month and current year for filename
-        prev_month = (pd.Timestamp.now() - pd.DateOffset(months=1)).strftime('%B')
-        current_year = pd.Timestamp.now().year
-        
+        prepared = save_report_inputs(request, client)
+        if isinstance(prepared, JsonResponse):
+            return prepared
+        inputs, params, hashes = prepared
+
+        # Run in the generator pool so the server thread doesn't hold the GIL;
+        # the pool deletes the temporary files when the run finishes
+        job = get_job_manager().submit(client, inputs, params, use_cache=not bypass_cache(request), hashes=hashes)
+        report = job.future.result()
+
+        # Remember the job for this session's "Open Report" button
+        request.session[LAST_REPORT_SESSION_KEY] = job.id
+
         # Send file for download
-        response = FileResponse(
-            open(output_path, 'rb'),
-            as_attachment=True,
-            filename=f"{prev_month}_{current_year}_Bill_Run_{client}.xlsx"
-        )
-        return response
+        return report_response(client, report)
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
+
+@csrf_exempt
+def submit_report(request):
+    """
+    Queue a report for generation in the background and return its job id straight away.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST method is allowed'}, status=405)
+
+    client = request.POST.get('client')
+    if not client:
+        return JsonResponse({'error': 'Client selection is required'}, status=400)
+
+    try:
+        prepared = save_report_inputs(request, client)
+        if isinstance(prepared, JsonResponse):
+            return prepared
+        inputs, params, hashes = prepared
+
+        job = get_job_manager().submit(client, inputs, params, use_cache=not bypass_cache(request), hashes=hashes)
+        return JsonResponse({
+            **job.as_dict(),
+            'status_url': reverse('reports:report_status', args=[job.id]),
+            'download_url': reverse('reports:download_report', args=[job.id]),
+        }, status=202)
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+def batch_prefix(client):
+    """
+    Prefix of a client's upload and parameter fields in a batch submission,
+    e.g. "knight-frank-usage_file" or "tysers-pre_tax_amount".
+    """
+    return f"{slugify(client)}-"
+
+
+@csrf_exempt
+def batch_report(request):
+    """
+    Run the monthly bill run for several clients at once and stream back a zip of their reports.
+
+    Each client's files and options are posted under its batch_prefix; a client is
+    included when any of its files are uploaded. The reports are generated
+    concurrently in the job pool and added to the zip as they finish.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST method is allowed'}, status=405)
+
+    clients = [client for client in CLIENTS
+               if any(field.startswith(batch_prefix(client)) for field in request.FILES)]
+    if not clients:
+        remove_uploads(request)
+        return JsonResponse({'error': 'Please upload the files for at least one client'}, status=400)
+
+    # Check every client before running any of them
+    runs = {}
+    errors = []
+    for client in clients:
+        try:
+            runs[client] = report_inputs(request, client, batch_prefix(client))
+        except ValueError as e:
+            errors.append(f"{client}: {e}")
+    if errors:
+        remove_uploads(request)
+        return JsonResponse({'error': '; '.join(errors)}, status=400)
+    remove_uploads(request, keep=[path for inputs, _, _ in runs.values() for path in inputs.values()])
+
+    job_manager = get_job_manager()
+    use_cache = not bypass_cache(request)
+    jobs = [job_manager.submit(client, inputs, params, use_cache=use_cache, hashes=hashes)
+            for client, (inputs, params, hashes) in runs.items()]
+
+    response = StreamingHttpResponse(stream_report_zip(jobs, report_filename), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{bill_run_name()}.zip"'
+    return response
+
+
+def report_status(request, job_id):
+    """
+    Report whether a job is queued, running, done or failed.
+    """
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Unknown job'}, status=404)
+    return JsonResponse(job.as_dict())
+
+
+def download_report(request, job_id):
+    """
+    Download the report produced by a finished job.
+    """
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Unknown job'}, status=404)
+    if job.status != DONE:
+        return JsonResponse({'error': f'Report is not ready (status: {job.status})', **job.as_dict()}, status=409)
+    if not job.report.exists():
+        return JsonResponse({'error': 'Report file no longer exists'}, status=410)
+
+    # Remember the job for this session's "Open Report" button
+    request.session[LAST_REPORT_SESSION_KEY] = job.id
+    return report_response(job.client, job.report)
+
 def open_report(request):
     """
-    Open the most recently generated report using the system's default application.
+    Open this session's most recently generated report using the system's default application.
     """
-    global last_report_path
+    job_id = request.session.get(LAST_REPORT_SESSION_KEY)
+    job = get_job_manager().get(job_id) if job_id else None
+    last_report_path = job.report_file() if job is not None else None
     
     if not last_report_path or not os.path.exists(last_report_path):
         return JsonResponse({'status': 'error', 'message': 'No report found'})
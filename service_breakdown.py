@@ -0,0 +1,95 @@
+import heapq
+import os
+import threading
+from typing import Iterator, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+# Column the breakdown files are merged on
+SERVICE_COLUMN = "Service"
+
+# Rows read from a breakdown file at a time; each chunk is one sorted run of the merge
+MERGE_CHUNK_SIZE = 50_000
+
+
+def read_header(path: str) -> List[str]:
+    """
+    Column names of a breakdown export, checking it has a Service column.
+    """
+    columns = list(pd.read_csv(path, dtype=str, nrows=0).columns)
+    if SERVICE_COLUMN not in columns:
+        raise ValueError(f"Service breakdown {os.path.basename(path)} has no '{SERVICE_COLUMN}' column")
+    return columns
+
+
+def read_sorted_runs(path: str, columns: List[str], chunksize: int = MERGE_CHUNK_SIZE) -> Iterator[List[tuple]]:
+    """
+    Read a breakdown export in chunks, each stably sorted on Service.
+
+    Args:
+        path (str): Path to the breakdown CSV
+        columns (List[str]): Columns of every row, in order; ones the file lacks are missing (NaN)
+        chunksize (int): Rows per chunk
+
+    Yields:
+        List[tuple]: The rows of one chunk as tuples in 'columns' order, with
+            surrounding whitespace stripped from Service, in Service order
+    """
+    for chunk in pd.read_csv(path, dtype=str, chunksize=chunksize):
+        chunk = chunk.reindex(columns=columns)
+        chunk[SERVICE_COLUMN] = chunk[SERVICE_COLUMN].str.strip()
+        order = np.argsort(chunk[SERVICE_COLUMN].fillna("").to_numpy(dtype=str), kind="stable")
+        yield list(chunk.take(order).itertuples(index=False, name=None))
+
+
+def write_debug_csv(df: pd.DataFrame, output_path: str) -> threading.Thread:
+    """
+    Save a copy of the combined breakdown for debugging on a background thread,
+    so the report doesn't wait for it. Join the returned thread to wait for the file.
+    """
+    def write():
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        df.to_csv(output_path, index=False)
+        print(f"Combined CSV saved as: {output_path}")
+
+    writer = threading.Thread(target=write, name="breakdown-debug-csv")
+    writer.start()
+    return writer
+
+
+def combine_service_breakdowns(paths: Sequence[str], debug_path: Optional[str] = None,
+                               chunksize: int = MERGE_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Combine any number of service breakdown files into one frame ordered by Service.
+
+    Each file is read once, in chunks that are stably sorted on Service as they
+    are read. The sorted chunks of all the files are then merged on Service with
+    heapq.merge, which takes rows with equal keys from earlier chunks first, so
+    rows with the same Service keep the order of `paths` and, within a file,
+    their order in the export. The files are never concatenated or sorted as a
+    whole.
+
+    Args:
+        paths (Sequence[str]): Breakdown CSVs, e.g. ConvaTec Limited and PLC
+        debug_path (Optional[str]): If given, also save the combined frame here in the background
+        chunksize (int): Rows read from a file at a time
+
+    Returns:
+        pd.DataFrame: Combined breakdown with a fresh RangeIndex; columns missing
+            from a file are NaN for its rows
+    """
+    if not paths:
+        return pd.DataFrame(columns=[SERVICE_COLUMN])
+
+    columns: List[str] = []
+    for path in paths:
+        columns += [column for column in read_header(path) if column not in columns]
+    service = columns.index(SERVICE_COLUMN)
+
+    runs = [run for path in paths for run in read_sorted_runs(path, columns, chunksize)]
+    merged = heapq.merge(*runs, key=lambda row: row[service] if isinstance(row[service], str) else "")
+    combined = pd.DataFrame.from_records(list(merged), columns=columns)
+
+    if debug_path:
+        write_debug_csv(combined, debug_path)
+    return combined
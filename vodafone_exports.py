@@ -0,0 +1,119 @@
+"""
+Compact loading of the Vodafone CSV exports.
+
+pd.read_csv keeps every text column as Python strings, one object per cell, so
+a usage file with millions of rows takes several GB. Each export type has a
+declared schema here instead: columns of repeated text are parsed straight to
+categoricals (each distinct value stored once, cells hold small integer codes),
+costs are float64 and whole-number columns are downcast to the smallest integer
+type that holds them. Cell values are unchanged, so reports written from a
+compact frame are the same as before.
+
+Only columns that are always text are declared categorical. Columns whose type
+depends on the file (Service, DialledNumber, Data (KB), which pandas reads as
+numbers when every value looks like one) are left to pandas or to the caller.
+"""
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import pandas as pd
+
+CATEGORY = "category"
+FLOAT = "float"
+INTEGER = "integer"
+
+# Usage export (one row per call, text or data session), as used by Islestar,
+# Tysers, Knight Frank and ICR
+USAGE_EXPORT = {
+    "CallDate": CATEGORY,
+    "CallTime": CATEGORY,
+    "CustomerCode": INTEGER,
+    "CustomerName": CATEGORY,
+    "ContractName": CATEGORY,
+    "UserName": CATEGORY,
+    "Duration": CATEGORY,
+    "Usage Type": CATEGORY,
+    "Usage Category": CATEGORY,
+    "Bundle Type": CATEGORY,
+    "Cost": FLOAT,
+    "Country Code": CATEGORY,
+    "Vat Code": CATEGORY,
+}
+
+
+def compact_frame(df: pd.DataFrame, schema: Dict[str, str], skip: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Convert the FLOAT and INTEGER columns of 'schema' in place: floats to float64
+    (values that don't parse become NaN), integers to the smallest integer type.
+    An integer column with blanks is left as pandas read it. Columns in 'skip' are untouched.
+    """
+    for column, kind in schema.items():
+        if column not in df.columns or column in skip:
+            continue
+        if kind == FLOAT:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
+        elif kind == INTEGER and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+    return df
+
+
+def read_export(path: str, schema: Dict[str, str], usecols: Optional[Union[List[str], Callable]] = None,
+                dtype: Optional[Dict[str, object]] = None,
+                chunksize: Optional[int] = None) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    Read a Vodafone CSV export with the compact dtypes of its schema.
+
+    Schema and dtype columns are matched against the file's header with surrounding
+    whitespace ignored; the header itself is returned as it is in the file.
+
+    Args:
+        path (str): Path to the CSV file
+        schema (Dict[str, str]): Column kinds, e.g. USAGE_EXPORT
+        usecols: Columns to read, as for pd.read_csv
+        dtype (Optional[Dict[str, object]]): dtypes that override the schema (e.g. {"Service": str})
+        chunksize (Optional[int]): Return an iterator of frames of this many rows instead of one frame
+
+    Returns:
+        The frame, or an iterator of chunks when chunksize is given
+    """
+    # Schema names -> names as they appear in the file
+    header = {str(column).strip(): column for column in pd.read_csv(path, nrows=0).columns}
+    file_schema = {header[column]: kind for column, kind in schema.items() if column in header}
+    file_dtype = {header[column]: kind for column, kind in (dtype or {}).items() if column in header}
+
+    parse_dtypes = {column: CATEGORY for column, kind in file_schema.items() if kind == CATEGORY}
+    parse_dtypes.update(file_dtype)
+
+    if chunksize is None:
+        return compact_frame(pd.read_csv(path, usecols=usecols, dtype=parse_dtypes), file_schema, skip=list(file_dtype))
+
+    def chunks():
+        for chunk in pd.read_csv(path, usecols=usecols, dtype=parse_dtypes, chunksize=chunksize):
+            yield compact_frame(chunk, file_schema, skip=list(file_dtype))
+    return chunks()
+
+
+def concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    pd.concat for chunks read by read_export. Each chunk's categoricals only know
+    the values in that chunk, and pd.concat falls back to object strings when they
+    differ, so the categories are first unified across the chunks.
+    """
+    if len(chunks) > 1:
+        for column in chunks[0].columns:
+            if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+                categories = chunks[0][column].cat.categories
+                for chunk in chunks[1:]:
+                    categories = categories.union(chunk[column].cat.categories, sort=False)
+                for chunk in chunks:
+                    chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def strip_text(values: pd.Series) -> pd.Series:
+    """
+    Strip surrounding whitespace from a text column. A categorical column has its
+    categories stripped, so it stays categorical where the stripped values stay distinct.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.map(str.strip)
+    return values.str.strip()
@@ -0,0 +1,243 @@
+"""
+Assemble a multi-sheet .xlsx from worksheets rendered in parallel.
+
+Each worksheet is serialized to its own XML part by a worker process and the
+parts are then stitched into a single .xlsx package. Worksheets write their
+text as inline strings rather than through a shared-strings table, so workers
+never need to agree on string indexes and can render fully independently.
+Styles are fixed up front in the parent (the header style plus one style per
+number format in use), so workers only refer to them by index.
+"""
+import math
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from numbers import Number
+from typing import BinaryIO, Dict, List, Optional, Union
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+import pandas as pd
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+from openpyxl.workbook.child import avoid_duplicate_name
+
+# Style index of the header row; index 0 is the default style
+HEADER_STYLE = 1
+
+# Number formats below this id are built into Excel
+FIRST_CUSTOM_NUM_FMT_ID = 164
+
+CONTENT_TYPES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+{overrides}
+</Types>"""
+
+ROOT_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+WORKBOOK_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>{sheets}</sheets>
+</workbook>"""
+
+WORKBOOK_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+{sheets}
+<Relationship Id="rId{styles_id}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+# Header style: blue fill, white bold centered text, thin borders (as icr_report.apply_header_formatting)
+STYLES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+{num_fmts}
+<fonts count="2">
+<font><sz val="11"/><name val="Calibri"/><family val="2"/></font>
+<font><b val="1"/><sz val="11"/><color rgb="00FFFFFF"/><name val="Calibri"/><family val="2"/></font>
+</fonts>
+<fills count="3">
+<fill><patternFill/></fill>
+<fill><patternFill patternType="gray125"/></fill>
+<fill><patternFill patternType="solid"><fgColor rgb="004F81BD"/><bgColor rgb="004F81BD"/></patternFill></fill>
+</fills>
+<borders count="2">
+<border><left/><right/><top/><bottom/><diagonal/></border>
+<border><left style="thin"/><right style="thin"/><top style="thin"/><bottom style="thin"/><diagonal/></border>
+</borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="{xf_count}">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="2" borderId="1" xfId="0" applyFont="1" applyFill="1" applyBorder="1" applyAlignment="1"><alignment horizontal="center" vertical="center"/></xf>
+{number_xfs}
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+
+def _cell_xml(ref: str, value, style: Optional[int]) -> str:
+    """
+    Serialize one cell. Missing values produce no cell at all.
+    """
+    style_attr = f' s="{style}"' if style else ""
+    if value is None or value is pd.NA or value is pd.NaT:
+        return ""
+    # numpy's bool_ and float32 are not subclasses of bool and float
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, Number):
+        is_float = isinstance(value, (float, np.floating))
+        if is_float and not math.isfinite(value):
+            return ""
+        number = repr(float(value)) if is_float else str(int(value))
+        return f'<c r="{ref}"{style_attr}><v>{number}</v></c>'
+    text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+
+def render_sheet(part_path: str, header: List[str], df: Optional[pd.DataFrame], header_styled: bool,
+                 widths: Optional[List[float]], column_styles: Dict[int, int]) -> str:
+    """
+    Render one worksheet XML part to 'part_path'. Runs in a worker process.
+
+    Returns:
+        str: The path written
+    """
+    letters = [get_column_letter(col_num) for col_num in range(1, len(header) + 1)]
+    header_style = HEADER_STYLE if header_styled else None
+    styles = [column_styles.get(col_num) for col_num in range(len(header))]
+
+    with open(part_path, "w", encoding="utf-8") as part:
+        part.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                   '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">')
+        if widths:
+            part.write("<cols>")
+            for col_num, width in enumerate(widths, start=1):
+                part.write(f'<col min="{col_num}" max="{col_num}" width="{width}" customWidth="1"/>')
+            part.write("</cols>")
+
+        part.write('<sheetData><row r="1">')
+        part.write("".join(_cell_xml(f"{letter}1", name, header_style) for letter, name in zip(letters, header)))
+        part.write("</row>")
+        if df is not None:
+            for row_num, row in enumerate(df.itertuples(index=False), start=2):
+                cells = "".join(
+                    _cell_xml(f"{letter}{row_num}", value, style)
+                    for letter, value, style in zip(letters, row, styles)
+                )
+                part.write(f'<row r="{row_num}">{cells}</row>')
+        part.write("</sheetData></worksheet>")
+    return part_path
+
+
+class WorkbookAssembler:
+    """
+    Collects worksheets, renders them in a process pool and writes one .xlsx.
+
+    Mirrors the parts of the openpyxl Workbook interface the report modules use
+    ('sheetnames', 'save'), with 'add_sheet' taking a whole DataFrame per sheet.
+    """
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes
+        self._sheets = []
+        self._num_formats: List[str] = []
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return [sheet["name"] for sheet in self._sheets]
+
+    def add_sheet(self, sheet_name: str, df: Optional[pd.DataFrame], header: List[str],
+                  header_styled: bool = True, widths: Optional[List[float]] = None,
+                  number_formats: Optional[Dict[int, str]] = None) -> str:
+        """
+        Queue a worksheet. With df=None only the header row is written.
+
+        Args:
+            sheet_name (str): Requested title; duplicates get a numeric suffix as in openpyxl
+            df (Optional[pd.DataFrame]): Rows to write below the header
+            header (List[str]): Header row
+            header_styled (bool): Apply the shared header style to the header row
+            widths (Optional[List[float]]): Column widths, one per header column
+            number_formats (Optional[Dict[int, str]]): Number format per 0-based column index
+
+        Returns:
+            str: The title the sheet was given
+        """
+        title = avoid_duplicate_name(self.sheetnames, sheet_name)
+        column_styles = {}
+        for col_num, num_format in (number_formats or {}).items():
+            if num_format not in self._num_formats:
+                self._num_formats.append(num_format)
+            column_styles[col_num] = HEADER_STYLE + 1 + self._num_formats.index(num_format)
+        self._sheets.append({
+            "name": title, "header": list(header), "df": df, "header_styled": header_styled,
+            "widths": widths, "column_styles": column_styles,
+        })
+        return title
+
+    def _styles_xml(self) -> str:
+        num_fmts = ""
+        number_xfs = ""
+        if self._num_formats:
+            num_fmts = f'<numFmts count="{len(self._num_formats)}">' + "".join(
+                f'<numFmt numFmtId="{FIRST_CUSTOM_NUM_FMT_ID + i}" formatCode={quoteattr(code)}/>'
+                for i, code in enumerate(self._num_formats)
+            ) + "</numFmts>"
+            number_xfs = "".join(
+                f'<xf numFmtId="{FIRST_CUSTOM_NUM_FMT_ID + i}" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+                for i in range(len(self._num_formats))
+            )
+        return STYLES_XML.format(num_fmts=num_fmts, number_xfs=number_xfs,
+                                 xf_count=HEADER_STYLE + 1 + len(self._num_formats))
+
+    def save(self, output_path: Union[str, BinaryIO]) -> None:
+        """
+        Render every queued sheet in the process pool and write the .xlsx package
+        to a path or a seekable binary file object.
+        """
+        part_dir = tempfile.mkdtemp(prefix="workbook_parts_")
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                futures = [
+                    pool.submit(render_sheet, os.path.join(part_dir, f"sheet{i}.xml"), sheet["header"],
+                                sheet["df"], sheet["header_styled"], sheet["widths"], sheet["column_styles"])
+                    for i, sheet in enumerate(self._sheets, start=1)
+                ]
+                part_paths = [future.result() for future in futures]
+
+            count = len(part_paths)
+            overrides = "\n".join(
+                f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                for i in range(1, count + 1)
+            )
+            sheets = "".join(
+                f'<sheet name={quoteattr(sheet["name"])} sheetId="{i}" r:id="rId{i}"/>'
+                for i, sheet in enumerate(self._sheets, start=1)
+            )
+            sheet_rels = "\n".join(
+                f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                f'Target="worksheets/sheet{i}.xml"/>'
+                for i in range(1, count + 1)
+            )
+
+            with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as package:
+                package.writestr("[Content_Types].xml", CONTENT_TYPES_XML.format(overrides=overrides))
+                package.writestr("_rels/.rels", ROOT_RELS_XML)
+                package.writestr("xl/workbook.xml", WORKBOOK_XML.format(sheets=sheets))
+                package.writestr("xl/_rels/workbook.xml.rels",
+                                 WORKBOOK_RELS_XML.format(sheets=sheet_rels, styles_id=count + 1))
+                package.writestr("xl/styles.xml", self._styles_xml())
+                for i, part_path in enumerate(part_paths, start=1):
+                    package.write(part_path, f"xl/worksheets/sheet{i}.xml")
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
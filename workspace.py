@@ -0,0 +1,60 @@
+"""
+Per-run workspaces.
+
+Each report run gets a directory of its own, holding its inputs and the report
+it writes, so concurrent runs (even for the same client and month, whose
+reports share a file name) never touch each other's files.
+"""
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict
+
+
+class RunWorkspace:
+    """
+    A fresh directory under 'root' with 'input' and 'output' subdirectories.
+
+    Args:
+        root (str): Directory the workspace is created in
+        prefix (str): Prefix of the workspace directory name
+    """
+
+    def __init__(self, root: str, prefix: str = "run-"):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=root, prefix=prefix)
+        self.input_dir = os.path.join(self.path, "input")
+        self.output_dir = os.path.join(self.path, "output")
+        os.makedirs(self.input_dir)
+        os.makedirs(self.output_dir)
+
+    def add_input(self, path: str) -> str:
+        """
+        Move a file into the workspace's input directory and return its new path.
+        """
+        target = os.path.join(self.input_dir, os.path.basename(path))
+        shutil.move(path, target)
+        return target
+
+    def add_inputs(self, inputs: Dict[str, str]) -> Dict[str, str]:
+        """
+        Move every input of a run into the workspace; returns the new paths under the same keys.
+        """
+        return {field: self.add_input(path) for field, path in inputs.items()}
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def remove_stale_workspaces(root: str, max_age: float, prefix: str = "run-") -> None:
+    """
+    Delete workspaces under 'root' that haven't been modified for 'max_age' seconds.
+    """
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name.startswith(prefix) and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)